@@ -0,0 +1,128 @@
+"""Streaming download of Gmail attachments into a content-addressed store."""
+
+import base64
+import fnmatch
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def iter_attachment_parts(part: dict) -> Iterator[dict]:
+    """Yield the message parts whose body is stored as a separate attachment."""
+    if part.get("body", {}).get("attachmentId"):
+        yield part
+    for child in part.get("parts", []):
+        yield from iter_attachment_parts(child)
+
+
+def mime_type_allowed(mime_type: str, patterns: Optional[List[str]]) -> bool:
+    """Return True if `mime_type` matches one of `patterns`, e.g. "image/*"."""
+    if not patterns:
+        return True
+    return any(fnmatch.fnmatch(mime_type.lower(), pattern.lower()) for pattern in patterns)
+
+
+def iter_json_string(chunks: Iterable[bytes], key: str) -> Iterator[bytes]:
+    """Yield the value of string field `key` of a streamed JSON object, in pieces.
+
+    Only suitable for values that need no unescaping, such as base64url data.
+    """
+    marker = f'"{key}"'.encode()
+    buffer = b""
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buffer += chunk
+        index = buffer.find(marker)
+        if index < 0:
+            buffer = buffer[-len(marker):]
+            continue
+        opening = buffer.find(b'"', index + len(marker))
+        if opening < 0:
+            buffer = buffer[index:]
+            continue
+        value = buffer[opening + 1:]
+        break
+    else:
+        raise ValueError(f"No {key!r} field in response")
+
+    while True:
+        closing = value.find(b'"')
+        if closing >= 0:
+            yield value[:closing]
+            return
+        yield value
+        value = next(chunks, None)
+        if value is None:
+            raise ValueError(f"Truncated {key!r} field in response")
+
+
+class Base64UrlDecoder:
+    """Decode base64url text that arrives in chunks of any length."""
+
+    def __init__(self) -> None:
+        """Initialize the decoder."""
+        self._pending = b""
+
+    def decode(self, chunk: bytes) -> bytes:
+        """Decode every complete 4-character group received so far."""
+        data = self._pending + chunk
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        return base64.urlsafe_b64decode(data[:usable])
+
+    def flush(self) -> bytes:
+        """Decode the final, possibly unpadded, group."""
+        data, self._pending = self._pending, b""
+        return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4)) if data else b""
+
+
+def decode_attachment(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Decode the `data` of a streamed messages.attachments.get response."""
+    decoder = Base64UrlDecoder()
+    for encoded in iter_json_string(chunks, "data"):
+        yield decoder.decode(encoded)
+    yield decoder.flush()
+
+
+class AttachmentStore:
+    """Directory of attachment files named by the SHA-256 of their content.
+
+    Identical attachments, from any message, are stored once.
+    """
+
+    def __init__(self, directory: str) -> None:
+        """Initialize the store, creating `directory` if needed."""
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, sha256: str) -> Path:
+        """Return where content with the given hash is stored."""
+        return self.directory / sha256[:2] / sha256
+
+    def save(self, chunks: Iterable[bytes]) -> Tuple[Path, int, str]:
+        """Write `chunks` to the store and return their path, size and SHA-256."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, partial = tempfile.mkstemp(dir=self.directory, prefix=".partial-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path_for(sha256)
+            if path.exists():
+                os.remove(partial)
+            else:
+                path.parent.mkdir(exist_ok=True)
+                os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return path, size, sha256
@@ -1,12 +1,48 @@
 """Gmail Authentication."""
 
+import threading
+from typing import Dict
 
-from singer_sdk.authenticators import OAuthAuthenticator, SingletonMeta
+import requests
+from singer_sdk.authenticators import (
+    OAuthAuthenticator,
+    OAuthJWTAuthenticator,
+    SingletonMeta,
+)
+
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+SCOPE = "https://www.googleapis.com/auth/gmail.readonly"
+PUBSUB_SCOPE = "https://www.googleapis.com/auth/pubsub"
+
+
+def scopes_for(config: dict) -> str:
+    """Return the scopes to request, adding Pub/Sub when notifications are pulled."""
+    if config.get("watch.subscription"):
+        return f"{SCOPE} {PUBSUB_SCOPE}"
+    return SCOPE
+
+
+class LockedRefreshMixin:
+    """Refresh an expired token once, however many threads notice it."""
+
+    _refresh_lock = threading.Lock()
+
+    def authenticate_request(
+        self, request: requests.PreparedRequest
+    ) -> requests.PreparedRequest:
+        """Authenticate a request, refreshing the token at most once at a time."""
+        if not self.is_token_valid():
+            with self._refresh_lock:
+                if not self.is_token_valid():
+                    self.update_access_token()
+        return super().authenticate_request(request)
 
 
 # The SingletonMeta metaclass makes your streams reuse the same authenticator instance.
 # If this behaviour interferes with your use-case, you can remove the metaclass.
-class GmailAuthenticator(OAuthAuthenticator, metaclass=SingletonMeta):
+class GmailAuthenticator(
+    LockedRefreshMixin, OAuthAuthenticator, metaclass=SingletonMeta
+):
     """Authenticator class for Gmail."""
 
     @property
@@ -24,6 +60,48 @@ class GmailAuthenticator(OAuthAuthenticator, metaclass=SingletonMeta):
     def create_for_stream(cls, stream) -> "GmailAuthenticator":
         return cls(
             stream=stream,
-            auth_endpoint="https://oauth2.googleapis.com/token",
-            oauth_scopes="https://www.googleapis.com/auth/gmail.readonly",
+            auth_endpoint=TOKEN_URI,
+            oauth_scopes=scopes_for(stream.config),
+        )
+
+
+class GmailServiceAccountAuthenticator(LockedRefreshMixin, OAuthJWTAuthenticator):
+    """Service account token impersonating one mailbox of a Workspace domain.
+
+    Requires domain-wide delegation of the Gmail read-only scope to the service
+    account, and of the Pub/Sub scope when notifications are pulled. One
+    instance, with its own token, is kept per mailbox.
+    """
+
+    _instances: Dict[str, "GmailServiceAccountAuthenticator"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, stream, user_id: str) -> None:
+        """Initialize the authenticator for `user_id`'s mailbox."""
+        super().__init__(
+            stream=stream, auth_endpoint=TOKEN_URI, oauth_scopes=scopes_for(stream.config)
         )
+        self.user_id = user_id
+        # Each mailbox refreshes its own token
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def private_key(self) -> str:
+        """Return the service account's PEM private key."""
+        return self.config["service_account.private_key"]
+
+    @property
+    def oauth_request_body(self) -> dict:
+        """Sign as the service account on behalf of the mailbox's user."""
+        body = super().oauth_request_body
+        body["iss"] = self.config["service_account.client_email"]
+        body["sub"] = self.user_id
+        return body
+
+    @classmethod
+    def for_user(cls, stream, user_id: str) -> "GmailServiceAccountAuthenticator":
+        """Return the shared authenticator of `user_id`'s mailbox."""
+        with cls._instances_lock:
+            if user_id not in cls._instances:
+                cls._instances[user_id] = cls(stream, user_id)
+            return cls._instances[user_id]
@@ -0,0 +1,111 @@
+"""Time-window partitioning for parallel backfills of a mailbox."""
+
+import datetime
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+GMAIL_LAUNCH_DATE = datetime.date(2004, 4, 1)
+MIN_WINDOW_SECONDS = 3600  # Windows are never split below an hour
+
+Window = Tuple[int, int]  # (after, before) in epoch seconds
+
+
+def plan_windows(
+    start: datetime.date, end: datetime.date, days: int
+) -> List[str]:
+    """Split [start, end] into `days`-long windows named "YYYY-MM-DD/YYYY-MM-DD".
+
+    Boundaries are aligned on `start`, so the names stay stable between runs and
+    a later run only appends new windows.
+    """
+    windows = []
+    window_start = start
+    while window_start <= end:
+        window_end = window_start + datetime.timedelta(days=days)
+        windows.append(f"{window_start.isoformat()}/{window_end.isoformat()}")
+        window_start = window_end
+    return windows
+
+
+def window_bounds(name: str) -> Window:
+    """Return the epoch-second bounds of a window name from `plan_windows`."""
+    after, before = (
+        datetime.datetime.combine(
+            datetime.date.fromisoformat(day), datetime.time(), datetime.timezone.utc
+        )
+        for day in name.split("/")
+    )
+    return int(after.timestamp()), int(before.timestamp())
+
+
+class WindowLister:
+    """List message ids of time windows concurrently, ahead of their hydration.
+
+    A window whose first page estimates more than `max_messages` results is split
+    in half, and the halves are listed in parallel, until windows reach
+    `MIN_WINDOW_SECONDS`.
+    """
+
+    def __init__(
+        self,
+        list_page: Callable[[Window, Optional[str]], dict],
+        max_messages: int,
+        max_workers: int,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        """Initialize the lister around a `list_page(window, page_token)` callable."""
+        self.list_page = list_page
+        self.max_messages = max_messages
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.logger = logger or logging.getLogger(__name__)
+        self._pending: Dict[Window, List[Future]] = {}
+
+    def _list(self, window: Window) -> Tuple[List[str], List[Future]]:
+        """List one window, or start listing its halves if it is too dense.
+
+        Halves are submitted from the worker itself (which never waits on them),
+        so dense windows keep splitting in the background.
+        """
+        data = self.list_page(window, None)
+        after, before = window
+        if (
+            data.get("resultSizeEstimate", 0) > self.max_messages
+            and before - after > MIN_WINDOW_SECONDS
+        ):
+            middle = (after + before) // 2
+            self.logger.info(
+                f"Splitting backfill window {window} with about "
+                f"{data['resultSizeEstimate']} messages"
+            )
+            return [], [
+                self.executor.submit(self._list, half)
+                for half in ((middle, before), (after, middle))
+            ]
+
+        ids = [message["id"] for message in data.get("messages", [])]
+        while data.get("nextPageToken"):
+            data = self.list_page(window, data["nextPageToken"])
+            ids.extend(message["id"] for message in data.get("messages", []))
+        return ids, []
+
+    def prefetch(self, window: Window) -> None:
+        """Start listing `window` in the background."""
+        if window not in self._pending:
+            self._pending[window] = [self.executor.submit(self._list, window)]
+
+    def ids(self, window: Window) -> List[str]:
+        """Return the ids in `window`, newest first, waiting for any split halves."""
+        self.prefetch(window)
+        futures = self._pending.pop(window)
+        ids: List[str] = []
+        while futures:
+            listed, halves = futures.pop(0).result()
+            ids.extend(listed)
+            # Keep newest-first order: the newer half comes before the older
+            futures[0:0] = halves
+        return ids
+
+    def shutdown(self) -> None:
+        """Stop the listing threads."""
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,368 @@
+"""Multipart HTTP batch client for the Gmail API."""
+
+import logging
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from urllib.parse import urlencode
+
+import requests
+from singer_sdk.exceptions import FatalAPIError, RetriableAPIError
+
+from tap_gmail.fastjson import loads
+from tap_gmail.instrumentation import SyncMetrics
+from tap_gmail.ratelimit import QUOTA_UNITS, AdaptiveConcurrency, QuotaRateLimiter
+
+BATCH_PATH = "/batch/gmail/v1"
+MAX_BATCH_SIZE = 100  # Gmail rejects batches with more than 100 sub-requests
+RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_CONTENT_ID_RE = re.compile(r"<response-(.+)>")
+
+
+class SubResponse(NamedTuple):
+    """A single demultiplexed response from a batch call."""
+
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+    def json(self) -> Any:
+        """Decode the sub-response body as JSON."""
+        return loads(self.body) if self.body else {}
+
+    @property
+    def is_rate_limited(self) -> bool:
+        """Return True if Gmail rejected the sub-request for quota reasons."""
+        if self.status == 429:
+            return True
+        if self.status != 403:
+            return False
+        try:
+            errors = self.json().get("error", {}).get("errors", [])
+        except ValueError:
+            return False
+        return any(error.get("reason") in RATE_LIMIT_REASONS for error in errors)
+
+    @property
+    def is_retriable(self) -> bool:
+        """Return True if the sub-request may succeed when sent again."""
+        return self.status in RETRIABLE_STATUSES or self.is_rate_limited
+
+
+def build_batch_body(
+    requests_by_id: Dict[str, str], boundary: str
+) -> bytes:
+    """Encode GET sub-requests as a multipart/mixed batch body.
+
+    `requests_by_id` maps a Content-ID to the path (with query string) of the
+    sub-request.
+    """
+    lines: List[str] = []
+    for content_id, path in requests_by_id.items():
+        lines.extend(
+            [
+                f"--{boundary}",
+                "Content-Type: application/http",
+                f"Content-ID: <{content_id}>",
+                "",
+                f"GET {path}",
+                "Accept: application/json",
+                "",
+            ]
+        )
+    lines.append(f"--{boundary}--")
+    lines.append("")
+    return "\r\n".join(lines).encode("utf-8")
+
+
+def _split_head(block: bytes) -> List[bytes]:
+    """Split an HTTP-style block into its header section and body."""
+    for separator in (b"\r\n\r\n", b"\n\n"):
+        if separator in block:
+            return block.split(separator, 1)
+    return [block, b""]
+
+
+def _parse_headers(lines: Iterable[bytes]) -> Dict[str, str]:
+    headers = {}
+    for line in lines:
+        if b":" in line:
+            name, value = line.split(b":", 1)
+            headers[name.decode("latin-1").strip().lower()] = (
+                value.decode("latin-1").strip()
+            )
+    return headers
+
+
+def parse_batch_response(content_type: str, content: bytes) -> Dict[str, SubResponse]:
+    """Demultiplex a multipart/mixed batch response.
+
+    Returns a mapping of the original Content-ID to its sub-response.
+    """
+    match = _BOUNDARY_RE.search(content_type or "")
+    if not match:
+        raise ValueError(f"Batch response is not multipart: {content_type!r}")
+    delimiter = b"--" + match.group(1).encode("latin-1")
+
+    responses: Dict[str, SubResponse] = {}
+    for part in content.split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        outer_head, inner = _split_head(part.strip(b"\r\n"))
+        outer_headers = _parse_headers(outer_head.splitlines())
+        id_match = _CONTENT_ID_RE.match(outer_headers.get("content-id", ""))
+        if not id_match:
+            continue
+
+        inner_head, body = _split_head(inner)
+        inner_lines = inner_head.splitlines()
+        status_line = inner_lines[0].decode("latin-1") if inner_lines else ""
+        status = int(status_line.split()[1]) if len(status_line.split()) > 1 else 0
+        responses[id_match.group(1)] = SubResponse(
+            status=status,
+            headers=_parse_headers(inner_lines[1:]),
+            body=body.rstrip(b"\r\n"),
+        )
+    return responses
+
+
+class GmailBatchClient:
+    """Fetch Gmail resources through the `/batch/gmail/v1` endpoint.
+
+    Up to `batch_size` GET sub-requests are packed into each HTTP call, and up to
+    `concurrency.limit` batch calls run in parallel. Every call first reserves its
+    quota units from `rate_limiter`. Sub-requests that fail with a retriable status
+    are resent in a following batch, and throttling shrinks both the fill rate and
+    the number of calls in flight.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        url_base: str,
+        auth: Optional[Callable] = None,
+        headers: Optional[Dict[str, str]] = None,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_retries: int = 5,
+        timeout: int = 300,
+        rate_limiter: Optional[QuotaRateLimiter] = None,
+        concurrency: Optional[AdaptiveConcurrency] = None,
+        max_in_flight_messages: int = 1000,
+        max_in_flight_bytes: int = 64 * 1024 * 1024,
+        logger: Optional[logging.Logger] = None,
+        metrics: Optional[SyncMetrics] = None,
+    ) -> None:
+        """Initialize the batch client."""
+        self.session = session
+        self.url = url_base + BATCH_PATH
+        self.auth = auth
+        self.headers = headers or {}
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or QuotaRateLimiter()
+        self.concurrency = concurrency or AdaptiveConcurrency(1)
+        self.max_in_flight_messages = max_in_flight_messages
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics or SyncMetrics()
+
+    def _send(
+        self, requests_by_id: Dict[str, str], units: int
+    ) -> Dict[str, SubResponse]:
+        """POST one batch, retrying transport-level failures of the whole call."""
+        boundary = f"batch_{random.getrandbits(64):016x}"
+        body = build_batch_body(requests_by_id, boundary)
+        headers = dict(self.headers)
+        headers["Content-Type"] = f"multipart/mixed; boundary={boundary}"
+        self.metrics.observe("batch_fill_ratio", len(requests_by_id) / self.batch_size)
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(units * len(requests_by_id))
+            self.metrics.increment(
+                "quota_units_total", units * len(requests_by_id), endpoint="batch"
+            )
+            try:
+                with self.metrics.timer("http_request_duration_seconds", endpoint="batch"):
+                    response = self.session.post(
+                        self.url,
+                        data=body,
+                        headers=headers,
+                        auth=self.auth,
+                        timeout=self.timeout,
+                    )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"Batch request failed, retrying: {str(e)}")
+            else:
+                self.metrics.increment(
+                    "received_bytes_total", len(response.content), endpoint="batch"
+                )
+                if response.status_code not in RETRIABLE_STATUSES:
+                    response.raise_for_status()
+                    return parse_batch_response(
+                        response.headers.get("Content-Type", ""), response.content
+                    )
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                if response.status_code == 429:
+                    self._throttled()
+                self.logger.warning(
+                    f"Batch request returned {response.status_code}, retrying"
+                )
+            self._sleep(attempt)
+        return {}
+
+    def _sleep(self, attempt: int) -> None:
+        wait = min(2 ** attempt, 64) + random.random()
+        self.metrics.increment("retries_total", endpoint="batch")
+        self.metrics.increment("backoff_seconds_total", wait, endpoint="batch")
+        time.sleep(wait)
+
+    def _throttled(self) -> None:
+        self.rate_limiter.penalize()
+        self.concurrency.decrease()
+        self.logger.warning(
+            f"Rate limited by Gmail, reducing to {self.rate_limiter.rate:.0f} "
+            f"units/s and {self.concurrency.limit} concurrent requests"
+        )
+
+    def _fetch_chunk(
+        self, paths: Dict[str, str], units: int, missing_ok: bool = False
+    ) -> Tuple[List[tuple], int]:
+        """Fetch one batch worth of `paths`, retrying failed sub-requests.
+
+        Returns the `(key, json)` results and the number of body bytes received.
+        Raises if a sub-request fails permanently or still fails after
+        `max_retries`, so that nothing is silently left out of the sync.
+        """
+        pending = {f"item-{index}": key for index, key in enumerate(paths)}
+        results = []
+        received = 0
+        attempt = 0
+        parsing = 0.0
+        while pending:
+            responses = self._send(
+                {content_id: paths[key] for content_id, key in pending.items()},
+                units,
+            )
+            retry = {}
+            for content_id, key in pending.items():
+                sub_response = responses.get(content_id)
+                if sub_response is None or sub_response.is_retriable:
+                    retry[content_id] = key
+                elif sub_response.status == 200:
+                    received += len(sub_response.body)
+                    started = time.perf_counter()
+                    results.append((key, sub_response.json()))
+                    parsing += time.perf_counter() - started
+                elif sub_response.status == 404 and missing_ok:
+                    self.logger.debug(f"{paths[key]} no longer exists")
+                else:
+                    raise FatalAPIError(
+                        f"Error fetching {paths[key]}: "
+                        f"{sub_response.status} {sub_response.body[:200]!r}"
+                    )
+            if not retry:
+                self.rate_limiter.reward()
+                self.concurrency.increase()
+                break
+            if any(
+                responses.get(content_id) is not None
+                and responses[content_id].is_rate_limited
+                for content_id in retry
+            ):
+                self._throttled()
+            if attempt >= self.max_retries:
+                raise RetriableAPIError(
+                    f"Giving up on {len(retry)} sub-requests after "
+                    f"{attempt} retries, e.g. {paths[next(iter(retry.values()))]}"
+                )
+            self.logger.info(f"Retrying {len(retry)} failed sub-requests")
+            self._sleep(attempt)
+            attempt += 1
+            pending = retry
+        self.metrics.increment("processing_seconds_total", parsing, stage="parse")
+        return results, received
+
+    def _window_full(self, in_flight: Deque[Future]) -> bool:
+        """Return True if no further batch may start until the oldest is consumed."""
+        if not in_flight:
+            return False
+        if len(in_flight) >= self.concurrency.limit:
+            return True
+        if len(in_flight) * self.batch_size >= self.max_in_flight_messages:
+            return True
+        buffered = sum(future.result()[1] for future in in_flight if future.done())
+        return buffered >= self.max_in_flight_bytes
+
+    def get(
+        self, paths: Dict[str, str], units: int = 5, missing_ok: bool = False
+    ) -> Iterator[tuple]:
+        """Fetch GET `paths` (keyed by caller id), yielding `(key, json)` pairs.
+
+        `units` is the quota cost of a single sub-request. Results are yielded
+        batch by batch in the order of `paths`. A sub-request that fails for good
+        raises; with `missing_ok`, resources that no longer exist (404) are skipped
+        quietly instead.
+
+        New batches only start while the results waiting to be consumed stay under
+        `max_in_flight_messages` and `max_in_flight_bytes`, so a slow consumer holds
+        back fetching instead of letting results pile up in memory.
+        """
+        keys = list(paths)
+        chunks = [
+            {key: paths[key] for key in keys[start:start + self.batch_size]}
+            for start in range(0, len(keys), self.batch_size)
+        ]
+        if len(chunks) <= 1 or self.concurrency.maximum == 1:
+            for chunk in chunks:
+                yield from self._fetch_chunk(chunk, units, missing_ok)[0]
+            return
+
+        in_flight: Deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency.maximum) as executor:
+            for chunk in chunks:
+                while self._window_full(in_flight):
+                    yield from in_flight.popleft().result()[0]
+                in_flight.append(executor.submit(self._fetch_chunk, chunk, units, missing_ok))
+            while in_flight:
+                yield from in_flight.popleft().result()[0]
+
+    def get_messages(
+        self,
+        user_id: str,
+        message_ids: List[str],
+        params: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[dict]:
+        """Fetch full messages by id using batched `messages.get` calls.
+
+        Messages deleted since they were listed are skipped.
+        """
+        query = f"?{urlencode(params, doseq=True)}" if params else ""
+        paths = {
+            message_id: f"/gmail/v1/users/{user_id}/messages/{message_id}{query}"
+            for message_id in dict.fromkeys(message_ids)
+        }
+        for _, message in self.get(
+            paths, units=QUOTA_UNITS["messages.get"], missing_ok=True
+        ):
+            yield message
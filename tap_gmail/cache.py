@@ -0,0 +1,142 @@
+"""Persistent on-disk cache of hydrated messages."""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from tap_gmail.fastjson import dumps, loads
+
+QUERY_CHUNK_SIZE = 500  # Ids per SELECT, below SQLite's bound parameter limit
+EVICT_INTERVAL = 1000  # Writes between age-based evictions
+
+
+class MessageCache:
+    """SQLite cache of message payloads, keyed by mailbox, message id and variant.
+
+    The variant identifies the messages.get parameters the payload was fetched
+    with, since a minimal message cannot stand in for a full one. Each entry keeps
+    the message's historyId, so a caller can tell whether it is still current.
+    Entries older than `max_age_seconds` are dropped, and the oldest ones are
+    evicted whenever compressed payloads exceed `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age_seconds: float) -> None:
+        """Open, creating if needed, the cache database at `path`."""
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " user_id TEXT NOT NULL,"
+            " message_id TEXT NOT NULL,"
+            " variant TEXT NOT NULL,"
+            " history_id INTEGER NOT NULL,"
+            " payload BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " stored_at REAL NOT NULL,"
+            " PRIMARY KEY (user_id, message_id, variant))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS messages_stored_at ON messages (stored_at)"
+        )
+        self._writes = 0
+        with self._lock:
+            self._size = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM messages"
+            ).fetchone()[0]
+            self._evict()
+
+    @staticmethod
+    def variant(params: Optional[dict]) -> str:
+        """Return the cache variant of a set of messages.get parameters."""
+        return json.dumps(params or {}, sort_keys=True)
+
+    def history_ids(
+        self, user_id: str, message_ids: List[str], variant: str
+    ) -> Dict[str, int]:
+        """Return the cached historyId of each of `message_ids` that is cached."""
+        found: Dict[str, int] = {}
+        with self._lock:
+            for start in range(0, len(message_ids), QUERY_CHUNK_SIZE):
+                chunk = message_ids[start:start + QUERY_CHUNK_SIZE]
+                rows = self._connection.execute(
+                    "SELECT message_id, history_id FROM messages"
+                    " WHERE user_id = ? AND variant = ?"
+                    f" AND message_id IN ({','.join('?' * len(chunk))})",
+                    [user_id, variant, *chunk],
+                )
+                found.update(rows)
+        return found
+
+    def get(self, user_id: str, message_id: str, variant: str) -> Optional[dict]:
+        """Return the cached payload of a message, if any."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload FROM messages"
+                " WHERE user_id = ? AND message_id = ? AND variant = ?",
+                (user_id, message_id, variant),
+            ).fetchone()
+        return loads(zlib.decompress(row[0])) if row else None
+
+    def put(self, user_id: str, message: dict, variant: str) -> None:
+        """Store a freshly fetched message."""
+        payload = zlib.compress(dumps(message))
+        key = (user_id, message["id"], variant)
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM messages"
+                " WHERE user_id = ? AND message_id = ? AND variant = ?",
+                key,
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, int(message.get("historyId") or 0), payload, len(payload), time.time()),
+            )
+            self._size += len(payload) - (previous[0] if previous else 0)
+            self._writes += 1
+            if self._size > self.max_bytes or self._writes % EVICT_INTERVAL == 0:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Drop expired entries, then the oldest ones until under `max_bytes`."""
+        if self.max_age_seconds:
+            self._connection.execute(
+                "DELETE FROM messages WHERE stored_at < ?",
+                (time.time() - self.max_age_seconds,),
+            )
+        self._size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM messages"
+        ).fetchone()[0]
+        if self._size <= self.max_bytes:
+            return
+        # Free a tenth more than needed, so eviction does not run on every write
+        excess = self._size - self.max_bytes * 0.9
+        freed = 0
+        evicted = []
+        for rowid, size in self._connection.execute(
+            "SELECT rowid, size FROM messages ORDER BY stored_at"
+        ):
+            evicted.append(rowid)
+            freed += size
+            if freed >= excess:
+                break
+        for start in range(0, len(evicted), QUERY_CHUNK_SIZE):
+            chunk = evicted[start:start + QUERY_CHUNK_SIZE]
+            self._connection.execute(
+                f"DELETE FROM messages WHERE rowid IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+        self._size -= freed
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._connection.close()
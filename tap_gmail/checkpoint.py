@@ -0,0 +1,80 @@
+"""Resumable bookmarks for the Gmail history feed."""
+
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+
+def max_history_id(*history_ids: Optional[str]) -> Optional[str]:
+    """Return the numerically largest history id, ignoring missing values."""
+    present = [history_id for history_id in history_ids if history_id]
+    return max(present, key=int) if present else None
+
+
+class HistoryCheckpoint:
+    """Track which history records of a page have been fully emitted.
+
+    History records arrive in ascending id order and each names the messages it
+    touched. `safe_history_id` only moves past a record once every message it
+    names has been emitted, so resuming from it can never skip a message.
+    """
+
+    def __init__(self, records: Iterable[Tuple[str, Iterable[str]]]) -> None:
+        """Initialize from `(history_id, message_ids)` pairs in page order."""
+        self._records: List[Tuple[str, Set[str]]] = [
+            (history_id, set(message_ids)) for history_id, message_ids in records
+        ]
+        self._index = 0
+        self._emitted: Set[str] = set()
+        self.safe_history_id: Optional[str] = None
+        self._advance()
+
+    def _advance(self) -> None:
+        while self._index < len(self._records):
+            history_id, message_ids = self._records[self._index]
+            if not message_ids <= self._emitted:
+                break
+            self.safe_history_id = max_history_id(self.safe_history_id, history_id)
+            self._index += 1
+
+    def emitted(self, message_id: str) -> Optional[str]:
+        """Mark `message_id` as emitted and return the new safe history id."""
+        self._emitted.add(message_id)
+        self._advance()
+        return self.safe_history_id
+
+    @property
+    def latest_history_id(self) -> Optional[str]:
+        """Return the largest history id on the page."""
+        return max_history_id(*(history_id for history_id, _ in self._records))
+
+
+class StateUpdate(NamedTuple):
+    """Bookmark changes to save once every record yielded before them is emitted.
+
+    Streams yield these among their records, so a bookmark can be computed ahead
+    of time (even on another thread) and still only be saved in emission order.
+    """
+
+    context: Optional[dict]
+    # Keys written to the partition's state; None removes the key
+    values: Dict[str, Any]
+    history_id: Optional[str] = None
+    last_internal_date: Optional[int] = None
+    # Write a STATE message after applying the update
+    flush: bool = False
+
+
+def apply_state_update(state: dict, update: StateUpdate, replication_key: str) -> None:
+    """Apply `update` to a partition's `state`, never moving bookmarks backwards."""
+    history_id = max_history_id(state.get("replication_key_value"), update.history_id)
+    if history_id:
+        state["replication_key"] = replication_key
+        state["replication_key_value"] = history_id
+    if update.last_internal_date:
+        state["last_internal_date"] = max(
+            int(state.get("last_internal_date") or 0), update.last_internal_date
+        )
+    for key, value in update.values.items():
+        if value is None:
+            state.pop(key, None)
+        else:
+            state[key] = value
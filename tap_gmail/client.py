@@ -1,29 +1,110 @@
 """REST client handling, including GmailStream base class."""
 
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+from urllib.parse import parse_qs, unquote, urlparse
 
 import requests
 from memoization import cached
-from singer_sdk.helpers.jsonpath import extract_jsonpath
+from requests.auth import AuthBase
+from singer_sdk.exceptions import FatalAPIError, RetriableAPIError
 from singer_sdk.streams import RESTStream
 
-from tap_gmail.auth import GmailAuthenticator
+from tap_gmail.auth import GmailAuthenticator, GmailServiceAccountAuthenticator
+from tap_gmail.batch import RATE_LIMIT_REASONS, GmailBatchClient
+from tap_gmail.checkpoint import StateUpdate, apply_state_update
+from tap_gmail.fastjson import compile_jsonpath, loads
+from tap_gmail.instrumentation import SyncMetrics, endpoint_of
+from tap_gmail.ratelimit import AdaptiveConcurrency, AdaptivePageSize, quota_cost
 
 SCHEMAS_DIR = Path(__file__).parent / Path("./schemas")
+API_URL = "https://gmail.googleapis.com"
+BATCH_SIZE = 100  # Gmail API batch size limit
+
+# The SDK exposes its conformance level enum only through this attribute
+TypeConformanceLevel = type(RESTStream.TYPE_CONFORMANCE_LEVEL)
+CONFORMANCE_LEVELS = {
+    "recursive": TypeConformanceLevel.RECURSIVE,
+    "root_only": TypeConformanceLevel.ROOT_ONLY,
+    "none": TypeConformanceLevel.NONE,
+}
+
+_MAILBOX_RE = re.compile(r"/gmail/v1/users/([^/?]+)")
+
+
+def mailbox_of(url: str) -> Optional[str]:
+    """Return the user id of the mailbox a Gmail API URL refers to."""
+    match = _MAILBOX_RE.search(url)
+    return unquote(match.group(1)) if match else None
+
+
+class HistoryExpiredError(FatalAPIError):
+    """Gmail no longer keeps history back to the requested startHistoryId."""
 
 
 class GmailStream(RESTStream):
     """Gmail stream class."""
 
-    url_base = "https://gmail.googleapis.com"
+    _schema_written = False
+    # Key of the items listed by a page, for streams whose maxResults adapts
+    page_items_key: Optional[str] = None
+
+    @property
+    def url_base(self) -> str:
+        """Return the API base URL."""
+        return self.config.get("api_url", API_URL)
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the stream."""
+        super().__init__(*args, **kwargs)
+        # Message ids are only unique within a mailbox
+        if self.config.get("user_ids") and self.primary_keys:
+            self.primary_keys = ["user_id", *self.primary_keys]
+        self.TYPE_CONFORMANCE_LEVEL = CONFORMANCE_LEVELS[
+            self.config.get("records.conformance", "recursive")
+        ]
+        # The page being requested and the one requested ahead, per partition thread
+        self._paging = threading.local()
+
+    @property
+    def requests_session(self) -> requests.Session:
+        """Return the tap's shared keep-alive session."""
+        return self._tap.requests_session
+
+    @property
+    def user_agent(self) -> str:
+        """Return the tap's User-Agent."""
+        return self._tap.user_agent
+
+    @property
+    def instrumentation(self) -> SyncMetrics:
+        """Return the tap's metrics."""
+        return self._tap.instrumentation
 
     @property
     @cached
     def authenticator(self) -> GmailAuthenticator:
-        """Return a new authenticator object."""
+        """Return the authenticator, whose token cache is shared by all streams."""
         return GmailAuthenticator.create_for_stream(self)
 
+    def authenticator_for(self, user_id: Optional[str]) -> AuthBase:
+        """Return the authenticator for requests to `user_id`'s mailbox.
+
+        With a service account every mailbox is impersonated with its own token;
+        otherwise all requests use the OAuth credentials.
+        """
+        if user_id and self.config.get("service_account.client_email"):
+            return GmailServiceAccountAuthenticator.for_user(self, user_id)
+        return self.authenticator
+
+    def user_id_for(self, context: Optional[dict]) -> str:
+        """Return the mailbox a partition or child context belongs to."""
+        return (context or {}).get("user_id") or self.config["user_id"]
+
     @property
     def http_headers(self) -> dict:
         """Return the http headers needed."""
@@ -32,13 +113,155 @@ class GmailStream(RESTStream):
             headers["User-Agent"] = self.config.get("user_agent")
         return headers
 
+    @cached
+    def batch_client_for(self, user_id: str) -> GmailBatchClient:
+        """Return a client for multipart batch requests to `user_id`'s mailbox."""
+        return GmailBatchClient(
+            session=self.requests_session,
+            url_base=self.url_base,
+            auth=self.authenticator_for(user_id),
+            headers=self.http_headers,
+            batch_size=self.config.get("fetch.batch_size", BATCH_SIZE),
+            timeout=self.timeout,
+            rate_limiter=self._tap.quota.for_user(user_id),
+            concurrency=AdaptiveConcurrency(self.config.get("fetch.max_concurrency", 4)),
+            max_in_flight_messages=self.config.get("fetch.max_in_flight_messages", 1000),
+            max_in_flight_bytes=self.config.get("fetch.max_in_flight_bytes", 64 * 1024 * 1024),
+            logger=self.logger,
+            metrics=self.instrumentation,
+        )
+
+    def build_prepared_request(self, *args, **kwargs) -> requests.PreparedRequest:
+        """Authenticate as the request's mailbox, leaving the shared session alone."""
+        request = requests.Request(*args, **kwargs)
+        request.auth = self.authenticator_for(mailbox_of(request.url))
+        return self.requests_session.prepare_request(request)
+
+    def _request(
+        self, prepared_request: requests.PreparedRequest, context: Optional[dict]
+    ) -> requests.Response:
+        """Send a request, or take the response of a page requested ahead.
+
+        Once a page arrives, the following pages are resized from it and the next
+        one is requested in the background.
+        """
+        paging = self._paging
+        prefetched = getattr(paging, "prefetched", None)
+        if prefetched is not None and prepared_request is prefetched[1]:
+            paging.prefetched = None
+            # A failure surfaces here, and is retried with a fresh request
+            response = prefetched[2].result()
+        else:
+            response = self._send(prepared_request, context)
+        if prepared_request is getattr(paging, "request", None):
+            self._observe_page(prepared_request, response)
+            self._prefetch_next_page(response, context)
+        return response
+
+    def _send(
+        self, prepared_request: requests.PreparedRequest, context: Optional[dict]
+    ) -> requests.Response:
+        """Reserve the mailbox's quota units for the request before sending it."""
+        endpoint = endpoint_of(prepared_request.path_url)
+        units = quota_cost(prepared_request.path_url)
+        self._tap.quota.for_user(mailbox_of(prepared_request.url)).acquire(units)
+        self.instrumentation.increment("quota_units_total", units, endpoint=endpoint)
+        with self.instrumentation.timer("http_request_duration_seconds", endpoint=endpoint):
+            response = super()._request(prepared_request, context)
+        self.instrumentation.increment(
+            "received_bytes_total", len(response.content), endpoint=endpoint
+        )
+        return response
+
+    def count_received(self, chunks: Iterable[bytes], endpoint: str) -> Iterator[bytes]:
+        """Pass streamed response chunks through, counting their bytes."""
+        for chunk in chunks:
+            self.instrumentation.increment("received_bytes_total", len(chunk), endpoint=endpoint)
+            yield chunk
+
+    def backoff_handler(self, details: dict) -> None:
+        """Count retries and the time spent waiting before them."""
+        super().backoff_handler(details)
+        endpoint = endpoint_of(details["args"][0].path_url)
+        self.instrumentation.increment("retries_total", endpoint=endpoint)
+        self.instrumentation.increment(
+            "backoff_seconds_total", details.get("wait", 0), endpoint=endpoint
+        )
+
+    def response_json(self, response: requests.Response) -> Any:
+        """Decode a JSON response once, counting the time spent parsing.
+
+        The result is kept on the response, so that the page token and the
+        records are read from the same parse.
+        """
+        data = getattr(response, "_parsed_json", None)
+        if data is None:
+            started = time.perf_counter()
+            data = loads(response.content)
+            self.instrumentation.increment(
+                "processing_seconds_total", time.perf_counter() - started, stage="parse"
+            )
+            response._parsed_json = data
+        return data
+
+    def _write_schema_message(self) -> None:
+        """Write the SCHEMA message once, not again before every child context."""
+        if not self._schema_written:
+            super()._write_schema_message()
+            self._schema_written = True
+
+    def _write_record_message(self, record: dict) -> None:
+        """Write a RECORD message, timing schema conformance and emission apart."""
+        started = time.perf_counter()
+        record_messages = list(self._generate_record_messages(record))
+        conformed = time.perf_counter()
+        for record_message in record_messages:
+            self._tap.write_message(record_message)
+        self.instrumentation.increment(
+            "processing_seconds_total", conformed - started, stage="validate"
+        )
+        self.instrumentation.increment(
+            "processing_seconds_total", time.perf_counter() - conformed, stage="emit"
+        )
+        self._is_state_flushed = False
+        self._tap.write_metrics(force=False)
+
+    def validate_response(self, response: requests.Response) -> None:
+        """Slow the mailbox's rate limiter down when Gmail throttles it."""
+        if response.status_code == 429 or (
+            response.status_code == 403
+            and any(reason in response.text for reason in RATE_LIMIT_REASONS)
+        ):
+            self._tap.quota.for_user(mailbox_of(response.url)).penalize()
+            raise RetriableAPIError(self.response_error_message(response), response)
+        super().validate_response(response)
+
+    def request_json(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        context: Optional[dict] = None,
+        method: str = "GET",
+        body: Optional[dict] = None,
+    ) -> dict:
+        """Call `path` outside of pagination, with the stream's quota and retries."""
+        prepared_request = self.build_prepared_request(
+            method=method,
+            url=self.url_base + path,
+            params=params or {},
+            headers=self.http_headers,
+            json=body,
+        )
+        response = self.request_decorator(self._request)(prepared_request, context)
+        return self.response_json(response)
+
     def get_next_page_token(
         self, response: requests.Response, previous_token: Optional[Any]
     ) -> Optional[Any]:
         """Return a token for identifying next page or None if no more pages."""
         if self.next_page_token_jsonpath:
-            all_matches = extract_jsonpath(
-                self.next_page_token_jsonpath, response.json()
+            all_matches = compile_jsonpath(self.next_page_token_jsonpath)(
+                self.response_json(response)
             )
             first_match = next(iter(all_matches), None)
             next_page_token = first_match
@@ -47,6 +270,100 @@ class GmailStream(RESTStream):
 
         return next_page_token
 
+    def apply_state_updates(self, items: Iterable[Any]) -> Iterator[dict]:
+        """Yield the records of `items`, applying each `StateUpdate` once reached.
+
+        The SDK has written every record yielded before an update by the time the
+        update is applied, so bookmarks never run ahead of emitted records.
+        """
+        for item in items:
+            if isinstance(item, StateUpdate):
+                apply_state_update(
+                    self.get_context_state(item.context), item, self.replication_key
+                )
+                self._is_state_flushed = False
+                if item.flush:
+                    self._write_state_message()
+            else:
+                yield item
+
+    @property
+    @cached
+    def page_size(self) -> AdaptivePageSize:
+        """Return the maxResults of the stream's next page."""
+        return AdaptivePageSize(
+            self.config.get("fetch.page_size", 100), self.config.get("fetch.max_page_size", 500)
+        )
+
+    def _observe_page(
+        self, prepared_request: requests.PreparedRequest, response: requests.Response
+    ) -> None:
+        """Resize the following pages from how long this one took and how big it was."""
+        requested = parse_qs(urlparse(prepared_request.url).query).get("maxResults")
+        if not self.page_items_key or not requested:
+            return
+        self.page_size.observe(
+            int(requested[0]),
+            len(self.response_json(response).get(self.page_items_key, [])),
+            response.elapsed.total_seconds(),
+            len(response.content),
+        )
+
+    def request_records(self, context: Optional[dict]) -> Iterable[Any]:
+        """Request every page, fetching the next one while this one is processed.
+
+        The SDK's loop only asks for page N+1 once page N is emitted; here its
+        request is sent as soon as page N arrives (see `_request`), so hydrating
+        and emitting page N overlaps with the round trip.
+        """
+        paging = self._paging
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            paging.executor = executor if self.config.get("fetch.prefetch_pages", True) else None
+            try:
+                yield from super().request_records(context)
+            finally:
+                prefetched = getattr(paging, "prefetched", None)
+                if prefetched is not None:
+                    prefetched[2].cancel()
+                paging.executor = paging.request = paging.prefetched = None
+
+    def prepare_request(
+        self, context: Optional[dict], next_page_token: Optional[Any]
+    ) -> requests.PreparedRequest:
+        """Return the request of a page, reusing it if it was prefetched."""
+        paging = self._paging
+        prefetched = getattr(paging, "prefetched", None)
+        if prefetched is not None and prefetched[0] == next_page_token:
+            prepared_request = prefetched[1]
+        else:
+            if prefetched is not None:
+                prefetched[2].cancel()
+                paging.prefetched = None
+            prepared_request = super().prepare_request(context, next_page_token)
+        paging.request = prepared_request
+        return prepared_request
+
+    def _prefetch_next_page(self, response: requests.Response, context: Optional[dict]) -> None:
+        """Start requesting the page after `response`, if the SDK will ask for it.
+
+        The SDK stops paginating at a page without records, so the request is
+        only sent ahead when this page listed items and has a next page token.
+        """
+        executor = getattr(self._paging, "executor", None)
+        if executor is None or not self.page_items_key:
+            return
+        if not self.response_json(response).get(self.page_items_key):
+            return
+        next_page_token = self.get_next_page_token(response, None)
+        if not next_page_token:
+            return
+        next_request = super().prepare_request(context, next_page_token)
+        self._paging.prefetched = (
+            next_page_token,
+            next_request,
+            executor.submit(self._send, next_request, context),
+        )
+
     def get_url_params(
         self, context: Optional[dict], next_page_token: Optional[Any]
     ) -> Dict[str, Any]:
@@ -58,18 +375,20 @@ class GmailStream(RESTStream):
 
     def parse_response(self, response: requests.Response) -> Iterable[dict]:
         """Parse the response and return an iterator of result rows."""
-        yield from extract_jsonpath(self.records_jsonpath, input=response.json())
+        yield from compile_jsonpath(self.records_jsonpath)(self.response_json(response))
 
     def get_starting_replication_key_value(self, context: Optional[dict]) -> Optional[Any]:
         """Get the starting value for the replication key from state or config."""
-        rep_key = self.get_replication_key()
-        if not rep_key:
+        if not self.replication_key:
             return None
 
-        state_value = self.get_context_state(context).get(rep_key) if self.is_state_persistent else None
+        state_value = super().get_starting_replication_key_value(context)
+        if state_value is None:
+            # Partitions synced ahead of the SDK have no starting marker yet
+            state_value = self.get_context_state(context).get("replication_key_value")
 
         # If no state exists but an initial history ID is provided in config, use that
-        if state_value is None and rep_key == "historyId" and "initial_history_id" in self.config:
+        if state_value is None and self.replication_key == "historyId" and "initial_history_id" in self.config:
             return self.config["initial_history_id"]
 
         return state_value
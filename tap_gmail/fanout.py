@@ -0,0 +1,94 @@
+"""Produce stream partitions ahead of the SDK's one-at-a-time partition loop."""
+
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple
+
+PUT_TIMEOUT = 0.5  # Seconds between checks for a stopped consumer
+
+_DONE = object()
+
+
+class _Failure(NamedTuple):
+    error: BaseException
+
+
+class PartitionPrefetcher:
+    """Run the partitions that come next in background threads.
+
+    The SDK syncs partitions one after the other. While `items(context)` yields
+    the items of the current partition, up to `max_workers - 1` following ones
+    are already being produced, each into a queue of `queue_size` items; a
+    producer that gets that far ahead of the consumer blocks until it catches up.
+    Items of a partition are always yielded in the order they were produced.
+    """
+
+    def __init__(
+        self,
+        produce: Callable[[dict], Iterable[Any]],
+        partitions: List[dict],
+        max_workers: int,
+        queue_size: int = 100,
+    ) -> None:
+        """Initialize around a `produce(context)` generator function."""
+        self.produce = produce
+        self.partitions = partitions
+        self.max_workers = max(1, max_workers)
+        self.queue_size = queue_size
+        self._queues: Dict[int, "queue.Queue[Any]"] = {}
+        self._started = 0
+        self._stopped = threading.Event()
+
+    def _start_through(self, index: int) -> None:
+        """Start producing every partition up to `index`."""
+        while self._started <= min(index, len(self.partitions) - 1):
+            items: "queue.Queue[Any]" = queue.Queue(self.queue_size)
+            self._queues[self._started] = items
+            threading.Thread(
+                target=self._run,
+                args=(self.partitions[self._started], items),
+                daemon=True,
+            ).start()
+            self._started += 1
+
+    def _put(self, items: "queue.Queue[Any]", item: Any) -> bool:
+        while not self._stopped.is_set():
+            try:
+                items.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, context: dict, items: "queue.Queue[Any]") -> None:
+        try:
+            for item in self.produce(context):
+                if not self._put(items, item):
+                    return
+        except BaseException as e:  # Re-raised in the consuming thread
+            self._put(items, _Failure(e))
+        else:
+            self._put(items, _DONE)
+
+    def items(self, context: dict) -> Iterator[Any]:
+        """Yield the items of partition `context`, then start the next one."""
+        index = self.partitions.index(context)
+        self._start_through(index + self.max_workers - 1)
+        items = self._queues.pop(index)
+        finished = False
+        try:
+            while True:
+                item = items.get()
+                if item is _DONE:
+                    finished = True
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            if not finished:
+                self.stop()
+
+    def stop(self) -> None:
+        """Make every producer give up at its next item."""
+        self._stopped.set()
@@ -0,0 +1,73 @@
+"""JSON decoding and encoding for large payloads, through orjson when installed."""
+
+import datetime
+import functools
+import json
+import re
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+
+from singer_sdk.helpers.jsonpath import extract_jsonpath
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - exercised without the optional package
+    orjson = None
+
+_SIMPLE_JSONPATH_RE = re.compile(r"^\$((?:\.[A-Za-z_][A-Za-z0-9_]*)+)(\[\*\])?$")
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Decode a JSON document."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _reject(obj: Any) -> Any:
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Encode `obj` as compact UTF-8 JSON.
+
+    Without `default`, types other than JSON's and datetimes raise a TypeError.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=default or _reject)
+    return json.dumps(
+        obj,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=default or _datetime_or_reject,
+    ).encode()
+
+
+def _datetime_or_reject(obj: Any) -> Any:
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    return _reject(obj)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_jsonpath(expression: str) -> Callable[[Any], Iterable[Any]]:
+    """Return a function extracting the matches of `expression` from a document.
+
+    Plain paths such as "$.nextPageToken" or "$.messages[*]" become direct key
+    lookups; anything else goes through the SDK's JSONPath implementation.
+    """
+    match = _SIMPLE_JSONPATH_RE.match(expression)
+    if not match:
+        return lambda document: extract_jsonpath(expression, document)
+    keys: Tuple[str, ...] = tuple(match.group(1)[1:].split("."))
+    each = bool(match.group(2))
+
+    def extract(document: Any) -> List[Any]:
+        for key in keys:
+            if not isinstance(document, dict) or key not in document:
+                return []
+            document = document[key]
+        if each:
+            return document if isinstance(document, list) else []
+        return [document]
+
+    return extract
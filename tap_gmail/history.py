@@ -0,0 +1,77 @@
+"""Collapse Gmail history records into one change per message."""
+
+from typing import Dict, List, Tuple
+
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+MESSAGE_ADDED = "messageAdded"
+MESSAGE_DELETED = "messageDeleted"
+LABELS_CHANGED = "labelsChanged"
+
+
+def summarize_history(
+    history: List[dict],
+) -> Tuple[Dict[str, dict], List[Tuple[str, List[str]]]]:
+    """Merge every change a page of history records made to each message.
+
+    Returns the per-message changes in order of first appearance, and the
+    `(history_id, message_ids)` pairs needed by `HistoryCheckpoint`. Each change
+    carries the id of the last history record that touched the message and one
+    `changeType`:
+
+    - `messageDeleted` if the message was deleted on this page,
+    - `messageAdded` if it was added (later label changes are already reflected
+      in the fetched message),
+    - `labelsChanged` otherwise, with the net added and removed label ids.
+    """
+    changes: Dict[str, dict] = {}
+    page_records: List[Tuple[str, List[str]]] = []
+
+    for history_item in history:
+        history_id = history_item.get("id")
+        record_message_ids = []
+        for history_type, key in (
+            (MESSAGE_ADDED, "messagesAdded"),
+            (MESSAGE_DELETED, "messagesDeleted"),
+            ("labelAdded", "labelsAdded"),
+            ("labelRemoved", "labelsRemoved"),
+        ):
+            for entry in history_item.get(key, []):
+                message = entry.get("message")
+                if not message:
+                    continue
+                change = changes.setdefault(
+                    message["id"],
+                    {
+                        "id": message["id"],
+                        "threadId": message.get("threadId"),
+                        "changeType": LABELS_CHANGED,
+                        "addedLabelIds": [],
+                        "removedLabelIds": [],
+                    },
+                )
+                change["historyId"] = history_id
+                if "labelIds" in message:
+                    change["labelIds"] = message["labelIds"]
+                record_message_ids.append(message["id"])
+
+                if history_type == MESSAGE_DELETED:
+                    change["changeType"] = MESSAGE_DELETED
+                    change["deleted"] = True
+                elif history_type == MESSAGE_ADDED:
+                    if change["changeType"] != MESSAGE_DELETED:
+                        change["changeType"] = MESSAGE_ADDED
+                else:
+                    added, removed = (
+                        (change["addedLabelIds"], change["removedLabelIds"])
+                        if history_type == "labelAdded"
+                        else (change["removedLabelIds"], change["addedLabelIds"])
+                    )
+                    for label_id in entry.get("labelIds", []):
+                        if label_id in removed:
+                            removed.remove(label_id)
+                        if label_id not in added:
+                            added.append(label_id)
+        page_records.append((history_id, record_message_ids))
+
+    return changes, page_records
@@ -0,0 +1,210 @@
+"""Counters and histograms describing where a sync spends its time."""
+
+import bisect
+import contextlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Histogram buckets by unit, chosen by the metric name's suffix
+BUCKETS = {
+    "seconds": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    "bytes": tuple(2 ** exponent for exponent in range(10, 27, 2)),
+    "ratio": (0.1, 0.25, 0.5, 0.75, 0.9, 1),
+}
+PREFIX = "tap_gmail_"
+# Quantiles of a histogram reported in METRIC points, besides its maximum
+QUANTILES = (0.5, 0.95, 0.99)
+
+_ENDPOINTS = [
+    (re.compile(r"/batch/"), "batch"),
+    (re.compile(r"/messages/[^/?]+/attachments/"), "messages.attachments.get"),
+    (re.compile(r"/messages/[^/?]+(\?|$)"), "messages.get"),
+    (re.compile(r"/messages(\?|$)"), "messages.list"),
+    (re.compile(r"/threads/[^/?]+(\?|$)"), "threads.get"),
+    (re.compile(r"/threads(\?|$)"), "threads.list"),
+    (re.compile(r"/history(\?|$)"), "history.list"),
+    (re.compile(r"/profile(\?|$)"), "getProfile"),
+    (re.compile(r"/watch(\?|$)"), "watch"),
+]
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def endpoint_of(url: str) -> str:
+    """Return the Gmail API method a request URL calls, e.g. "messages.list"."""
+    for pattern, name in _ENDPOINTS:
+        if pattern.search(url):
+            return name
+    return "other"
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum and maximum."""
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        """Initialize an empty histogram with the given upper bounds."""
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add an observation."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate the `q` quantile as the upper bound of its bucket."""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return 0.0
+
+
+class SyncMetrics:
+    """Thread-safe registry of the counters and histograms of one tap run.
+
+    Names follow Prometheus conventions: counters end in `_total` and
+    histograms in their unit (`_seconds`, `_bytes` or `_ratio`), which picks
+    their buckets. Timers can also open an OpenTelemetry span each.
+    """
+
+    def __init__(self, tracer=None) -> None:
+        """Initialize an empty registry, optionally tracing with `tracer`."""
+        self.tracer = tracer
+        self._counters: Dict[Key, float] = {}
+        self._histograms: Dict[Key, Histogram] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, tags: Dict[str, str]) -> Key:
+        return name, tuple(sorted((key, str(value)) for key, value in tags.items()))
+
+    def increment(self, name: str, value: float = 1, **tags: str) -> None:
+        """Add `value` to a counter."""
+        key = self._key(name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **tags: str) -> None:
+        """Add an observation to a histogram."""
+        key = self._key(name, tags)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(BUCKETS[name.rsplit("_", 1)[-1]])
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **tags: str) -> Iterator[None]:
+        """Observe how long the block takes in histogram `name`."""
+        span = (
+            self.tracer.start_as_current_span(name, attributes=tags)
+            if self.tracer
+            else contextlib.nullcontext()
+        )
+        started = time.perf_counter()
+        with span:
+            try:
+                yield
+            finally:
+                self.observe(name, time.perf_counter() - started, **tags)
+
+    def points(self) -> List[dict]:
+        """Return every metric as Singer METRIC points with numeric values.
+
+        A histogram becomes `_count` and `_sum` counters, and one point per
+        quantile tagged like a Prometheus summary (`quantile="1"` being the
+        maximum): a timer for durations, a counter otherwise.
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [
+                (
+                    key,
+                    histogram.count,
+                    histogram.sum,
+                    [(str(q), histogram.quantile(q)) for q in QUANTILES] + [("1", histogram.max)],
+                )
+                for key, histogram in self._histograms.items()
+            ]
+        points = [
+            {"type": "counter", "metric": name, "value": value, "tags": dict(tags)}
+            for (name, tags), value in counters
+        ]
+        for (name, tags), count, total, quantiles in histograms:
+            points.append({"type": "counter", "metric": f"{name}_count", "value": count, "tags": dict(tags)})
+            points.append({"type": "counter", "metric": f"{name}_sum", "value": total, "tags": dict(tags)})
+            point_type = "timer" if name.endswith("_seconds") else "counter"
+            points.extend(
+                {"type": point_type, "metric": name, "value": value, "tags": {**dict(tags), "quantile": q}}
+                for q, value in quantiles
+            )
+        return points
+
+    def log(self, logger: logging.Logger) -> None:
+        """Log every metric as a Singer METRIC message."""
+        for point in self.points():
+            logger.info("METRIC: %s", json.dumps(point, default=str))
+
+    def prometheus_text(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (histogram.bounds, list(histogram.counts), histogram.count, histogram.sum))
+                for key, histogram in self._histograms.items()
+            )
+        declared = set()
+        for (name, tags), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                declared.add(name)
+            lines.append(f"{PREFIX}{name}{_labels(tags)} {value}")
+        for (name, tags), (bounds, counts, count, total) in histograms:
+            if name not in declared:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                declared.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{PREFIX}{name}_bucket{_labels(tags, le=bound)} {cumulative}"
+                )
+            lines.append(f"{PREFIX}{name}_bucket{_labels(tags, le='+Inf')} {count}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(tags)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_labels(tags)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """Atomically replace `path` with the Prometheus text of every metric."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, partial = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        with os.fdopen(fd, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(partial, path)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(tags: Tuple[Tuple[str, str], ...], le: Optional[object] = None) -> str:
+    pairs = list(tags) + ([("le", str(le))] if le is not None else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
@@ -0,0 +1,115 @@
+"""Decoding of message bodies and headers into flat, text-only records."""
+
+import base64
+import email
+import email.policy
+from email.message import EmailMessage
+from typing import Dict, Iterator, List, Optional, Tuple
+
+BODY_TYPES = ("text/plain", "text/html")
+
+
+def b64url_decode(data: str) -> bytes:
+    """Decode base64url data, with or without padding."""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def flat_headers(headers: List[dict]) -> Dict[str, str]:
+    """Return headers as one entry per name; repeated headers are joined by newlines."""
+    flat: Dict[str, str] = {}
+    for header in headers:
+        name, value = header.get("name", ""), header.get("value", "")
+        flat[name] = f"{flat[name]}\n{value}" if name in flat else value
+    return flat
+
+
+def _charset(part: dict) -> str:
+    for header in part.get("headers", []):
+        if header.get("name", "").lower() == "content-type":
+            for param in header.get("value", "").split(";")[1:]:
+                key, _, value = param.strip().partition("=")
+                if key.lower() == "charset" and value:
+                    return value.strip('"')
+    return "utf-8"
+
+
+def _decode_text(data: bytes, charset: str) -> str:
+    try:
+        return data.decode(charset, errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
+def _iter_inline_bodies(part: dict) -> Iterator[Tuple[str, str]]:
+    """Yield the `(mimeType, text)` of inline text parts of a Gmail payload."""
+    data = part.get("body", {}).get("data")
+    if part.get("mimeType") in BODY_TYPES and data and not part.get("filename"):
+        yield part["mimeType"], _decode_text(b64url_decode(data), _charset(part))
+    for child in part.get("parts", []):
+        yield from _iter_inline_bodies(child)
+
+
+def _iter_raw_bodies(message: EmailMessage) -> Iterator[Tuple[str, str]]:
+    """Yield the `(mimeType, text)` of inline text parts of an RFC 2822 message."""
+    for part in message.walk():
+        if part.get_content_type() in BODY_TYPES and not part.get_filename():
+            payload = part.get_payload(decode=True) or b""
+            yield part.get_content_type(), _decode_text(
+                payload, part.get_content_charset() or "utf-8"
+            )
+
+
+def _truncate(text: str, max_bytes: int) -> Tuple[str, bool]:
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text, False
+    return encoded[:max_bytes].decode("utf-8", errors="ignore"), True
+
+
+def _strip_data(part: dict) -> dict:
+    """Return a message part without inline body data."""
+    stripped = dict(part)
+    if "body" in part:
+        stripped["body"] = {key: value for key, value in part["body"].items() if key != "data"}
+    if "parts" in part:
+        stripped["parts"] = [_strip_data(child) for child in part["parts"]]
+    return stripped
+
+
+def decode_message(message: dict, max_body_bytes: int) -> dict:
+    """Add `headers`, `text_body` and `html_body` to a message, dropping base64 data.
+
+    Bodies come from the payload's inline text parts, or from `raw` for
+    format=raw messages. Each body is cut to `max_body_bytes` of UTF-8, in
+    which case `body_truncated` is set.
+    """
+    decoded = dict(message)
+    raw = decoded.pop("raw", None)
+    bodies: Iterator[Tuple[str, str]] = iter(())
+    headers: Optional[Dict[str, str]] = None
+    if raw:
+        parsed = email.message_from_bytes(b64url_decode(raw), policy=email.policy.default)
+        headers = flat_headers(
+            [{"name": name, "value": str(value)} for name, value in parsed.items()]
+        )
+        bodies = _iter_raw_bodies(parsed)
+    elif "payload" in decoded:
+        payload = decoded["payload"]
+        if "headers" in payload:
+            headers = flat_headers(payload["headers"])
+        bodies = _iter_inline_bodies(payload)
+        decoded["payload"] = _strip_data(payload)
+    if headers is not None:
+        decoded["headers"] = headers
+
+    texts: Dict[str, List[str]] = {}
+    for mime_type, text in bodies:
+        texts.setdefault(mime_type, []).append(text)
+    truncated = False
+    for mime_type, key in (("text/plain", "text_body"), ("text/html", "html_body")):
+        if mime_type in texts:
+            decoded[key], cut = _truncate("\n".join(texts[mime_type]), max_body_bytes)
+            truncated = truncated or cut
+    if texts:
+        decoded["body_truncated"] = truncated
+    return decoded
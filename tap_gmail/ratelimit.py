@@ -0,0 +1,202 @@
+"""Quota-aware rate limiting for the Gmail API."""
+
+import threading
+import time
+from typing import Dict, Optional
+
+# Per-user quota is 250 units per second, see
+# https://developers.google.com/gmail/api/reference/quota
+DEFAULT_UNITS_PER_SECOND = 250
+# Per-project quota is 1,200,000 units per minute
+PROJECT_UNITS_PER_SECOND = 20_000
+QUOTA_UNITS = {
+    "messages.get": 5,
+    "messages.list": 5,
+    "history.list": 2,
+    "threads.get": 10,
+    "threads.list": 10,
+    "attachments.get": 5,
+    "getProfile": 1,
+    "watch": 100,
+}
+# Largest maxResults Gmail accepts on list and history pages
+MAX_PAGE_SIZE = 500
+
+
+def quota_cost(path: str) -> int:
+    """Return the quota units consumed by a GET on `path`."""
+    segments = path.split("?", 1)[0].rstrip("/").split("/")
+    if "attachments" in segments:
+        return QUOTA_UNITS["attachments.get"]
+    if segments[-1] == "history":
+        return QUOTA_UNITS["history.list"]
+    if segments[-1] == "profile":
+        return QUOTA_UNITS["getProfile"]
+    if segments[-1] == "watch":
+        return QUOTA_UNITS["watch"]
+    resource = "threads" if "threads" in segments else "messages"
+    method = "list" if segments[-1] == resource else "get"
+    return QUOTA_UNITS[f"{resource}.{method}"]
+
+
+class QuotaRateLimiter:
+    """Thread-safe token bucket measured in Gmail quota units.
+
+    Callers reserve units before each request and sleep off any deficit, so
+    concurrent workers are served in arrival order. `penalize` halves the fill
+    rate after a rate-limit response and `reward` slowly restores it.
+    """
+
+    def __init__(self, units_per_second: float = DEFAULT_UNITS_PER_SECOND) -> None:
+        """Initialize the limiter with a full bucket."""
+        self.max_rate = float(units_per_second)
+        self.rate = self.max_rate
+        self._tokens = self.max_rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, units: float) -> float:
+        """Reserve `units`, blocking until the bucket can afford them.
+
+        Returns the number of seconds spent waiting.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= units
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self) -> None:
+        """Halve the fill rate and drain the bucket after being throttled."""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+
+    def reward(self) -> None:
+        """Recover 5% of the configured rate after a successful request."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+class MailboxQuota:
+    """A mailbox's own token bucket, drawn on together with the project's."""
+
+    def __init__(self, user: QuotaRateLimiter, project: QuotaRateLimiter) -> None:
+        """Initialize from the mailbox and project buckets."""
+        self.user = user
+        self.project = project
+
+    @property
+    def rate(self) -> float:
+        """Return the current fill rate of the mailbox bucket."""
+        return self.user.rate
+
+    def acquire(self, units: float) -> float:
+        """Reserve `units` from the mailbox bucket, then from the project bucket."""
+        return self.user.acquire(units) + self.project.acquire(units)
+
+    def penalize(self) -> None:
+        """Slow down only the mailbox that was throttled."""
+        self.user.penalize()
+
+    def reward(self) -> None:
+        """Restore the mailbox's rate after a successful request."""
+        self.user.reward()
+
+
+class QuotaScheduler:
+    """Hand out per-mailbox rate limiters that share one project-wide budget.
+
+    Gmail enforces its quota both per user and per project, so each mailbox gets
+    its own bucket and every request also draws on a common one.
+    """
+
+    def __init__(
+        self,
+        units_per_second: float = DEFAULT_UNITS_PER_SECOND,
+        project_units_per_second: float = PROJECT_UNITS_PER_SECOND,
+    ) -> None:
+        """Initialize the scheduler with the per-mailbox and per-project rates."""
+        self.units_per_second = units_per_second
+        self.project = QuotaRateLimiter(project_units_per_second)
+        self._mailboxes: Dict[Optional[str], MailboxQuota] = {}
+        self._lock = threading.Lock()
+
+    def for_user(self, user_id: Optional[str]) -> MailboxQuota:
+        """Return the rate limiter of `user_id`'s mailbox."""
+        with self._lock:
+            if user_id not in self._mailboxes:
+                self._mailboxes[user_id] = MailboxQuota(
+                    QuotaRateLimiter(self.units_per_second), self.project
+                )
+            return self._mailboxes[user_id]
+
+
+class AdaptiveConcurrency:
+    """Concurrency limit that shrinks on throttling and grows back on success."""
+
+    def __init__(self, maximum: int, recovery_interval: int = 10) -> None:
+        """Initialize the limit at `maximum`."""
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.recovery_interval = recovery_interval
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def decrease(self) -> None:
+        """Halve the number of requests allowed in flight."""
+        with self._lock:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+    def increase(self) -> None:
+        """Allow one more request in flight after enough consecutive successes."""
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.recovery_interval and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+
+
+class AdaptivePageSize:
+    """maxResults for list and history pages, sized from the pages seen so far.
+
+    Full pages that come back quickly double the next request, up to `maximum`,
+    so fewer round trips are needed. A page slower than `target_seconds` or
+    larger than `max_bytes` halves it. Partial pages say nothing about capacity
+    and leave it alone.
+    """
+
+    def __init__(
+        self,
+        initial: int = 100,
+        maximum: int = 500,
+        minimum: int = 10,
+        target_seconds: float = 2.0,
+        max_bytes: int = 8 * 1024 * 1024,
+    ) -> None:
+        """Initialize the page size at `initial`."""
+        initial = min(initial, MAX_PAGE_SIZE)
+        self.minimum = max(1, min(minimum, initial))
+        self.maximum = min(MAX_PAGE_SIZE, max(initial, maximum))
+        self.value = initial
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def observe(self, requested: int, items: int, seconds: float, size: int) -> None:
+        """Adjust the page size after a page of `items` out of `requested`."""
+        with self._lock:
+            if seconds > self.target_seconds or size > self.max_bytes:
+                self.value = max(self.minimum, min(self.value, requested) // 2)
+            elif items >= requested and seconds < self.target_seconds / 2:
+                self.value = min(self.maximum, max(self.value, requested * 2))
@@ -1,60 +1,396 @@
 """Stream type classes for tap-gmail."""
 
+import abc
+import datetime
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, Optional, Iterable
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlencode, urlparse
+
 import requests
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from memoization import cached
 
-from singer_sdk.helpers.jsonpath import extract_jsonpath
-from tap_gmail.client import GmailStream
+from tap_gmail.attachments import (
+    DOWNLOAD_CHUNK_SIZE,
+    AttachmentStore,
+    decode_attachment,
+    iter_attachment_parts,
+    mime_type_allowed,
+)
+from tap_gmail.backfill import (
+    GMAIL_LAUNCH_DATE,
+    WindowLister,
+    plan_windows,
+    window_bounds,
+)
+from tap_gmail.checkpoint import (
+    HistoryCheckpoint,
+    StateUpdate,
+    max_history_id,
+)
+from tap_gmail.client import GmailStream, HistoryExpiredError, mailbox_of
+from tap_gmail.fanout import PartitionPrefetcher
+from tap_gmail.fastjson import compile_jsonpath
+from tap_gmail.history import (
+    HISTORY_TYPES,
+    LABELS_CHANGED,
+    MESSAGE_ADDED,
+    MESSAGE_DELETED,
+    summarize_history,
+)
+from tap_gmail.ratelimit import QUOTA_UNITS, quota_cost
 
 SCHEMAS_DIR = Path(__file__).parent / Path("./schemas")
-BATCH_SIZE = 50  # Gmail API batch size limit
+HANDOFF_SIZE = 1000  # Hydrated messages held for the child stream at most
+SEEN_MESSAGES_SIZE = 100_000  # Message ids remembered across history pages
+RECENT_IDS_SIZE = 500  # Latest added ids kept in state to diff a fallback scan against
+FALLBACK_MARGIN_SECONDS = 3600  # Overlap of a fallback scan with the last sync
+BACKFILL_CHUNK_SIZE = 500  # Messages hydrated between backfill checkpoints
+PREFETCH_QUEUE_SIZE = 100  # Items a mailbox synced ahead may buffer
+MAX_BODY_BYTES = 1024 * 1024  # Decoded text or HTML body kept per message
+DECODE_AHEAD = 100  # Messages submitted for decoding before the first is handed off
+# Fields MessageListStream needs from every hydrated message
+LIST_FIELDS = ("id", "threadId", "historyId", "internalDate")
+# Payload properties that format=metadata still returns
+METADATA_PAYLOAD_PROPERTIES = {"partId", "mimeType", "filename", "headers"}
+BODY_PROPERTIES = ("text_body", "html_body", "body_truncated")
+# Properties added by the tap, which the API does not know
+TAP_PROPERTIES = ("user_id", "headers") + BODY_PROPERTIES
+
+
+class MailboxRun:
+    """What the sync of one partition remembers from page to page."""
+
+    def __init__(self, user_id: str, context: Optional[dict], state: dict) -> None:
+        """Initialize from the saved state of the mailbox partition `context`."""
+        self.user_id = user_id
+        # The partition holding the mailbox's historyId bookmark
+        self.context = context
+        self.start_history_id: Optional[str] = None
+        self.resume_checked = False
+        # Ids already emitted as added, so later history pages never refetch them
+        self.seen_message_ids: "OrderedDict[str, None]" = OrderedDict()
+        self.recent_ids: "OrderedDict[str, None]" = OrderedDict.fromkeys(
+            state.get("recent_message_ids", [])
+        )
+        self.latest_internal_date: Optional[int] = None
+        # Messages whose decoding started before they were handed off, by id
+        self.prepared: Dict[str, Union[dict, "Future[dict]"]] = {}
+
+    def remember(self, message_id: str) -> None:
+        """Remember that `message_id` was emitted as added during this sync."""
+        self.seen_message_ids[message_id] = None
+        while len(self.seen_message_ids) > SEEN_MESSAGES_SIZE:
+            self.seen_message_ids.popitem(last=False)
+        self.recent_ids[message_id] = None
+        self.recent_ids.move_to_end(message_id)
+        while len(self.recent_ids) > RECENT_IDS_SIZE:
+            self.recent_ids.popitem(last=False)
+
+
+class HistoryFeedStream(GmailStream):
+    """A stream that follows the history feed when incremental, or lists otherwise.
+
+    Bookmarks are only advanced by the `StateUpdate`s from `_checkpoint`,
+    yielded after the records they cover. If the history has expired, the
+    records come from `_recover_expired_history` instead.
+    """
+
+    replication_key = "historyId"
+    # History records arrive in ascending order; see `_checkpoint`
+    is_sorted = True
+    check_sorted = False
+    next_page_token_jsonpath = "$.nextPageToken"
+    # Key of the items listed by a full sync's page
+    list_items_key: str
+
+    @property
+    def incremental(self) -> bool:
+        """Return True if the stream follows the history feed."""
+        return self.config.get("use_incremental", False)
+
+    @property
+    def page_items_key(self) -> str:
+        """Return the key of the items listed by a page."""
+        return "history" if self.incremental else self.list_items_key
+
+    def history_params(self, start_history_id: Optional[str]) -> Dict[str, Any]:
+        """Return the history.list parameters of a page."""
+        return {
+            "startHistoryId": start_history_id,
+            "historyTypes": self.config.get("history_types", HISTORY_TYPES),
+            "maxResults": self.page_size.value,
+        }
+
+    def validate_response(self, response: requests.Response) -> None:
+        """Tell an expired startHistoryId apart from other client errors."""
+        if (
+            self.incremental
+            and response.status_code == 404
+            and urlparse(response.url).path.endswith("/history")
+        ):
+            raise HistoryExpiredError(self.response_error_message(response))
+        super().validate_response(response)
+
+    def _feed_records(self, context: Optional[dict]) -> Iterator[Any]:
+        """Yield the records and state updates of the pages, or of a fallback scan."""
+        try:
+            yield from super().get_records(context)
+        except HistoryExpiredError as e:
+            self.logger.warning(f"History of {self.user_id_for(context)} is no longer available ({str(e)}), falling back to a {self.list_items_key} list scan")
+            yield from self._recover_expired_history(context)
+
+    @abc.abstractmethod
+    def _recover_expired_history(self, context: Optional[dict]) -> Iterator[Any]:
+        """Yield what changed since the last sync, then restart history."""
 
-class MessageListStream(GmailStream):
+    def _fallback_query(self, state: dict) -> str:
+        """Return the `after:` query of a scan replacing the expired history.
+
+        `last_internal_date` lags behind when no message was fetched for a while
+        (e.g. only message_list is selected), so the later of it and
+        `last_synced_at` bounds the scan.
+        """
+        synced = [
+            int(state[key]) for key in ("last_internal_date", "last_synced_at") if state.get(key)
+        ]
+        since = max(synced) if synced else self.config.get("messages.after_timestamp")
+        if not since:
+            raise HistoryExpiredError(
+                "History has expired and there is no previous sync time to bound "
+                "a fallback scan; set 'messages.after_timestamp' or a recent "
+                "'initial_history_id'."
+            )
+        return f"after:{int(since) // 1000 - FALLBACK_MARGIN_SECONDS}"
+
+    @property
+    @abc.abstractmethod
+    def _bookmark_context(self) -> Optional[dict]:
+        """Return the partition holding the bookmark being synced."""
+
+    def _checkpoint(
+        self,
+        history_id: Optional[str],
+        next_page_token: Optional[str] = None,
+        flush: bool = False,
+    ) -> StateUpdate:
+        """Advance the historyId bookmark and remember where listing stopped.
+
+        Only yielded once every record up to `history_id` has been yielded.
+        """
+        return StateUpdate(
+            self._bookmark_context,
+            {"next_page_token": next_page_token, "last_synced_at": int(time.time() * 1000)},
+            history_id=history_id,
+            flush=flush,
+        )
+
+    def _increment_stream_state(
+        self, latest_record: dict, *, context: Optional[dict] = None
+    ) -> None:
+        """Leave bookmarks to the `StateUpdate`s, which never run ahead of emitted records."""
+
+
+class MessageListStream(HistoryFeedStream):
     """Define custom stream."""
 
     name = "message_list"
     primary_keys = ["id"]
-    # Add replication key for incremental fetching
-    replication_key = "historyId"
     schema_filepath = SCHEMAS_DIR / "message_list.json"
     records_jsonpath = "$.messages[*]"
-    next_page_token_jsonpath = "$.nextPageToken"
+    list_items_key = "messages"
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the stream."""
+        super().__init__(*args, **kwargs)
+        # Full payloads fetched while listing, waiting to be emitted by
+        # MessagesStream, keyed by (user_id, message_id)
+        self._hydrated: "OrderedDict[Tuple[str, str], dict]" = OrderedDict()
+        self._hydrated_lock = threading.Lock()
+        # Mailboxes synced ahead buffer hydrated records as well
+        self._handoff_size = HANDOFF_SIZE + PREFETCH_QUEUE_SIZE * self.config.get(
+            "fetch.max_concurrent_mailboxes", 4
+        )
+        # The MailboxRun of the partition being produced by the current thread
+        self._local = threading.local()
+        self._windows: List[str] = []
+        self._listers: Dict[str, WindowLister] = {}
+        self._listers_lock = threading.Lock()
+        self._prefetcher: Optional[PartitionPrefetcher] = None
+        self._sync_started_at = int(time.time())
+
+    @property
+    def backfill(self) -> bool:
+        """Return True if a full sync is split into time-window partitions."""
+        return not self.incremental and self.config.get("backfill.enabled", False)
+
+    @property
+    @cached
+    def partitions(self) -> Optional[List[dict]]:
+        """Return one partition per mailbox in `user_ids`, and per backfill window.
+
+        Backfill partitions are ordered by window, oldest first, then by mailbox,
+        so that consecutive partitions belong to different mailboxes.
+        """
+        user_ids = self.config.get("user_ids")
+        if not self.backfill:
+            return [{"user_id": user_id} for user_id in user_ids] if user_ids else None
+        if self.config.get("backfill.start_date"):
+            start = datetime.date.fromisoformat(self.config["backfill.start_date"][:10])
+        elif self.config.get("messages.after_timestamp"):
+            start = datetime.datetime.fromtimestamp(
+                int(self.config["messages.after_timestamp"]) // 1000, datetime.timezone.utc
+            ).date()
+        else:
+            start = GMAIL_LAUNCH_DATE
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        self._windows = plan_windows(start, today, self.config.get("backfill.partition_days", 30))
+        if user_ids:
+            return [
+                {"user_id": user_id, "backfill_window": window}
+                for window in self._windows
+                for user_id in user_ids
+            ]
+        return [{"backfill_window": window} for window in self._windows]
 
     @property
     def path(self):
         """Set the path for the stream."""
-        # When using incremental with a historyId, we'll override this in get_url_params
-        return "/gmail/v1/users/" + self.config["user_id"] + "/messages"
+        if self.incremental:
+            return "/gmail/v1/users/{user_id}/history"
+        return "/gmail/v1/users/{user_id}/messages"
+
+    @staticmethod
+    def _mailbox_context(context: Optional[dict]) -> Optional[dict]:
+        """Return the partition holding the bookmark of `context`'s mailbox."""
+        if context and "user_id" in context:
+            return {"user_id": context["user_id"]}
+        return None
+
+    @property
+    def _run(self) -> MailboxRun:
+        return self._local.run
 
     def get_child_context(self, record: dict, context: Optional[dict]) -> dict:
         """Return a context dictionary for child streams."""
-        return {"message_id": record["id"]}
+        child_context = {"message_id": record["id"]}
+        if context and "user_id" in context:
+            child_context["user_id"] = context["user_id"]
+        return child_context
+
+    @property
+    def hydrate_children(self) -> bool:
+        """Return True if a child stream needs the full message payloads."""
+        return any(
+            child.selected or child.has_selected_descendents
+            for child in self.child_streams
+        )
+
+    @property
+    def message_params(self) -> Dict[str, Any]:
+        """Return the messages.get parameters used to hydrate listed messages."""
+        for child in self.child_streams:
+            if isinstance(child, MessagesStream) and (
+                child.selected or child.has_selected_descendents
+            ):
+                return child.message_params
+        return {"format": "minimal", "fields": ",".join(LIST_FIELDS)}
+
+    def _hand_off(self, message: dict, change: Optional[dict] = None) -> dict:
+        """Keep the full payload for MessagesStream and return the list record."""
+        run = self._run
+        if self.hydrate_children:
+            prepared = run.prepared.pop(message["id"], None)
+            if prepared is None:
+                prepared = self._tap.streams[MessagesStream.name].prepare(message)
+            with self._hydrated_lock:
+                self._hydrated[(run.user_id, message["id"])] = prepared
+                while len(self._hydrated) > self._handoff_size:
+                    self._hydrated.popitem(last=False)
+        record = {
+            "id": message["id"],
+            "threadId": message.get("threadId"),
+            "historyId": message.get("historyId"),
+        }
+        if message.get("internalDate"):
+            run.latest_internal_date = max(
+                run.latest_internal_date or 0, int(message["internalDate"])
+            )
+        # Listed, backfilled or added: a fallback scan need not fetch it again
+        run.remember(message["id"])
+        if change:
+            record["changeType"] = change["changeType"]
+        return record
+
+    def _change_record(self, change: dict) -> dict:
+        """Return the lightweight record for a change that needs no fetch."""
+        record = {
+            "id": change["id"],
+            "threadId": change["threadId"],
+            "historyId": change["historyId"],
+            "changeType": change["changeType"],
+        }
+        if change["changeType"] == MESSAGE_DELETED:
+            record["deleted"] = True
+        elif change["changeType"] == LABELS_CHANGED:
+            record["addedLabelIds"] = change["addedLabelIds"]
+            record["removedLabelIds"] = change["removedLabelIds"]
+            if "labelIds" in change:
+                record["labelIds"] = change["labelIds"]
+        else:
+            self._run.remember(change["id"])
+        return record
+
+    def generate_child_contexts(
+        self, record: dict, context: Optional[dict]
+    ) -> Iterable[Optional[dict]]:
+        """Only sync the messages stream for records whose body was fetched."""
+        if (self.user_id_for(context), record["id"]) in self._hydrated:
+            yield self.get_child_context(record, context)
+
+    def pop_hydrated(
+        self, user_id: str, message_id: str
+    ) -> Optional[Union[dict, "Future[dict]"]]:
+        """Return and forget the full payload fetched for a message, if any.
+
+        The payload may still be being decoded, see `MessagesStream.prepare`.
+        """
+        with self._hydrated_lock:
+            return self._hydrated.pop((user_id, message_id), None)
 
     def get_url_params(
         self, context: Optional[dict], next_page_token: Optional[Any]
     ) -> Dict[str, Any]:
         params = super().get_url_params(context, next_page_token)
-        params["includeSpamTrash"] = self.config["messages.include_spam_trash"]
-        if self.config.get("messages.q"):
-            params["q"] = self.config.get("messages.q")
+        run = self._run
 
         # Use incremental fetching exclusively based on history API when enabled
-        if self.config.get("use_incremental", False):
-            history_id = self.get_starting_replication_key_value(context)
-            if not history_id:
-                self.logger.error("Incremental sync is enabled but no historyId is provided. Please set 'initial_history_id' in your config.")
-            self.logger.info(f"Using incremental sync with history API. Starting from historyId: {history_id}")
-            self._path = "/gmail/v1/users/" + self.config["user_id"] + "/history"
-            params["startHistoryId"] = history_id
-            # Limit to only new messages and restrict results per page.
-            params["historyTypes"] = "messageAdded"
-            params["maxResults"] = 100
+        if self.incremental:
+            if run.start_history_id is None:
+                run.start_history_id = self.get_starting_replication_key_value(context)
+                if not run.start_history_id:
+                    self.logger.error("Incremental sync is enabled but no historyId is provided. Please set 'initial_history_id' in your config.")
+                self.logger.info(f"Using incremental sync with history API for {run.user_id}. Starting from historyId: {run.start_history_id}")
+            params.update(self.history_params(run.start_history_id))
         else:
             self.logger.info("Using standard message list endpoint (not incremental)")
-            self._path = "/gmail/v1/users/" + self.config["user_id"] + "/messages"
+            params["includeSpamTrash"] = self.config["messages.include_spam_trash"]
+            params["maxResults"] = self.page_size.value
+            if self.config.get("messages.q"):
+                params["q"] = self.config.get("messages.q")
+
+            # Continue an interrupted listing from the last fully emitted page
+            if not next_page_token and not run.resume_checked:
+                resume_token = self.get_context_state(context).get("next_page_token")
+                if resume_token:
+                    self.logger.info("Resuming message list from saved page token")
+                    params["pageToken"] = resume_token
+            run.resume_checked = True
 
             # Check if we have a timestamp filter to apply
             if self.config.get("messages.after_timestamp"):
@@ -69,119 +405,406 @@ class MessageListStream(GmailStream):
 
         return params
 
-    def _batch_get_messages(self, message_ids: list) -> list:
-        """Get messages in batch to reduce API calls."""
+    def _batch_get_messages(
+        self, message_ids: list, history_ids: Optional[Dict[str, str]] = None
+    ) -> Iterator[dict]:
+        """Stream messages from multipart batch requests as each batch arrives.
+
+        When decoding in the background, up to `DECODE_AHEAD` messages are
+        submitted for decoding before the first is yielded: the child stream
+        waits for a message's decoding as soon as it is handed off, so only
+        messages submitted earlier are decoded in parallel. Their historyId
+        is set from `history_ids` beforehand.
+        """
+        messages = self._fetch_messages(message_ids, history_ids)
+        messages_stream = self._tap.streams[MessagesStream.name]
+        if not (self.hydrate_children and messages_stream.decodes_in_background):
+            yield from messages
+            return
+
+        prepared = self._run.prepared
+        window: "deque[dict]" = deque()
+        for message in messages:
+            if history_ids and message["id"] in history_ids:
+                message["historyId"] = history_ids[message["id"]]
+            prepared[message["id"]] = messages_stream.prepare(message)
+            window.append(message)
+            if len(window) >= DECODE_AHEAD:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+
+    def _fetch_messages(
+        self, message_ids: list, history_ids: Optional[Dict[str, str]] = None
+    ) -> Iterator[dict]:
+        """Fetch messages from multipart batch requests as each batch arrives.
+
+        Nothing is materialized for the whole page: the batch client only fetches
+        ahead as far as its in-flight message and byte limits allow.
+
+        With the message cache enabled, a cached message is reused when its
+        historyId is at least the one in `history_ids`. Cached messages of
+        unknown historyId are first checked with a cheap format=minimal fetch.
+        """
         if not message_ids:
-            return []
-
-        # Create Gmail API service
-        credentials = Credentials(
-            None,
-            refresh_token=self.config["oauth_credentials"]["refresh_token"],
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=self.config["oauth_credentials"]["client_id"],
-            client_secret=self.config["oauth_credentials"]["client_secret"],
+            return
+
+        user_id = self._run.user_id
+        batch_client = self.batch_client_for(user_id)
+        cache = self._tap.message_cache
+        if cache is None:
+            yield from batch_client.get_messages(
+                user_id, message_ids, params=self.message_params
+            )
+            return
+
+        variant = cache.variant(self.message_params)
+        cached = cache.history_ids(user_id, message_ids, variant)
+        history_ids = history_ids or {}
+        current = [
+            message_id
+            for message_id in message_ids
+            if message_id in history_ids
+            and cached.get(message_id, -1) >= int(history_ids[message_id])
+        ]
+        unknown = [
+            message_id
+            for message_id in message_ids
+            if message_id in cached and message_id not in history_ids
+        ]
+        if unknown:
+            for probe in batch_client.get_messages(
+                user_id, unknown, params={"format": "minimal", "fields": "id,historyId"}
+            ):
+                if int(probe.get("historyId") or 0) == cached[probe["id"]]:
+                    current.append(probe["id"])
+
+        hits = set()
+        for message_id in current:
+            message = cache.get(user_id, message_id, variant)
+            if message is not None:
+                hits.add(message_id)
+                yield message
+        missing = [message_id for message_id in message_ids if message_id not in hits]
+        self.logger.info(f"Message cache: {len(hits)} hits, {len(missing)} to fetch")
+        for message in batch_client.get_messages(
+            user_id, missing, params=self.message_params
+        ):
+            cache.put(user_id, message, variant)
+            yield message
+
+    @property
+    def _bookmark_context(self) -> Optional[dict]:
+        return self._run.context
+
+    def _checkpoint(
+        self,
+        history_id: Optional[str],
+        next_page_token: Optional[str] = None,
+        flush: bool = False,
+    ) -> StateUpdate:
+        """Also save the latest added ids and internalDate, to bound a fallback scan."""
+        run = self._run
+        update = super()._checkpoint(history_id, next_page_token, flush)
+        if flush and run.recent_ids:
+            update.values["recent_message_ids"] = list(run.recent_ids)
+        return update._replace(last_internal_date=run.latest_internal_date)
+
+    def _start_prefetcher(self) -> PartitionPrefetcher:
+        """Start syncing the mailboxes of upcoming partitions in the background.
+
+        Every partition's state is created up front, so that the producing
+        threads only ever read the tap state.
+        """
+        for context in self.partitions:
+            self.get_context_state(context)
+            self.get_context_state(self._mailbox_context(context))
+        return PartitionPrefetcher(
+            self._mailbox_records,
+            self.partitions,
+            max_workers=self.config.get("fetch.max_concurrent_mailboxes", 4),
+            queue_size=PREFETCH_QUEUE_SIZE,
         )
-        service = build('gmail', 'v1', credentials=credentials)
-
-        # Split into batches of BATCH_SIZE
-        batches = [message_ids[i:i + BATCH_SIZE] for i in range(0, len(message_ids), BATCH_SIZE)]
-        messages = []
-
-        for batch in batches:
-            try:
-                # Use messages.batchGet for efficiency
-                batch_request = service.users().messages().batchGet(
-                    userId=self.config["user_id"],
-                    ids=batch
-                ).execute()
-                messages.extend(batch_request.get('messages', []))
-            except Exception as e:
-                self.logger.error(f"Error fetching batch of messages: {str(e)}")
-                # Fall back to individual fetches if batch fails
-                for msg_id in batch:
-                    try:
-                        msg = service.users().messages().get(
-                            userId=self.config["user_id"],
-                            id=msg_id
-                        ).execute()
-                        messages.append(msg)
-                    except Exception as e:
-                        self.logger.error(f"Error fetching message {msg_id}: {str(e)}")
-
-        return messages
-
-    def parse_response(self, response: requests.Response) -> Iterable[dict]:
-        """Parse the response and return an iterator of result rows."""
-        data = response.json()
-        self.logger.info(f"Response data type: {'history API' if 'history' in data else 'message list'}")
-
-        if "history" in data:
-            # 1. Create message-to-history mapping FIRST
-            message_history_map = {}
-            message_ids = []
-            latest_history_id = None
 
-            for history_item in data.get("history", []):
-                history_id = history_item.get("id")
-                if history_id and (latest_history_id is None or int(history_id) > int(latest_history_id)):
-                    latest_history_id = history_id
+    def get_records(self, context: Optional[dict]) -> Iterable[Dict[str, Any]]:
+        """Return records, saving each bookmark once the records it covers are out.
 
-                # Look for messages in messagesAdded
-                for msg in history_item.get("messagesAdded", []):
-                    if "message" in msg:
-                        msg_id = msg["message"]["id"]
-                        message_history_map[msg_id] = history_id
-                        message_ids.append(msg_id)
+        With several mailboxes, upcoming partitions are synced concurrently and
+        their records and bookmarks buffered until the SDK gets to them.
+        """
+        # Only a sync of every mailbox runs ahead; a mailbox synced on its own
+        # (e.g. once notified of changes) is not followed by the others
+        if context and self.config.get("user_ids") and self.context is None:
+            if self._prefetcher is None:
+                self._prefetcher = self._start_prefetcher()
+            items = self._prefetcher.items(context)
+        else:
+            items = self._mailbox_records(context)
 
-            # Update state with latest history ID if available
-            if latest_history_id:
-                self.logger.info(f"Updating state with latest historyId: {latest_history_id}")
-                self.state = {self.replication_key: latest_history_id}
+        yield from self.apply_state_updates(items)
 
-            # 2. Batch fetch ONLY after we have ALL mappings
-            if message_ids:
-                self.logger.info(f"Found {len(message_ids)} messages in history API response")
-                messages = self._batch_get_messages(message_ids)
-                # 3. Attach CORRECT history ID to EACH message
-                for msg in messages:
-                    if msg and msg.get("id") in message_history_map:
-                        msg["historyId"] = message_history_map[msg.get("id")]
-                        yield msg
+    def _mailbox_records(self, context: Optional[dict]) -> Iterator[Any]:
+        """Yield the records and state updates of one partition."""
+        user_id = self.user_id_for(context)
+        mailbox_context = self._mailbox_context(context)
+        self._local.run = MailboxRun(
+            user_id, mailbox_context, self.get_context_state(mailbox_context)
+        )
+        if context and "backfill_window" in context:
+            yield from self._backfill_window(context)
+            return
+        yield from self._feed_records(context)
+
+    def _window_context(self, window: str) -> dict:
+        """Return the partition of `window` for the current mailbox."""
+        run = self._run
+        if run.context:
+            return {"user_id": run.user_id, "backfill_window": window}
+        return {"backfill_window": window}
+
+    def _window_bounds(self, window: str) -> Tuple[int, int]:
+        """Return the part of `window` that still has to be backfilled."""
+        after, before = window_bounds(window)
+        state = self.get_context_state(self._window_context(window))
+        return after, min(before, state.get("resume_before") or before)
+
+    def _list_window_page(
+        self, user_id: str, window: Tuple[int, int], page_token: Optional[str]
+    ) -> dict:
+        """List one page of message ids within an (after, before) window."""
+        after, before = window
+        # One second of overlap so that boundary messages are never missed
+        query = f"after:{after - 1} before:{before}"
+        if self.config.get("messages.q"):
+            query = f"{self.config['messages.q']} {query}"
+        params: Dict[str, Any] = {
+            "q": query,
+            "includeSpamTrash": self.config["messages.include_spam_trash"],
+            "maxResults": 500,
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        return self.request_json(f"/gmail/v1/users/{user_id}/messages", params)
+
+    def _backfill_window(self, context: dict) -> Iterator[Any]:
+        """Hydrate one backfill partition while the next ones are being listed.
+
+        Ids are listed newest first, so after each chunk the partition's
+        `resume_before` is moved to the oldest emitted message; an interrupted
+        window restarts from there. Windows that had fully elapsed when the sync
+        started are marked complete and skipped by later runs; a window still open
+        forgets `resume_before` once listed, so later runs pick up newer mail.
+        """
+        run = self._run
+        window = context["backfill_window"]
+        last_window = window == self._windows[-1]
+        if self.get_context_state(context).get("complete"):
+            self.logger.info(f"Backfill window {window} of {run.user_id} is already complete")
+            if last_window:
+                self._release_lister(run.user_id)
+            return
+
+        with self._listers_lock:
+            lister = self._listers.get(run.user_id)
+            first_window = lister is None
+            if first_window:
+                lister = WindowLister(
+                    partial(self._list_window_page, run.user_id),
+                    max_messages=self.config.get("backfill.max_messages_per_window", 5000),
+                    max_workers=self.config.get("backfill.max_concurrent_windows", 4),
+                    logger=self.logger,
+                )
+                self._listers[run.user_id] = lister
+        # The lister outlives a window, listing the next ones ahead of time; its
+        # threads stop after the mailbox's last window, or as soon as one fails
+        done = False
+        try:
+            if first_window:
+                seed = self._seed_history_bookmark()
+                if seed:
+                    yield seed
+
+            ahead = self.config.get("backfill.max_concurrent_windows", 4)
+            position = self._windows.index(window) if window in self._windows else len(self._windows)
+            for next_window in self._windows[position + 1:position + 1 + ahead]:
+                if not self.get_context_state(self._window_context(next_window)).get("complete"):
+                    lister.prefetch(self._window_bounds(next_window))
+
+            message_ids = lister.ids(self._window_bounds(window))
+            self.logger.info(f"Backfilling {len(message_ids)} messages of {run.user_id} in window {window}")
+            for start in range(0, len(message_ids), BACKFILL_CHUNK_SIZE):
+                oldest = None
+                latest_history_id = None
+                for msg in self._batch_get_messages(message_ids[start:start + BACKFILL_CHUNK_SIZE]):
+                    if msg.get("internalDate"):
+                        oldest = min(oldest or int(msg["internalDate"]), int(msg["internalDate"]))
+                    latest_history_id = max_history_id(latest_history_id, msg.get("historyId"))
+                    yield self._hand_off(msg)
+                if oldest:
+                    yield StateUpdate(context, {"resume_before": oldest // 1000 + 1})
+                yield self._checkpoint(latest_history_id, flush=True)
+
+            if window_bounds(window)[1] <= self._sync_started_at:
+                yield StateUpdate(context, {"complete": True, "resume_before": None}, flush=True)
             else:
-                self.logger.info("No messages found in history API response")
+                # Still open: the next run lists it whole, including newer mail
+                yield StateUpdate(context, {"resume_before": None}, flush=True)
+            done = True
+        finally:
+            if last_window or not done:
+                self._release_lister(run.user_id)
+
+    def _release_lister(self, user_id: str) -> None:
+        """Stop listing backfill windows of `user_id` ahead."""
+        with self._listers_lock:
+            lister = self._listers.pop(user_id, None)
+        if lister is not None:
+            lister.shutdown()
+
+    def _seed_history_bookmark(self) -> Optional[StateUpdate]:
+        """Record the mailbox historyId before backfilling, for later incremental runs."""
+        run = self._run
+        if self.get_context_state(run.context).get("replication_key_value"):
+            return None
+        profile = self.request_json(f"/gmail/v1/users/{run.user_id}/profile")
+        self.logger.info(f"Incremental syncs of {run.user_id} will start from historyId: {profile['historyId']}")
+        return StateUpdate(run.context, {}, history_id=profile["historyId"])
+
+    def _recover_expired_history(self, context: Optional[dict]) -> Iterator[Any]:
+        """Fetch only the messages missed since the last sync and restart history.
+
+        The fresh historyId is read from users.getProfile before scanning, so
+        anything that arrives during the scan is picked up by the next run.
+        Messages listed `after:` the last synced internalDate (less a safety
+        margin) are diffed against the recently synced ids kept in state.
+        """
+        run = self._run
+        user_path = f"/gmail/v1/users/{run.user_id}"
+        state = self.get_context_state(context)
+        profile = self.request_json(user_path + "/profile", context=context)
+        query = self._fallback_query(state)
+
+        known = set(run.recent_ids)
+        missing = []
+        params: Dict[str, Any] = {
+            "q": query,
+            "includeSpamTrash": self.config["messages.include_spam_trash"],
+            "maxResults": 500,
+        }
+        while True:
+            data = self.request_json(user_path + "/messages", params, context)
+            missing.extend(
+                msg["id"] for msg in data.get("messages", []) if msg["id"] not in known
+            )
+            if not data.get("nextPageToken"):
+                break
+            params["pageToken"] = data["nextPageToken"]
+        self.logger.info(f"Fallback scan '{query}' found {len(missing)} messages not synced yet")
+
+        for msg in self._batch_get_messages(missing):
+            yield self._hand_off(msg, {"changeType": MESSAGE_ADDED})
+
+        self.logger.info(f"Restarting history from historyId: {profile['historyId']}")
+        yield self._checkpoint(profile["historyId"], flush=True)
+
+    def parse_response(self, response: requests.Response) -> Iterable[Any]:
+        """Parse the response and return an iterator of result rows.
+
+        A `StateUpdate` follows the records it covers; it also keeps the SDK
+        paginating past pages without records.
+        """
+        data = self.response_json(response)
+        run = self._run
+        self.logger.info(f"Response data type: {'history API' if self.incremental else 'message list'}")
+
+        if self.incremental and not data.get("history") and not data.get("nextPageToken"):
+            # Nothing changed: bookmark the mailbox's historyId without
+            # building any of the fetching machinery
+            self.logger.info(f"No changes in {run.user_id} since historyId {run.start_history_id}")
+            yield self._checkpoint(data.get("historyId"), flush=True)
+        elif self.incremental:
+            # 1. Collapse the page to one change per message FIRST
+            changes, page_records = summarize_history(data.get("history", []))
+            checkpoint = HistoryCheckpoint(page_records)
+            self.logger.info(f"Found {len(changes)} changed messages in history API response")
+
+            # 2. Deletions and label changes are emitted straight from the history
+            # records, as are additions when no child stream needs the bodies.
+            to_hydrate = []
+            for msg_id, change in changes.items():
+                if change["changeType"] == MESSAGE_ADDED and msg_id in run.seen_message_ids:
+                    # Already fetched earlier in this sync
+                    change["changeType"] = LABELS_CHANGED
+                if change["changeType"] == MESSAGE_ADDED and self.hydrate_children:
+                    to_hydrate.append(msg_id)
+                    continue
+                yield self._change_record(change)
+                yield self._checkpoint(checkpoint.emitted(msg_id))
+
+            # 3. Batch fetch the added messages ONCE, with the CORRECT history ID
+            hydrated = set()
+            for msg in self._batch_get_messages(
+                to_hydrate, {msg_id: changes[msg_id]["historyId"] for msg_id in to_hydrate}
+            ):
+                hydrated.add(msg["id"])
+                change = changes[msg["id"]]
+                msg["historyId"] = change["historyId"]
+                yield self._hand_off(msg, change)
+                # Applied only after the SDK has written the record
+                yield self._checkpoint(checkpoint.emitted(msg["id"]))
+
+            # Anything not fetched was deleted after the history was read (any
+            # other failure raises), so it is emitted as deleted
+            for msg_id in to_hydrate:
+                if msg_id not in hydrated:
+                    yield self._change_record({**changes[msg_id], "changeType": MESSAGE_DELETED})
+                    yield self._checkpoint(checkpoint.emitted(msg_id))
+
+            # Only history whose messages are all out is bookmarked; once the
+            # last page is done the mailbox's current historyId is safe as well.
+            safe_history_id = checkpoint.safe_history_id
+            if (
+                not data.get("nextPageToken")
+                and safe_history_id == checkpoint.latest_history_id
+            ):
+                safe_history_id = max_history_id(safe_history_id, data.get("historyId"))
+            self.logger.info(f"Updating state of {run.user_id} with latest historyId: {safe_history_id}")
+            yield self._checkpoint(safe_history_id, flush=True)
         else:
             # Regular message list endpoint
-            message_ids = [msg.get("id") for msg in extract_jsonpath(self.records_jsonpath, data)]
+            message_ids = [msg.get("id") for msg in compile_jsonpath(self.records_jsonpath)(data)]
+            # Track the latest historyId to update state
+            latest_history_id = None
             if message_ids:
                 self.logger.info(f"Found {len(message_ids)} messages in message list response")
                 messages = self._batch_get_messages(message_ids)
 
-                # Track the latest historyId to update state
-                latest_history_id = None
-
+                fetched = set()
                 for msg in messages:
                     if msg:
+                        fetched.add(msg["id"])
                         # Add historyId from response data if available
                         if "historyId" in data:
                             msg["historyId"] = data["historyId"]
 
                         # Track the largest historyId we've seen
-                        if msg.get("historyId") and (
-                            latest_history_id is None or
-                            int(msg["historyId"]) > int(latest_history_id)
-                        ):
-                            latest_history_id = msg["historyId"]
+                        latest_history_id = max_history_id(latest_history_id, msg.get("historyId"))
+
+                        yield self._hand_off(msg)
+
+                # Any other failure raises, so the page is complete without these
+                deleted = len(set(message_ids) - fetched)
+                if deleted:
+                    self.logger.info(f"{deleted} listed messages were deleted before they were fetched")
+
+            # The page is fully emitted: a restart continues from the next page
+            yield self._checkpoint(latest_history_id, data.get("nextPageToken"), flush=True)
 
-                        yield msg
 
-                # Update state with latest history ID if available
-                if latest_history_id:
-                    self.logger.info(f"Updating state with latest historyId: {latest_history_id}")
-                    self.state = {self.replication_key: latest_history_id}
 
 
 class MessagesStream(GmailStream):
+    """Full message payloads, handed off by MessageListStream when available."""
 
     name = "messages"
     replication_key = None
@@ -190,7 +813,477 @@ class MessagesStream(GmailStream):
     ignore_parent_replication_keys = True
     state_partitioning_keys = []
 
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the stream."""
+        super().__init__(*args, **kwargs)
+        # Attachment parts of the message being synced, for AttachmentsStream
+        self._attachment_parts: Dict[Tuple[str, str], List[dict]] = {}
+        self._decoder: Optional[ProcessPoolExecutor] = None
+
     @property
     def path(self):
         """Set the path for the stream."""
-        return "/gmail/v1/users/" + self.config["user_id"] + "/messages/{message_id}"
+        return "/gmail/v1/users/{user_id}/messages/{message_id}"
+
+    @property
+    def attachments_selected(self) -> bool:
+        """Return True if the attachments stream needs the message parts."""
+        return any(child.selected for child in self.child_streams)
+
+    @property
+    def decode_enabled(self) -> bool:
+        """Return True if bodies and headers are decoded into flat properties."""
+        return bool(self.config.get("decode.enabled"))
+
+    def _decoded_selected(self, names: Iterable[str]) -> bool:
+        return self.decode_enabled and any(self.mask[("properties", name)] for name in names)
+
+    @property
+    def needs_full_payload(self) -> bool:
+        """Return True if attachments or decoded bodies need every message part."""
+        return self.attachments_selected or self._decoded_selected(BODY_PROPERTIES)
+
+    @property
+    def selected_properties(self) -> list:
+        """Return the top-level API properties needed by the catalog."""
+        return [
+            name
+            for name in self.schema["properties"]
+            if name not in TAP_PROPERTIES
+            and (
+                self.mask[("properties", name)]
+                or (
+                    name == "payload"
+                    and (self.needs_full_payload or self._decoded_selected(["headers"]))
+                )
+            )
+        ]
+
+    @property
+    def selected_payload_properties(self) -> list:
+        """Return the selected properties of the top-level message part."""
+        return [
+            name
+            for name in self.schema["definitions"]["message_part"]["properties"]
+            if self.mask[("properties", "payload", "properties", name)]
+            or self.needs_full_payload
+            or (name == "headers" and self._decoded_selected(["headers"]))
+        ]
+
+    def _smallest_format(self, selected: list) -> str:
+        """Pick the cheapest Gmail message format that covers `selected`."""
+        if "payload" in selected:
+            if set(self.selected_payload_properties) <= METADATA_PAYLOAD_PROPERTIES:
+                return "metadata"
+            return "full"
+        if "raw" in selected:
+            return "raw"
+        return "minimal"
+
+    @property
+    @cached
+    def message_params(self) -> Dict[str, Any]:
+        """Return the messages.get `format` and `fields` for the selected properties.
+
+        Gmail never returns `raw` and `payload` together, so whichever the format
+        does not cover is left out of the fields mask.
+        """
+        selected = self.selected_properties
+        message_format = self.config.get("messages.format", "auto")
+        if message_format == "auto":
+            message_format = self._smallest_format(selected)
+        selected = [
+            name
+            for name in selected
+            if name != ("payload" if message_format == "raw" else "raw")
+        ]
+        if message_format == "raw" and self.attachments_selected:
+            self.logger.warning("Attachments are not synced with messages.format=raw")
+        self.logger.info(f"Fetching messages with format={message_format}")
+        params: Dict[str, Any] = {"format": message_format}
+        if message_format == "metadata" and self.config.get("messages.metadata_headers"):
+            params["metadataHeaders"] = self.config["messages.metadata_headers"]
+
+        fields = []
+        for name in dict.fromkeys(LIST_FIELDS + tuple(selected)):
+            if name == "payload":
+                payload_properties = self.selected_payload_properties
+                if len(payload_properties) < len(
+                    self.schema["definitions"]["message_part"]["properties"]
+                ):
+                    name = f"payload({','.join(payload_properties)})"
+            fields.append(name)
+        params["fields"] = ",".join(fields)
+        return params
+
+    def get_url_params(
+        self, context: Optional[dict], next_page_token: Optional[Any]
+    ) -> Dict[str, Any]:
+        """Request only the format and fields needed by the catalog."""
+        params = super().get_url_params(context, next_page_token)
+        params.update(self.message_params)
+        return params
+
+    @property
+    def decodes_in_background(self) -> bool:
+        """Return True if `prepare` submits messages to the decoding processes."""
+        return self.decode_enabled and self.config.get("decode.processes") != 0
+
+    @property
+    def decoder(self) -> Optional[ProcessPoolExecutor]:
+        """Return the pool decoding messages, or None to decode in this thread.
+
+        The worker processes are only started once a message needs decoding.
+        They are spawned rather than forked, as the fetching threads are
+        running by then.
+        """
+        if self._decoder is None and self.config.get("decode.processes") != 0:
+            self._decoder = ProcessPoolExecutor(
+                self.config.get("decode.processes") or None,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._decoder
+
+    def prepare(self, message: dict) -> Union[dict, "Future[dict]"]:
+        """Start decoding a message handed off by the parent ahead of its sync."""
+        if self.decodes_in_background:
+            from tap_gmail.mime import decode_message
+
+            return self.decoder.submit(
+                decode_message, message, self.config.get("decode.max_body_bytes", MAX_BODY_BYTES)
+            )
+        return message
+
+    def close(self) -> None:
+        """Stop the decoding processes, if any were started."""
+        if self._decoder is not None:
+            self._decoder.shutdown()
+            self._decoder = None
+
+    def get_records(self, context: Optional[dict]) -> Iterable[Dict[str, Any]]:
+        """Emit the payload the parent already fetched, or fetch it if missing."""
+        parent = self._tap.streams[self.parent_stream_type.name]
+        message = (
+            parent.pop_hydrated(self.user_id_for(context), context["message_id"])
+            if context
+            else None
+        )
+        if message is None:
+            yield from super().get_records(context)
+        elif isinstance(message, Future):
+            yield self._tag_mailbox(message.result(), context)
+        else:
+            yield self.post_process(message, context)
+
+    def post_process(self, row: dict, context: Optional[dict] = None) -> dict:
+        """Decode the message if enabled, and tag it with its mailbox."""
+        if self.decode_enabled:
+            from tap_gmail.mime import decode_message
+
+            row = decode_message(
+                row, self.config.get("decode.max_body_bytes", MAX_BODY_BYTES)
+            )
+        return self._tag_mailbox(row, context)
+
+    @staticmethod
+    def _tag_mailbox(row: dict, context: Optional[dict]) -> dict:
+        """Tag the message with its mailbox when syncing several."""
+        if context and "user_id" in context:
+            row["user_id"] = context["user_id"]
+        return row
+
+    def generate_child_contexts(
+        self, record: dict, context: Optional[dict]
+    ) -> Iterable[Optional[dict]]:
+        """Sync the attachments stream for messages that have attachments."""
+        if not self.attachments_selected or not context:
+            return
+        parts = list(iter_attachment_parts(record.get("payload") or {}))
+        if parts:
+            self._attachment_parts[(self.user_id_for(context), record["id"])] = parts
+            yield dict(context)
+
+    def pop_attachment_parts(self, user_id: str, message_id: str) -> List[dict]:
+        """Return and forget the attachment parts of a message."""
+        return self._attachment_parts.pop((user_id, message_id), [])
+
+
+class AttachmentsStream(GmailStream):
+    """Attachments of synced messages, downloaded into a content-addressed store.
+
+    Attachment data is decoded from the response as it streams in and written
+    straight to disk, so it is never held in memory as a whole.
+    """
+
+    name = "attachments"
+    primary_keys = ["message_id", "part_id"]
+    replication_key = None
+    schema_filepath = SCHEMAS_DIR / "attachments.json"
+    parent_stream_type = MessagesStream
+    state_partitioning_keys = []
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the stream."""
+        super().__init__(*args, **kwargs)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def path(self):
+        """Set the path for the stream."""
+        return "/gmail/v1/users/{user_id}/messages/{message_id}/attachments"
+
+    @property
+    @cached
+    def store(self) -> AttachmentStore:
+        """Return the local store attachments are saved to."""
+        return AttachmentStore(self.config.get("attachments.directory", "attachments"))
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Return the pool downloading attachments concurrently, started on first use."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(1, self.config.get("attachments.max_concurrency", 4))
+            )
+        return self._executor
+
+    def close(self) -> None:
+        """Stop the download threads, if any were started."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _wanted(self, part: dict) -> bool:
+        """Apply the size and MIME type filters to an attachment part."""
+        max_size = self.config.get("attachments.max_size")
+        if max_size and part["body"].get("size", 0) > max_size:
+            self.logger.info(f"Skipping attachment {part.get('filename')!r} of {part['body']['size']} bytes")
+            return False
+        return mime_type_allowed(
+            part.get("mimeType") or "", self.config.get("attachments.mime_types")
+        )
+
+    def _download(self, prepared_request: requests.PreparedRequest, context: Optional[dict]) -> tuple:
+        """Stream one attachment into the store and return its path, size and hash."""
+        endpoint = "messages.attachments.get"
+        units = quota_cost(prepared_request.path_url)
+        self._tap.quota.for_user(mailbox_of(prepared_request.url)).acquire(units)
+        self.instrumentation.increment("quota_units_total", units, endpoint=endpoint)
+        # Timed until the attachment is stored, as it is read while streaming
+        with self.instrumentation.timer("http_request_duration_seconds", endpoint=endpoint):
+            response = self.requests_session.send(
+                prepared_request, stream=True, timeout=self.timeout
+            )
+            with response:
+                self.validate_response(response)
+                chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+                return self.store.save(
+                    decode_attachment(self.count_received(chunks, endpoint))
+                )
+
+    def _fetch(self, part: dict, context: dict) -> dict:
+        """Download the attachment of `part`, retrying like any other request."""
+        user_id = self.user_id_for(context)
+        prepared_request = self.build_prepared_request(
+            method="GET",
+            url=(
+                f"{self.url_base}/gmail/v1/users/{user_id}/messages/"
+                f"{context['message_id']}/attachments/{part['body']['attachmentId']}"
+            ),
+            # Only the data, so that it can be decoded as it streams in
+            params={"fields": "data"},
+            headers=self.http_headers,
+        )
+        path, size, sha256 = self.request_decorator(self._download)(prepared_request, context)
+        record = {
+            "message_id": context["message_id"],
+            "part_id": part.get("partId"),
+            "filename": part.get("filename"),
+            "mime_type": part.get("mimeType"),
+            "size": size,
+            "sha256": sha256,
+            "path": str(path),
+        }
+        if "user_id" in context:
+            record["user_id"] = context["user_id"]
+        return record
+
+    def get_records(self, context: Optional[dict]) -> Iterable[Dict[str, Any]]:
+        """Download the message's attachments in parallel, emitting them in order."""
+        parent = self._tap.streams[self.parent_stream_type.name]
+        parts = parent.pop_attachment_parts(self.user_id_for(context), context["message_id"])
+        futures = [
+            self.executor.submit(self._fetch, part, context)
+            for part in parts
+            if self._wanted(part)
+        ]
+        for future in futures:
+            yield future.result()
+
+
+class ThreadsStream(HistoryFeedStream):
+    """Conversations with all of their messages, fetched with one threads.get each.
+
+    Full syncs page through threads.list. Incremental syncs follow the history
+    feed like MessageListStream, refetching each thread touched by a page of
+    history records once for the whole page.
+    """
+
+    name = "threads"
+    primary_keys = ["id"]
+    schema_filepath = SCHEMAS_DIR / "threads.json"
+    records_jsonpath = "$.threads[*]"
+    list_items_key = "threads"
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the stream."""
+        super().__init__(*args, **kwargs)
+        # The partition being synced; threads has no concurrent partitions
+        self._context: Optional[dict] = None
+        self._start_history_id: Optional[str] = None
+
+    @property
+    def partitions(self) -> Optional[List[dict]]:
+        """Return one partition per mailbox in `user_ids`."""
+        user_ids = self.config.get("user_ids")
+        return [{"user_id": user_id} for user_id in user_ids] if user_ids else None
+
+    @property
+    def path(self):
+        """Set the path for the stream."""
+        if self.incremental:
+            return "/gmail/v1/users/{user_id}/history"
+        return "/gmail/v1/users/{user_id}/threads"
+
+    @property
+    @cached
+    def thread_params(self) -> Dict[str, Any]:
+        """Return the threads.get parameters, following messages.format.
+
+        threads.get has no raw format, so raw and auto fetch full messages.
+        """
+        message_format = self.config.get("messages.format", "auto")
+        if message_format not in ("minimal", "metadata", "full"):
+            message_format = "full"
+        params: Dict[str, Any] = {"format": message_format}
+        if message_format == "metadata" and self.config.get("messages.metadata_headers"):
+            params["metadataHeaders"] = self.config["messages.metadata_headers"]
+        return params
+
+    def get_url_params(
+        self, context: Optional[dict], next_page_token: Optional[Any]
+    ) -> Dict[str, Any]:
+        """Page through the history feed, or through threads.list."""
+        params = super().get_url_params(context, next_page_token)
+        if self.incremental:
+            if self._start_history_id is None:
+                self._start_history_id = self.get_starting_replication_key_value(context)
+                self.logger.info(f"Syncing threads of {self.user_id_for(context)} from historyId: {self._start_history_id}")
+            params.update(self.history_params(self._start_history_id))
+        else:
+            params["includeSpamTrash"] = self.config["messages.include_spam_trash"]
+            query = self.config.get("messages.q")
+            if self.config.get("messages.after_timestamp"):
+                timestamp_query = f"after:{int(self.config['messages.after_timestamp']) // 1000}"
+                query = f"{query} {timestamp_query}" if query else timestamp_query
+            if query:
+                params["q"] = query
+            params["maxResults"] = self.page_size.value
+        return params
+
+    def get_records(self, context: Optional[dict]) -> Iterable[Dict[str, Any]]:
+        """Return thread records, saving each bookmark once its page is out."""
+        self._context = context
+        self._start_history_id = None
+        yield from self.apply_state_updates(self._partition_records(context))
+
+    def _partition_records(self, context: Optional[dict]) -> Iterator[Any]:
+        """Yield the threads and state updates of one mailbox."""
+        if self.incremental:
+            yield from self._feed_records(context)
+            return
+        # Threads changed while listing are picked up by the next incremental run
+        user_id = self.user_id_for(context)
+        profile = self.request_json(f"/gmail/v1/users/{user_id}/profile", context=context)
+        yield from super().get_records(context)
+        yield self._checkpoint(profile["historyId"], flush=True)
+
+    def _recover_expired_history(self, context: Optional[dict]) -> Iterator[Any]:
+        """Refetch the threads active since the last sync and restart history."""
+        user_path = f"/gmail/v1/users/{self.user_id_for(context)}"
+        profile = self.request_json(user_path + "/profile", context=context)
+        params: Dict[str, Any] = {
+            "q": self._fallback_query(self.get_context_state(context)),
+            "includeSpamTrash": self.config["messages.include_spam_trash"],
+            "maxResults": 500,
+        }
+        while True:
+            data = self.request_json(user_path + "/threads", params, context)
+            for thread in self._get_threads([thread["id"] for thread in data.get("threads", [])]):
+                yield self.post_process(thread, context)
+            if not data.get("nextPageToken"):
+                break
+            params["pageToken"] = data["nextPageToken"]
+        yield self._checkpoint(profile["historyId"], flush=True)
+
+    @property
+    def _bookmark_context(self) -> Optional[dict]:
+        return self._context
+
+    def _get_threads(self, thread_ids: List[str]) -> Iterator[dict]:
+        """Fetch threads with batched threads.get calls."""
+        if not thread_ids:
+            return
+        user_id = self.user_id_for(self._context)
+        query = urlencode(self.thread_params, doseq=True)
+        paths = {
+            thread_id: f"/gmail/v1/users/{user_id}/threads/{thread_id}?{query}"
+            for thread_id in thread_ids
+        }
+        # Threads whose every message was deleted are gone
+        for _, thread in self.batch_client_for(user_id).get(
+            paths, units=QUOTA_UNITS["threads.get"], missing_ok=True
+        ):
+            yield thread
+
+    def parse_response(self, response: requests.Response) -> Iterable[Any]:
+        """Fetch the threads of a page, followed by the page's bookmark.
+
+        A history page names each changed message with its thread, so a thread
+        touched by many records of the page is still fetched once.
+        """
+        data = self.response_json(response)
+        if self.incremental:
+            changes, _ = summarize_history(data.get("history", []))
+            thread_ids = list(
+                dict.fromkeys(
+                    change["threadId"] for change in changes.values() if change.get("threadId")
+                )
+            )
+            latest_history_id = max_history_id(
+                *(record.get("id") for record in data.get("history", []))
+            )
+            if not data.get("nextPageToken"):
+                latest_history_id = max_history_id(latest_history_id, data.get("historyId"))
+            self.logger.info(f"{len(changes)} changed messages touch {len(thread_ids)} threads")
+        else:
+            thread_ids = [thread["id"] for thread in compile_jsonpath(self.records_jsonpath)(data)]
+            latest_history_id = None
+        yield from self._get_threads(thread_ids)
+        if latest_history_id or self.incremental:
+            yield self._checkpoint(latest_history_id, flush=True)
+
+    def post_process(self, row: Any, context: Optional[dict] = None) -> Any:
+        """Decode the thread's messages if enabled, and tag it with its mailbox."""
+        if isinstance(row, StateUpdate):
+            return row
+        if self.config.get("decode.enabled"):
+            from tap_gmail.mime import decode_message
+
+            max_body_bytes = self.config.get("decode.max_body_bytes", MAX_BODY_BYTES)
+            row["messages"] = [
+                decode_message(message, max_body_bytes) for message in row.get("messages", [])
+            ]
+        if context and "user_id" in context:
+            row["user_id"] = context["user_id"]
+        return row
@@ -1,13 +1,48 @@
 """Gmail tap class."""
 
-from typing import List
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 
+import requests
+from memoization import cached
+from requests.adapters import HTTPAdapter
 from singer_sdk import Stream, Tap
 from singer_sdk import typing as th  # JSON schema typing helpers
+from singer_sdk.exceptions import ConfigValidationError
+from singer_sdk.metrics import get_metrics_logger
 
-from tap_gmail.streams import GmailStream, MessageListStream, MessagesStream
+from tap_gmail.checkpoint import max_history_id
+from tap_gmail.fastjson import dumps
+from tap_gmail.history import HISTORY_TYPES
+from tap_gmail.instrumentation import SyncMetrics
+from tap_gmail.ratelimit import (
+    DEFAULT_UNITS_PER_SECOND,
+    MAX_PAGE_SIZE,
+    PROJECT_UNITS_PER_SECOND,
+    QuotaScheduler,
+)
+from tap_gmail.streams import (
+    AttachmentsStream,
+    GmailStream,
+    MessageListStream,
+    MessagesStream,
+    ThreadsStream,
+)
+from tap_gmail.watch import (
+    PUBSUB_URL,
+    RENEW_MARGIN_SECONDS,
+    NotificationFile,
+    PubSubSubscription,
+    collect_changes,
+)
 
-STREAM_TYPES = [MessageListStream, MessagesStream]
+if TYPE_CHECKING:
+    # singer-sdk 0.40 has no public export of Message; only needed for typing
+    from singer_sdk._singerlib import Message
+
+    from tap_gmail.cache import MessageCache
+
+STREAM_TYPES = [MessageListStream, MessagesStream, AttachmentsStream, ThreadsStream]
 
 
 class TapGmail(Tap):
@@ -35,7 +70,41 @@ class TapGmail(Tap):
             th.StringType,
             description="Only return messages matching the specified query. Supports the same query format as the Gmail search box. For example, \"from:someuser@example.com rfc822msgid:<somemsgid@example.com> is:unread\". Parameter cannot be used when accessing the api using the gmail.metadata scope. https://developers.google.com/gmail/api/reference/rest/v1/users.messages/list#query-parameters",
         ),
+        th.Property(
+            "messages.format",
+            th.StringType,
+            description="Gmail message format to request: minimal, metadata, full or raw. The default, auto, picks the smallest format that covers the properties selected in the catalog.",
+            default="auto",
+            allowed_values=["auto", "minimal", "metadata", "full", "raw"],
+        ),
+        th.Property(
+            "messages.metadata_headers",
+            th.ArrayType(th.StringType),
+            description="Headers to return when messages are fetched with format=metadata, e.g. [\"From\", \"Subject\"]. All headers are returned when unset.",
+        ),
         th.Property("user_id", th.StringType, description="Your Gmail User ID"),
+        th.Property(
+            "api_url",
+            th.StringType,
+            description="Base URL of the Gmail API, e.g. to go through a proxy or to test against a local stand-in",
+            default="https://gmail.googleapis.com",
+        ),
+        th.Property(
+            "user_ids",
+            th.ArrayType(th.StringType),
+            description="Mailboxes to sync from one process instead of user_id. Each mailbox is a separate partition with its own history bookmark, and several are synced concurrently.",
+        ),
+        th.Property(
+            "service_account.client_email",
+            th.StringType,
+            description="Client email of a service account with domain-wide delegation, used to impersonate each mailbox in user_ids instead of the OAuth credentials. Requires singer-sdk[jwt].",
+        ),
+        th.Property(
+            "service_account.private_key",
+            th.StringType,
+            description="PEM private key of the service account",
+            secret=True,
+        ),
         th.Property(
             "messages.include_spam_trash",
             th.BooleanType,
@@ -49,14 +118,450 @@ class TapGmail(Tap):
             description="Enable incremental fetching using Gmail history API",
             default=True,
         ),
+        th.Property(
+            "history_types",
+            th.ArrayType(th.StringType),
+            description="History change types to sync incrementally: messageAdded, messageDeleted, labelAdded and labelRemoved. Deletions are emitted as tombstones and label changes as deltas, neither refetches the message.",
+            default=HISTORY_TYPES,
+        ),
         th.Property(
             "initial_history_id",
             th.StringType,
             description="Initial history ID to start fetching from if no state exists",
             required=False,
         ),
+        th.Property(
+            "backfill.enabled",
+            th.BooleanType,
+            description="When not syncing incrementally, split the mailbox into time windows that are synced as separate partitions, listed in parallel and resumable on their own",
+            default=False,
+        ),
+        th.Property(
+            "backfill.start_date",
+            th.DateType,
+            description="First day to backfill. Defaults to messages.after_timestamp, or to Gmail's launch date.",
+        ),
+        th.Property(
+            "backfill.partition_days",
+            th.IntegerType,
+            description="Length in days of each backfill time window",
+            default=30,
+        ),
+        th.Property(
+            "backfill.max_messages_per_window",
+            th.IntegerType,
+            description="Windows estimated to hold more messages than this are split in half and listed in parallel",
+            default=5000,
+        ),
+        th.Property(
+            "backfill.max_concurrent_windows",
+            th.IntegerType,
+            description="Number of backfill windows listed ahead of the one being hydrated",
+            default=4,
+        ),
+        th.Property(
+            "attachments.directory",
+            th.StringType,
+            description="Directory attachments are saved to, one file per distinct content named by its SHA-256",
+            default="attachments",
+        ),
+        th.Property(
+            "attachments.max_size",
+            th.IntegerType,
+            description="Skip attachments larger than this many bytes",
+        ),
+        th.Property(
+            "attachments.mime_types",
+            th.ArrayType(th.StringType),
+            description="Only download attachments whose MIME type matches one of these patterns, e.g. [\"application/pdf\", \"image/*\"]",
+        ),
+        th.Property(
+            "attachments.max_concurrency",
+            th.IntegerType,
+            description="Number of attachments downloaded in parallel",
+            default=4,
+        ),
+        th.Property(
+            "cache.path",
+            th.StringType,
+            description="Path of a SQLite file caching hydrated messages between runs. Messages whose historyId has not changed are then not downloaded again. Disabled when unset.",
+        ),
+        th.Property(
+            "cache.max_bytes",
+            th.IntegerType,
+            description="Maximum size of the compressed messages kept in the cache; the oldest are evicted first",
+            default=1024 * 1024 * 1024,
+        ),
+        th.Property(
+            "cache.max_age_days",
+            th.NumberType,
+            description="Cached messages older than this many days are evicted",
+            default=30,
+        ),
+        th.Property(
+            "fetch.batch_size",
+            th.IntegerType,
+            description="Number of messages.get sub-requests packed into each batch HTTP call (max 100)",
+            default=100,
+        ),
+        th.Property(
+            "fetch.pool_size",
+            th.IntegerType,
+            description="Maximum number of keep-alive connections kept open to the Gmail API",
+            default=10,
+        ),
+        th.Property(
+            "fetch.max_concurrency",
+            th.IntegerType,
+            description="Maximum number of batch requests fetching messages in parallel. Shrinks automatically when Gmail rate limits the tap.",
+            default=4,
+        ),
+        th.Property(
+            "fetch.quota_units_per_second",
+            th.NumberType,
+            description="Gmail quota units the tap may consume per second and per mailbox (messages.get costs 5 units). https://developers.google.com/gmail/api/reference/quota",
+            default=DEFAULT_UNITS_PER_SECOND,
+        ),
+        th.Property(
+            "fetch.project_quota_units_per_second",
+            th.NumberType,
+            description="Gmail quota units the tap may consume per second across all mailboxes",
+            default=PROJECT_UNITS_PER_SECOND,
+        ),
+        th.Property(
+            "fetch.max_concurrent_mailboxes",
+            th.IntegerType,
+            description="Number of mailboxes from user_ids synced at the same time",
+            default=4,
+        ),
+        th.Property(
+            "fetch.max_in_flight_messages",
+            th.IntegerType,
+            description="Maximum number of fetched messages buffered ahead of the downstream target",
+            default=1000,
+        ),
+        th.Property(
+            "fetch.max_in_flight_bytes",
+            th.IntegerType,
+            description="Maximum size in bytes of fetched message bodies buffered ahead of the downstream target",
+            default=64 * 1024 * 1024,
+        ),
+        th.Property(
+            "fetch.page_size",
+            th.IntegerType(minimum=1, maximum=MAX_PAGE_SIZE),
+            description="maxResults of the first messages.list, threads.list or history.list page. Later pages grow while full pages come back quickly, and shrink when they are slow or large.",
+            default=100,
+        ),
+        th.Property(
+            "fetch.max_page_size",
+            th.IntegerType(minimum=1, maximum=MAX_PAGE_SIZE),
+            description="Largest maxResults that list and history pages grow to. Gmail allows up to 500.",
+            default=500,
+        ),
+        th.Property(
+            "fetch.prefetch_pages",
+            th.BooleanType,
+            description="Request the next list or history page while the current one is being fetched and emitted",
+            default=True,
+        ),
+        th.Property(
+            "decode.enabled",
+            th.BooleanType,
+            description="Decode messages into flat headers, text_body and html_body properties, dropping the base64 body data from the payload",
+            default=False,
+        ),
+        th.Property(
+            "decode.max_body_bytes",
+            th.IntegerType,
+            description="Size in UTF-8 bytes that each decoded body is cut to",
+            default=1024 * 1024,
+        ),
+        th.Property(
+            "decode.processes",
+            th.IntegerType,
+            description="Worker processes decoding messages ahead of their sync. Defaults to the number of CPUs; 0 decodes in the tap's main thread instead.",
+        ),
+        th.Property(
+            "records.conformance",
+            th.StringType,
+            description="How deeply records are conformed to the stream schema before they are written. Gmail responses already hold JSON types, so root_only or none save the CPU time of walking every message part when the catalog's schema matches the API.",
+            default="recursive",
+            allowed_values=["recursive", "root_only", "none"],
+        ),
+        th.Property(
+            "watch.enabled",
+            th.BooleanType,
+            description="Keep running after the sync and pull history again whenever Gmail notifies a change, instead of polling on a schedule. Requires use_incremental, and watch.subscription or watch.notifications_path.",
+            default=False,
+        ),
+        th.Property(
+            "watch.topic",
+            th.StringType,
+            description="Pub/Sub topic for users.watch to publish mailbox changes to, e.g. projects/my-project/topics/gmail. The watch is registered for every mailbox and renewed before it expires. Leave unset if it is registered elsewhere.",
+        ),
+        th.Property(
+            "watch.label_ids",
+            th.ArrayType(th.StringType),
+            description="Only notify changes to messages with one of these labels, e.g. [\"INBOX\"]",
+        ),
+        th.Property(
+            "watch.subscription",
+            th.StringType,
+            description="Pub/Sub subscription of watch.topic to pull notifications from, e.g. projects/my-project/subscriptions/tap-gmail. The credentials also need the Pub/Sub scope.",
+        ),
+        th.Property(
+            "watch.pubsub_url",
+            th.StringType,
+            description="Base URL of the Pub/Sub API",
+            default=PUBSUB_URL,
+        ),
+        th.Property(
+            "watch.notifications_path",
+            th.StringType,
+            description="JSON-lines file of notifications to read instead of a Pub/Sub subscription, each line like {\"emailAddress\": ..., \"historyId\": ...}, e.g. as appended by a push endpoint",
+        ),
+        th.Property(
+            "watch.debounce_seconds",
+            th.NumberType,
+            description="Quiet time after a notification before history is pulled, so that a burst of changes is synced at once",
+            default=2,
+        ),
+        th.Property(
+            "watch.max_delay_seconds",
+            th.NumberType,
+            description="Longest a steady stream of notifications can hold back a pull",
+            default=30,
+        ),
+        th.Property(
+            "watch.max_runtime_seconds",
+            th.NumberType,
+            description="Stop watching after this many seconds. Runs until stopped when unset.",
+        ),
+        th.Property(
+            "metrics.interval",
+            th.NumberType,
+            description="Seconds between METRIC messages summarizing request latency, quota, retries, bytes received and time spent parsing, validating and emitting records. They are also written when the sync ends.",
+            default=60,
+        ),
+        th.Property(
+            "metrics.prometheus_path",
+            th.StringType,
+            description="File rewritten with the same metrics in the Prometheus text format, e.g. for the node_exporter textfile collector",
+        ),
+        th.Property(
+            "metrics.opentelemetry",
+            th.BooleanType,
+            description="Also record requests and processing stages as OpenTelemetry spans. Requires opentelemetry-api and a configured tracer provider.",
+            default=False,
+        ),
     ).to_dict()
 
+    _metrics_written_at = 0.0
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the tap."""
+        # Expiry, in epoch seconds, of each mailbox's users.watch
+        self._watch_expirations: Dict[str, float] = {}
+        super().__init__(*args, **kwargs)
+
+    @property
+    @cached
+    def requests_session(self) -> requests.Session:
+        """Return the pooled keep-alive session shared by every stream."""
+        pool_size = self.config.get("fetch.pool_size", 10)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    @cached
+    def user_agent(self) -> str:
+        """Return the User-Agent of the tap's requests.
+
+        Looking up the installed version scans package metadata, so it is done
+        once rather than by every stream.
+        """
+        return self.config.get("user_agent", f"{self.name}/{self.plugin_version}")
+
+    @property
+    @cached
+    def quota(self) -> QuotaScheduler:
+        """Return the per-mailbox and per-project quota shared by every stream."""
+        return QuotaScheduler(
+            self.config.get("fetch.quota_units_per_second", DEFAULT_UNITS_PER_SECOND),
+            self.config.get(
+                "fetch.project_quota_units_per_second", PROJECT_UNITS_PER_SECOND
+            ),
+        )
+
+    @property
+    @cached
+    def message_cache(self) -> Optional["MessageCache"]:
+        """Return the persistent message cache, if one is configured."""
+        if not self.config.get("cache.path"):
+            return None
+        from tap_gmail.cache import MessageCache
+
+        return MessageCache(
+            self.config["cache.path"],
+            max_bytes=self.config.get("cache.max_bytes", 1024 * 1024 * 1024),
+            max_age_seconds=self.config.get("cache.max_age_days", 30) * 86400,
+        )
+
+    @property
+    @cached
+    def instrumentation(self) -> SyncMetrics:
+        """Return the metrics shared by every stream."""
+        tracer = None
+        if self.config.get("metrics.opentelemetry"):
+            try:
+                from opentelemetry import trace
+            except ImportError as error:
+                raise ConfigValidationError(
+                    "metrics.opentelemetry requires the opentelemetry extra "
+                    "(pip install 'tap-gmail[opentelemetry]')"
+                ) from error
+
+            tracer = trace.get_tracer(self.name)
+        return SyncMetrics(tracer)
+
+    def write_metrics(self, force: bool = True) -> None:
+        """Write the metrics, unless not forced and written recently."""
+        now = time.monotonic()
+        if not force and now - self._metrics_written_at < self.config.get("metrics.interval", 60):
+            return
+        self._metrics_written_at = now
+        self.instrumentation.log(get_metrics_logger())
+        if self.config.get("metrics.prometheus_path"):
+            self.instrumentation.write_prometheus(self.config["metrics.prometheus_path"])
+
+    def serialize_message(self, message: "Message") -> str:
+        """Serialize a Singer message, through orjson when it is installed."""
+        try:
+            return dumps(message.to_dict()).decode()
+        except TypeError:
+            # e.g. Decimals, which the SDK writes as exact numbers
+            return super().serialize_message(message)
+
+    def sync_all(self) -> None:
+        """Sync all streams, follow their changes when watching, then write the final metrics."""
+        self._metrics_written_at = time.monotonic()
+        watching = self.config.get("watch.enabled")
+        if watching and not self.config.get("use_incremental"):
+            raise ConfigValidationError("watch.enabled requires use_incremental")
+        if watching and not (
+            self.config.get("watch.subscription") or self.config.get("watch.notifications_path")
+        ):
+            raise ConfigValidationError(
+                "watch.enabled requires watch.subscription or watch.notifications_path"
+            )
+        try:
+            # Registered first, so nothing that changes during the sync goes unnotified
+            if watching and self.config.get("watch.topic"):
+                self._register_watches()
+            super().sync_all()
+            if watching:
+                self.follow_changes()
+        finally:
+            self.streams[MessagesStream.name].close()
+            self.streams[AttachmentsStream.name].close()
+            cache = self.message_cache
+            if cache is not None:
+                cache.close()
+            self.write_metrics()
+
+    @property
+    def mailboxes(self) -> List[str]:
+        """Return the user ids of the synced mailboxes."""
+        return self.config.get("user_ids") or [self.config["user_id"]]
+
+    def _register_watches(self) -> None:
+        """Register or renew users.watch for mailboxes whose watch expires soon."""
+        stream = self.streams[MessageListStream.name]
+        body: Dict[str, Any] = {"topicName": self.config["watch.topic"]}
+        if self.config.get("watch.label_ids"):
+            body["labelIds"] = self.config["watch.label_ids"]
+            body["labelFilterBehavior"] = "include"
+        for user_id in self.mailboxes:
+            if self._watch_expirations.get(user_id, 0) - RENEW_MARGIN_SECONDS > time.time():
+                continue
+            response = stream.request_json(
+                f"/gmail/v1/users/{user_id}/watch", method="POST", body=body
+            )
+            self._watch_expirations[user_id] = int(response["expiration"]) / 1000
+            self.logger.info(f"Watching {user_id} from historyId {response['historyId']}")
+
+    def _notification_source(self) -> Union[PubSubSubscription, NotificationFile]:
+        """Return where change notifications are read from."""
+        if self.config.get("watch.subscription"):
+            stream = self.streams[MessageListStream.name]
+            return PubSubSubscription(
+                self.requests_session,
+                self.config["watch.subscription"],
+                stream.authenticator_for((self.config.get("user_ids") or [None])[0]),
+                url_base=self.config.get("watch.pubsub_url", PUBSUB_URL),
+            )
+        return NotificationFile(self.config["watch.notifications_path"])
+
+    def _changed_mailboxes(self, changes: Dict[str, str]) -> Dict[str, str]:
+        """Map the email addresses of notifications to the mailboxes they concern."""
+        if not self.config.get("user_ids"):
+            return {self.config["user_id"]: max_history_id(*changes.values())}
+        by_address = {user_id.lower(): user_id for user_id in self.config["user_ids"]}
+        return {
+            by_address[address.lower()]: history_id
+            for address, history_id in changes.items()
+            if address.lower() in by_address
+        }
+
+    def follow_changes(self) -> None:
+        """Sync mailboxes again as Gmail notifies changes to them.
+
+        Notifications are debounced, so a burst of new mail becomes one history
+        pull from each stream's bookmark, and mailboxes whose bookmark is already
+        past the notified historyId are not pulled at all. Records and STATE are
+        written as each pull goes, until `watch.max_runtime_seconds` passes.
+        """
+        streams = [
+            stream
+            for stream in self.streams.values()
+            if isinstance(stream, (MessageListStream, ThreadsStream))
+            and (stream.selected or stream.has_selected_descendents)
+        ]
+        if not streams:
+            return
+        source = self._notification_source()
+        deadline = None
+        if self.config.get("watch.max_runtime_seconds"):
+            deadline = time.monotonic() + self.config["watch.max_runtime_seconds"]
+        self.logger.info("Waiting for change notifications")
+        while deadline is None or time.monotonic() < deadline:
+            until = deadline
+            if self.config.get("watch.topic"):
+                self._register_watches()
+                renew_at = time.monotonic() + (
+                    min(self._watch_expirations.values()) - RENEW_MARGIN_SECONDS - time.time()
+                )
+                until = renew_at if deadline is None else min(deadline, renew_at)
+            changes = collect_changes(
+                source,
+                self.config.get("watch.debounce_seconds", 2),
+                self.config.get("watch.max_delay_seconds", 30),
+                until,
+            )
+            for user_id, history_id in self._changed_mailboxes(changes).items():
+                context = {"user_id": user_id} if self.config.get("user_ids") else None
+                for stream in streams:
+                    bookmark = stream.get_context_state(context).get("replication_key_value")
+                    if max_history_id(bookmark, history_id) == bookmark:
+                        self.instrumentation.increment("watch_pulls_skipped_total")
+                        continue
+                    self.instrumentation.increment("watch_pulls_total")
+                    stream.sync(context)
+            self.write_metrics(force=False)
+
     def discover_streams(self) -> List[Stream]:
         """Return a list of discovered streams."""
         return [stream_class(tap=self) for stream_class in STREAM_TYPES]
@@ -0,0 +1,42 @@
+"""Shared fixtures for tests that sync against the local Gmail stand-in."""
+
+from typing import Dict, Union
+
+import pytest
+
+from tap_gmail.auth import GmailAuthenticator
+from tap_gmail.tests.fake_gmail import FakeGmailServer, FakeMailbox
+
+
+@pytest.fixture
+def gmail_auth(monkeypatch):
+    """Skip the OAuth token exchange."""
+    monkeypatch.setattr(GmailAuthenticator, "is_token_valid", lambda self: True)
+    monkeypatch.setattr(GmailAuthenticator, "access_token", "fake", raising=False)
+
+
+@pytest.fixture
+def make_gmail(gmail_auth):
+    """Start fake Gmail servers, returning each with a tap config pointing at it."""
+    servers = []
+
+    def make(mailbox: Union[FakeMailbox, Dict[str, FakeMailbox]], **options):
+        """Serve one mailbox as "me", or several keyed by user id (as `user_ids`)."""
+        mailboxes = mailbox if isinstance(mailbox, dict) else {"me": mailbox}
+        server = FakeGmailServer(mailboxes, **options).start()
+        servers.append(server)
+        config = {
+            "api_url": server.url,
+            # Measure the tap, not the client-side quota
+            "fetch.quota_units_per_second": 1e9,
+            "fetch.project_quota_units_per_second": 1e9,
+        }
+        if isinstance(mailbox, dict):
+            config["user_ids"] = list(mailboxes)
+        else:
+            config["user_id"] = "me"
+        return server, config
+
+    yield make
+    for server in servers:
+        server.stop()
@@ -0,0 +1,646 @@
+"""A local stand-in for the Gmail API serving synthetic mailboxes, and test helpers."""
+
+import base64
+import io
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Collection, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+BASE_INTERNAL_DATE = 1_700_000_000_000  # Messages arrive one minute apart from here
+START_HISTORY_ID = 1000
+MINIMAL_FIELDS = (
+    "id",
+    "threadId",
+    "labelIds",
+    "snippet",
+    "historyId",
+    "internalDate",
+    "sizeEstimate",
+)
+MESSAGE_FIELDS = set(MINIMAL_FIELDS) | {"payload", "raw"}
+# Modules only needed once messages are decoded or cached
+LAZY_MODULES = ("tap_gmail.mime", "tap_gmail.cache", "email.policy", "sqlite3")
+
+
+def b64url(data: bytes) -> str:
+    """Encode `data` as unpadded base64url, like Gmail does."""
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def apply_fields(resource: dict, fields: Optional[str]) -> dict:
+    """Apply a partial-response mask such as "id,payload(headers)"."""
+    if not fields:
+        return resource
+    selected: Dict[str, Optional[List[str]]] = {}
+    for name in _split_fields(fields):
+        if "(" in name:
+            name, inner = name.split("(", 1)
+            selected[name] = _split_fields(inner[:-1])
+        else:
+            selected[name] = None
+    result = {}
+    for name, inner in selected.items():
+        if name in resource:
+            value = resource[name]
+            if inner is not None and isinstance(value, dict):
+                value = {key: value[key] for key in inner if key in value}
+            result[name] = value
+    return result
+
+
+def _split_fields(fields: str) -> List[str]:
+    names, depth, current = [], 0, ""
+    for char in fields:
+        if char == "," and depth == 0:
+            names.append(current)
+            current = ""
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    names.append(current)
+    return [name.strip() for name in names if name.strip()]
+
+
+class FakeMailbox:
+    """A synthetic mailbox with a history feed.
+
+    Message `n` (oldest first) has id `f"{n:016x}"`, arrives at
+    `BASE_INTERNAL_DATE + n` minutes and is added by history record
+    `START_HISTORY_ID + n + 1`. Messages added once the mailbox exists arrive no
+    earlier than now, as new mail does. Every `attachment_every`-th message
+    carries an attachment of `attachment_bytes`.
+    """
+
+    def __init__(
+        self,
+        size: int = 1000,
+        body_bytes: int = 2000,
+        attachment_every: int = 0,
+        attachment_bytes: int = 50_000,
+        seed: int = 0,
+    ) -> None:
+        """Generate `size` messages."""
+        self.body_bytes = body_bytes
+        self.attachment_every = attachment_every
+        self.attachment_bytes = attachment_bytes
+        self.random = random.Random(seed)
+        self.messages: "OrderedDict[str, dict]" = OrderedDict()
+        self.attachments: Dict[str, bytes] = {}
+        self.history: List[dict] = []
+        self.history_id = START_HISTORY_ID
+        # History older than this has expired
+        self.min_history_id = START_HISTORY_ID
+        # Messages ever added; deleted ones keep their index
+        self._added = 0
+        self._created = False
+        self._lock = threading.Lock()
+        self.add_messages(size)
+        self._created = True
+
+    def _next_history_id(self) -> str:
+        self.history_id += 1
+        return str(self.history_id)
+
+    def _make_message(self, index: int, history_id: str) -> dict:
+        message_id = f"{index:016x}"
+        text = b64url(self.random.randbytes(self.body_bytes * 3 // 4))
+        parts = [
+            {
+                "partId": "0",
+                "mimeType": "text/plain",
+                "filename": "",
+                "headers": [{"name": "Content-Type", "value": "text/plain"}],
+                "body": {"size": len(text), "data": b64url(text.encode())},
+            }
+        ]
+        if self.attachment_every and index % self.attachment_every == 0:
+            attachment_id = f"att-{message_id}"
+            self.attachments[attachment_id] = self.random.randbytes(self.attachment_bytes)
+            parts.append(
+                {
+                    "partId": "1",
+                    "mimeType": "application/pdf",
+                    "filename": f"{message_id}.pdf",
+                    "headers": [],
+                    "body": {"size": self.attachment_bytes, "attachmentId": attachment_id},
+                }
+            )
+        internal_date = BASE_INTERNAL_DATE + index * 60_000
+        if self._created:
+            internal_date = max(internal_date, int(time.time() * 1000))
+        return {
+            "id": message_id,
+            "threadId": f"{index // 3:016x}",
+            "labelIds": ["INBOX", "UNREAD"],
+            "snippet": text[:100],
+            "historyId": history_id,
+            "internalDate": str(internal_date),
+            "sizeEstimate": self.body_bytes + (self.attachment_bytes if len(parts) > 1 else 0),
+            "payload": {
+                "partId": "",
+                "mimeType": "multipart/mixed",
+                "filename": "",
+                "headers": [
+                    {"name": "From", "value": f"sender{index % 50}@example.com"},
+                    {"name": "To", "value": "me@example.com"},
+                    {"name": "Subject", "value": f"Message {index}"},
+                    {"name": "Date", "value": time.strftime(
+                        "%a, %d %b %Y %H:%M:%S +0000", time.gmtime(internal_date / 1000)
+                    )},
+                ],
+                "body": {"size": 0},
+                "parts": parts,
+            },
+        }
+
+    def add_messages(self, count: int) -> List[str]:
+        """Deliver `count` new messages and return their ids."""
+        with self._lock:
+            ids = []
+            for _ in range(count):
+                history_id = self._next_history_id()
+                message = self._make_message(self._added, history_id)
+                self._added += 1
+                self.messages[message["id"]] = message
+                self.history.append(
+                    {
+                        "id": history_id,
+                        "messages": [{"id": message["id"], "threadId": message["threadId"]}],
+                        "messagesAdded": [
+                            {
+                                "message": {
+                                    "id": message["id"],
+                                    "threadId": message["threadId"],
+                                    "labelIds": message["labelIds"],
+                                }
+                            }
+                        ],
+                    }
+                )
+                ids.append(message["id"])
+            return ids
+
+    def add_label(self, message_ids: List[str], label_id: str) -> None:
+        """Add `label_id` to messages, recording it in history."""
+        self._change_label(message_ids, label_id, "labelsAdded")
+
+    def remove_label(self, message_ids: List[str], label_id: str) -> None:
+        """Remove `label_id` from messages, recording it in history."""
+        self._change_label(message_ids, label_id, "labelsRemoved")
+
+    def _change_label(self, message_ids: List[str], label_id: str, key: str) -> None:
+        with self._lock:
+            history_id = self._next_history_id()
+            entries = []
+            for message_id in message_ids:
+                message = self.messages[message_id]
+                others = [label for label in message["labelIds"] if label != label_id]
+                message["labelIds"] = others + [label_id] if key == "labelsAdded" else others
+                message["historyId"] = history_id
+                entries.append(
+                    {
+                        "message": {
+                            "id": message_id,
+                            "threadId": message["threadId"],
+                            "labelIds": message["labelIds"],
+                        },
+                        "labelIds": [label_id],
+                    }
+                )
+            self.history.append({"id": history_id, key: entries})
+
+    def delete(self, message_ids: List[str]) -> None:
+        """Delete messages, recording it in history."""
+        with self._lock:
+            history_id = self._next_history_id()
+            entries = []
+            for message_id in message_ids:
+                message = self.messages.pop(message_id)
+                entries.append({"message": {"id": message_id, "threadId": message["threadId"]}})
+            self.history.append({"id": history_id, "messagesDeleted": entries})
+
+    def expire_history(self) -> None:
+        """Make every history id handed out so far unusable."""
+        self.min_history_id = self.history_id + 1
+
+    def render(self, message: dict, params: Dict[str, List[str]]) -> dict:
+        """Return a message in the requested format and fields."""
+        message_format = params.get("format", ["full"])[0]
+        rendered = {name: message[name] for name in MINIMAL_FIELDS}
+        if message_format == "full":
+            rendered["payload"] = message["payload"]
+        elif message_format == "metadata":
+            wanted = {name.lower() for name in params.get("metadataHeaders", [])}
+            payload = message["payload"]
+            rendered["payload"] = {
+                "partId": payload["partId"],
+                "mimeType": payload["mimeType"],
+                "filename": payload["filename"],
+                "headers": [
+                    header
+                    for header in payload["headers"]
+                    if not wanted or header["name"].lower() in wanted
+                ],
+            }
+        elif message_format == "raw":
+            rendered["raw"] = b64url(json.dumps(message["payload"]).encode())
+        return apply_fields(rendered, params.get("fields", [None])[0])
+
+
+class FakeGmailServer:
+    """Serve `FakeMailbox`es on localhost with Gmail's REST and batch endpoints.
+
+    `latency` seconds are added to every HTTP request, and every
+    `throttle_every`-th request or batch sub-request is rejected with a 429, as is
+    every messages.get for an id in `throttle_ids`.
+    `stats` counts calls by API method. It also stands in for the Pub/Sub
+    subscription that users.watch notifications are pulled from, see `publish`.
+    """
+
+    def __init__(
+        self,
+        mailboxes: Dict[str, FakeMailbox],
+        latency: float = 0.0,
+        throttle_every: int = 0,
+        throttle_ids: Collection[str] = (),
+    ) -> None:
+        """Initialize the server, which listens once started."""
+        self.mailboxes = mailboxes
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.throttle_ids = set(throttle_ids)
+        self.stats: Counter = Counter()
+        self._calls = 0
+        self._lock = threading.Lock()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        # Pub/Sub messages not pulled yet, and the topic each mailbox is watched on
+        self.notifications: List[dict] = []
+        self.watches: Dict[str, str] = {}
+
+    @property
+    def url(self) -> str:
+        """Return the base URL to use as the tap's `api_url`."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeGmailServer":
+        """Start serving in a background thread."""
+        gmail = self
+
+        class Handler(_Handler):
+            server_gmail = gmail
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving."""
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def __enter__(self) -> "FakeGmailServer":
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def _throttled(self) -> bool:
+        with self._lock:
+            self._calls += 1
+            return bool(self.throttle_every) and self._calls % self.throttle_every == 0
+
+    def _rate_limited(self) -> Tuple[int, Any]:
+        self.stats["throttled"] += 1
+        return 429, {
+            "error": {
+                "code": 429,
+                "errors": [{"reason": "rateLimitExceeded"}],
+                "message": "Rate limit exceeded",
+            }
+        }
+
+    def handle_get(self, url: str) -> Tuple[int, Any]:
+        """Answer a GET, from HTTP or from within a batch."""
+        parsed = urlparse(url)
+        params = parse_qs(parsed.query)
+        segments = parsed.path.strip("/").split("/")
+        if segments[:3] != ["gmail", "v1", "users"] or len(segments) < 5:
+            return 404, {"error": {"code": 404, "message": "Not found"}}
+        mailbox = self.mailboxes.get(segments[3])
+        if mailbox is None:
+            return 404, {"error": {"code": 404, "message": "Unknown user"}}
+        if self._throttled():
+            return self._rate_limited()
+        resource = segments[4:]
+        if resource == ["profile"]:
+            self.stats["getProfile"] += 1
+            return 200, {
+                "emailAddress": segments[3],
+                "messagesTotal": len(mailbox.messages),
+                "historyId": str(mailbox.history_id),
+            }
+        if resource == ["history"]:
+            self.stats["history.list"] += 1
+            return self._history(mailbox, params)
+        if resource == ["messages"]:
+            self.stats["messages.list"] += 1
+            return self._list(mailbox, params)
+        if resource[0] == "messages" and len(resource) == 2:
+            self.stats["messages.get"] += 1
+            if resource[1] in self.throttle_ids:
+                return self._rate_limited()
+            message = mailbox.messages.get(resource[1])
+            if message is None:
+                return 404, {"error": {"code": 404, "message": "Not found"}}
+            fields = params.get("fields", [""])[0]
+            unknown = {name.split("(")[0] for name in _split_fields(fields)} - MESSAGE_FIELDS
+            if unknown:
+                return 400, {"error": {"code": 400, "message": f"Invalid field selection {unknown}"}}
+            return 200, mailbox.render(message, params)
+        if resource == ["threads"]:
+            self.stats["threads.list"] += 1
+            return self._list(mailbox, params, threads=True)
+        if resource[0] == "threads" and len(resource) == 2:
+            self.stats["threads.get"] += 1
+            messages = [
+                message
+                for message in mailbox.messages.values()
+                if message["threadId"] == resource[1]
+            ]
+            if not messages:
+                return 404, {"error": {"code": 404, "message": "Not found"}}
+            return 200, {
+                "id": resource[1],
+                "historyId": max((message["historyId"] for message in messages), key=int),
+                "messages": [mailbox.render(message, params) for message in messages],
+            }
+        if resource[0] == "messages" and resource[2:3] == ["attachments"]:
+            self.stats["attachments.get"] += 1
+            data = mailbox.attachments.get(resource[3])
+            if data is None:
+                return 404, {"error": {"code": 404, "message": "Not found"}}
+            return 200, apply_fields(
+                {"size": len(data), "data": b64url(data)}, params.get("fields", [None])[0]
+            )
+        return 404, {"error": {"code": 404, "message": "Not found"}}
+
+    @staticmethod
+    def _history(mailbox: FakeMailbox, params: Dict[str, List[str]]) -> Tuple[int, Any]:
+        start = int(params["startHistoryId"][0])
+        if start < mailbox.min_history_id:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        types = set(params.get("historyTypes", []))
+        keys = {
+            "messageAdded": "messagesAdded",
+            "messageDeleted": "messagesDeleted",
+            "labelAdded": "labelsAdded",
+            "labelRemoved": "labelsRemoved",
+        }
+        wanted = {keys[name] for name in types} if types else set(keys.values())
+        records = [
+            record
+            for record in mailbox.history
+            if int(record["id"]) > start and wanted & set(record)
+        ]
+        offset = int(params.get("pageToken", ["0"])[0])
+        size = min(int(params.get("maxResults", ["100"])[0]), 500)
+        body: Dict[str, Any] = {
+            "history": records[offset:offset + size],
+            "historyId": str(mailbox.history_id),
+        }
+        if offset + size < len(records):
+            body["nextPageToken"] = str(offset + size)
+        return 200, body
+
+    @staticmethod
+    def _list(
+        mailbox: FakeMailbox, params: Dict[str, List[str]], threads: bool = False
+    ) -> Tuple[int, Any]:
+        after, before = 0, float("inf")
+        for term in params.get("q", [""])[0].split():
+            if term.startswith("after:"):
+                after = int(term[6:]) * 1000
+            elif term.startswith("before:"):
+                before = int(term[7:]) * 1000
+        matches = [
+            message
+            for message in reversed(mailbox.messages.values())
+            if after < int(message["internalDate"]) < before
+        ]
+        if threads:
+            items = [
+                {"id": thread_id}
+                for thread_id in dict.fromkeys(message["threadId"] for message in matches)
+            ]
+        else:
+            items = [
+                {"id": message["id"], "threadId": message["threadId"]}
+                for message in matches
+            ]
+        offset = int(params.get("pageToken", ["0"])[0])
+        size = min(int(params.get("maxResults", ["100"])[0]), 500)
+        body: Dict[str, Any] = {
+            "threads" if threads else "messages": items[offset:offset + size],
+            "resultSizeEstimate": len(items),
+        }
+        if offset + size < len(items):
+            body["nextPageToken"] = str(offset + size)
+        return 200, body
+
+    def publish(self, user_id: str) -> None:
+        """Notify the subscription that `user_id`'s mailbox changed, like Gmail does."""
+        data = json.dumps(
+            {"emailAddress": user_id, "historyId": self.mailboxes[user_id].history_id}
+        )
+        with self._lock:
+            self.notifications.append(
+                {
+                    "ackId": str(len(self.notifications)),
+                    "message": {"data": base64.b64encode(data.encode()).decode()},
+                }
+            )
+
+    def handle_post(self, path: str, body: dict) -> Tuple[int, Any]:
+        """Answer users.watch and Pub/Sub pull and acknowledge calls."""
+        if path.endswith(":pull"):
+            self.stats["pubsub.pull"] += 1
+            with self._lock:
+                received, self.notifications = self.notifications, []
+            return 200, {"receivedMessages": received} if received else {}
+        if path.endswith(":acknowledge"):
+            self.stats["pubsub.acknowledge"] += 1
+            return 200, {}
+        segments = urlparse(path).path.strip("/").split("/")
+        if segments[:3] == ["gmail", "v1", "users"] and segments[4:] == ["watch"]:
+            self.stats["watch"] += 1
+            mailbox = self.mailboxes[segments[3]]
+            self.watches[segments[3]] = body["topicName"]
+            return 200, {
+                "historyId": str(mailbox.history_id),
+                "expiration": str(int(time.time() * 1000) + 7 * 86400 * 1000),
+            }
+        return 404, {"error": {"code": 404, "message": "Not found"}}
+
+    def handle_batch(self, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        """Answer a multipart/mixed batch of GETs."""
+        self.stats["batch"] += 1
+        boundary = content_type.split("boundary=", 1)[1].strip('"')
+        out = io.StringIO()
+        for part in body.decode().split(f"--{boundary}")[1:]:
+            if part.startswith("--"):
+                break
+            content_id = part.split("Content-ID: <", 1)[1].split(">", 1)[0]
+            path = part.split("GET ", 1)[1].split()[0]
+            status, payload = self.handle_get(path)
+            out.write(
+                f"--batch_response\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        out.write("--batch_response--\r\n")
+        return "multipart/mixed; boundary=batch_response", out.getvalue().encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_gmail: FakeGmailServer
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _reply(self, status: int, body: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        gmail = self.server_gmail
+        time.sleep(gmail.latency)
+        status, payload = gmail.handle_get(self.path)
+        self._reply(status, json.dumps(payload).encode())
+
+    def do_POST(self) -> None:
+        gmail = self.server_gmail
+        time.sleep(gmail.latency)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/token"):
+            gmail.stats["token"] += 1
+            self._reply(200, json.dumps({"access_token": "fake", "expires_in": 3600}).encode())
+            return
+        if not self.path.startswith("/batch/"):
+            status, payload = gmail.handle_post(self.path, json.loads(body or b"{}"))
+            self._reply(status, json.dumps(payload).encode())
+            return
+        content_type, response = gmail.handle_batch(self.headers["Content-Type"], body)
+        self._reply(200, response, content_type)
+
+
+class SyncResult(NamedTuple):
+    """Singer messages written by a sync and how long it took."""
+
+    messages: List[dict]
+    seconds: float
+    first_record_seconds: Optional[float]
+
+    def records(self, stream: str) -> List[dict]:
+        """Return the records of `stream`."""
+        return [
+            message["record"]
+            for message in self.messages
+            if message["type"] == "RECORD" and message["stream"] == stream
+        ]
+
+    @property
+    def state(self) -> dict:
+        """Return the last state written."""
+        return [message for message in self.messages if message["type"] == "STATE"][-1]["value"]
+
+
+class SyncFailed(Exception):
+    """A sync raised; `result` holds what it wrote before failing."""
+
+    def __init__(self, result: SyncResult) -> None:
+        super().__init__(f"Sync failed after {len(result.messages)} messages")
+        self.result = result
+
+
+class _Capture(io.TextIOBase):
+    """Collect Singer messages and note when the first record was written."""
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.lines: List[str] = []
+        self.first_record_seconds: Optional[float] = None
+
+    def write(self, text: str) -> int:
+        if self.first_record_seconds is None and '"type":"RECORD"' in text.replace(" ", ""):
+            self.first_record_seconds = time.perf_counter() - self.started
+        self.lines.append(text)
+        return len(text)
+
+
+def run_sync(
+    tap_class: Any,
+    config: dict,
+    selected: Tuple[str, ...] = ("message_list", "messages"),
+    state: Optional[dict] = None,
+) -> SyncResult:
+    """Sync the selected streams, capturing everything written to stdout.
+
+    Raises `SyncFailed`, chained to the original error, if the sync does.
+    """
+    tap = tap_class(config=config, state=state, parse_env_config=False)
+    for name, stream in tap.streams.items():
+        stream.selected = name in selected
+    started = time.perf_counter()
+    capture = _Capture(started)
+    stdout, sys.stdout = sys.stdout, capture
+    error: Optional[Exception] = None
+    try:
+        tap.sync_all()
+    except Exception as exception:
+        error = exception
+    finally:
+        sys.stdout = stdout
+    seconds = time.perf_counter() - started
+    messages = [json.loads(line) for line in "".join(capture.lines).splitlines() if line]
+    result = SyncResult(messages, seconds, capture.first_record_seconds)
+    if error is not None:
+        raise SyncFailed(result) from error
+    return result
+
+
+def import_tap() -> dict:
+    """Import the tap in a fresh interpreter, returning its import times in seconds."""
+    script = (
+        "import sys, tap_gmail.tap; "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in completed.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative) / 1e6
+    times["loaded_lazy_modules"] = completed.stdout.strip()
+    return times
@@ -0,0 +1,87 @@
+"""Tests for streaming attachment downloads."""
+
+import base64
+import hashlib
+import json
+import os
+
+from tap_gmail.attachments import (
+    AttachmentStore,
+    decode_attachment,
+    iter_attachment_parts,
+    mime_type_allowed,
+)
+from tap_gmail.tap import TapGmail
+from tap_gmail.tests.fake_gmail import FakeMailbox, run_sync
+
+SELECTED = ("message_list", "messages", "attachments")
+
+
+def chunked(data: bytes, size: int):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def test_decode_attachment_across_any_chunk_boundaries():
+    content = os.urandom(1001)
+    response = json.dumps(
+        {"data": base64.urlsafe_b64encode(content).decode().rstrip("=")}, indent=2
+    ).encode()
+    for size in (1, 3, 7, 64, len(response)):
+        assert b"".join(decode_attachment(chunked(response, size))) == content
+
+
+def test_store_keeps_one_file_per_content(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    first = store.save([b"hello ", b"world"])
+    second = store.save([b"hello world"])
+    assert first == second
+    path, size, sha256 = first
+    assert size == 11
+    assert sha256 == hashlib.sha256(b"hello world").hexdigest()
+    assert path.read_bytes() == b"hello world"
+    assert [p.name for p in tmp_path.rglob("*") if p.is_file()] == [sha256]
+
+
+def test_attachment_parts_and_mime_filter():
+    payload = {
+        "parts": [
+            {"partId": "0", "body": {"data": "aGk"}},
+            {
+                "partId": "1",
+                "parts": [{"partId": "1.1", "mimeType": "image/png", "body": {"attachmentId": "x"}}],
+            },
+        ]
+    }
+    assert [part["partId"] for part in iter_attachment_parts(payload)] == ["1.1"]
+    assert mime_type_allowed("image/png", ["application/pdf", "image/*"])
+    assert not mime_type_allowed("text/plain", ["image/*"])
+    assert mime_type_allowed("text/plain", None)
+
+
+def test_sync_downloads_attachments_matching_filters(make_gmail, tmp_path):
+    mailbox = FakeMailbox(size=10, attachment_every=3, attachment_bytes=5000)
+    server, config = make_gmail(mailbox)
+    config = {**config, "use_incremental": False, "attachments.directory": str(tmp_path)}
+
+    result = run_sync(TapGmail, config, selected=SELECTED)
+
+    records = result.records("attachments")
+    assert [record["message_id"] for record in records] == [
+        f"{index:016x}" for index in (9, 6, 3, 0)
+    ]
+    for record in records:
+        content = mailbox.attachments[f"att-{record['message_id']}"]
+        assert record["size"] == 5000
+        assert record["sha256"] == hashlib.sha256(content).hexdigest()
+        with open(record["path"], "rb") as file:
+            assert file.read() == content
+
+    server.stats.clear()
+    too_large = run_sync(TapGmail, {**config, "attachments.max_size": 4999}, selected=SELECTED)
+    other_type = run_sync(TapGmail, {**config, "attachments.mime_types": ["image/*"]}, selected=SELECTED)
+    assert too_large.records("attachments") == other_type.records("attachments") == []
+    assert server.stats["attachments.get"] == 0
+    wanted_type = run_sync(
+        TapGmail, {**config, "attachments.mime_types": ["application/*"]}, selected=SELECTED
+    )
+    assert len(wanted_type.records("attachments")) == 4
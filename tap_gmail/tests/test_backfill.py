@@ -0,0 +1,95 @@
+"""Tests for time-window backfill partitioning."""
+
+import datetime
+
+from tap_gmail.backfill import WindowLister, plan_windows, window_bounds
+from tap_gmail.tap import TapGmail
+from tap_gmail.tests.fake_gmail import FakeMailbox, run_sync
+
+# One message every 10 minutes over two days, newest first like messages.list
+TIMESTAMPS = list(range(1700000000 + 2 * 86400, 1700000000, -600))
+
+
+def list_page(window, page_token):
+    after, before = window
+    ids = [str(ts) for ts in TIMESTAMPS if after <= ts < before]
+    start = int(page_token or 0)
+    data = {"messages": [{"id": i} for i in ids[start:start + 50]]}
+    data["resultSizeEstimate"] = len(ids)
+    if start + 50 < len(ids):
+        data["nextPageToken"] = str(start + 50)
+    return data
+
+
+def test_plan_windows_is_aligned_on_start():
+    windows = plan_windows(datetime.date(2024, 1, 1), datetime.date(2024, 1, 20), 7)
+    assert windows == [
+        "2024-01-01/2024-01-08",
+        "2024-01-08/2024-01-15",
+        "2024-01-15/2024-01-22",
+    ]
+    assert window_bounds(windows[0]) == (1704067200, 1704672000)
+
+
+def test_window_lister_splits_dense_windows():
+    lister = WindowLister(list_page, max_messages=40, max_workers=4)
+    window = (1700000000, 1700000000 + 2 * 86400 + 1)
+
+    ids = lister.ids(window)
+
+    assert ids == [str(ts) for ts in TIMESTAMPS]
+
+
+def test_backfill_sync_then_incremental(make_gmail):
+    mailbox = FakeMailbox(size=600)  # Ten hours of mail on 2023-11-14 and 15
+    server, config = make_gmail(mailbox)
+    config = {
+        **config,
+        "backfill.enabled": True,
+        "backfill.start_date": "2023-11-01",
+        "backfill.partition_days": 365,
+        "backfill.max_messages_per_window": 100,
+    }
+
+    backfill = run_sync(TapGmail, {**config, "use_incremental": False})
+
+    ids = [record["id"] for record in backfill.records("messages")]
+    assert sorted(ids) == sorted(mailbox.messages)
+    assert len(ids) == len(set(ids))
+    # The first window was split until each part held at most 100 messages
+    assert server.stats["messages.list"] > 6
+    partitions = backfill.state["bookmarks"]["message_list"]["partitions"]
+    windows = [partition for partition in partitions if "backfill_window" in partition["context"]]
+    # Every window but the one still running up to today is done
+    assert len(windows) > 1
+    assert all(partition.get("complete") for partition in windows[:-1])
+    assert not windows[-1].get("complete")
+
+    added = mailbox.add_messages(3)
+    server.stats.clear()
+    incremental = run_sync(TapGmail, {**config, "use_incremental": True}, state=backfill.state)
+
+    assert [record["id"] for record in incremental.records("messages")] == added
+    assert server.stats["history.list"] == 1
+    assert server.stats["messages.list"] == 0
+
+
+def test_open_backfill_window_picks_up_new_mail(make_gmail):
+    mailbox = FakeMailbox(size=200)
+    server, config = make_gmail(mailbox)
+    # One window, from before the first message to after today
+    config = {
+        **config,
+        "use_incremental": False,
+        "backfill.enabled": True,
+        "backfill.start_date": "2023-11-01",
+        "backfill.partition_days": 36500,
+    }
+    first = run_sync(TapGmail, config)
+    added = mailbox.add_messages(3)
+
+    second = run_sync(TapGmail, config, state=first.state)
+
+    assert set(added) <= {record["id"] for record in second.records("messages")}
+    window = second.state["bookmarks"]["message_list"]["partitions"][0]
+    assert "resume_before" not in window and not window.get("complete")
@@ -0,0 +1,146 @@
+"""Tests for the multipart batch client."""
+
+import json
+
+import requests
+
+from tap_gmail.batch import GmailBatchClient, build_batch_body, parse_batch_response
+from tap_gmail.ratelimit import AdaptiveConcurrency, AdaptivePageSize, QuotaRateLimiter
+
+RESPONSE = (
+    b"--batch_abc\r\n"
+    b"Content-Type: application/http\r\n"
+    b"Content-ID: <response-item-0>\r\n"
+    b"\r\n"
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: application/json; charset=UTF-8\r\n"
+    b"\r\n"
+    b'{"id": "m1", "threadId": "t1"}\r\n'
+    b"--batch_abc\r\n"
+    b"Content-Type: application/http\r\n"
+    b"Content-ID: <response-item-1>\r\n"
+    b"\r\n"
+    b"HTTP/1.1 429 Too Many Requests\r\n"
+    b"Content-Type: application/json; charset=UTF-8\r\n"
+    b"\r\n"
+    b'{"error": {"code": 429}}\r\n'
+    b"--batch_abc\r\n"
+    b"Content-Type: application/http\r\n"
+    b"Content-ID: <response-item-2>\r\n"
+    b"\r\n"
+    b"HTTP/1.1 403 Forbidden\r\n"
+    b"\r\n"
+    b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}\r\n'
+    b"--batch_abc--\r\n"
+)
+
+
+def test_build_batch_body():
+    body = build_batch_body({"item-0": "/gmail/v1/users/me/messages/m1"}, "b")
+    assert body.startswith(b"--b\r\nContent-Type: application/http\r\n")
+    assert b"Content-ID: <item-0>" in body
+    assert b"GET /gmail/v1/users/me/messages/m1\r\n" in body
+    assert body.endswith(b"--b--\r\n")
+
+
+def test_parse_batch_response():
+    responses = parse_batch_response(
+        "multipart/mixed; boundary=batch_abc", RESPONSE
+    )
+    assert set(responses) == {"item-0", "item-1", "item-2"}
+    assert responses["item-0"].status == 200
+    assert responses["item-0"].json() == {"id": "m1", "threadId": "t1"}
+    assert not responses["item-0"].is_retriable
+    assert responses["item-1"].is_retriable
+    assert responses["item-2"].is_rate_limited
+
+
+class FakeBatchSession:
+    """Answer batch calls from a dict of message ids, throttling each id once."""
+
+    def __init__(self):
+        self.calls = 0
+        self.throttled = set()
+
+    def post(self, url, data, headers, auth, timeout):
+        self.calls += 1
+        boundary = headers["Content-Type"].split("boundary=")[1]
+        parts = []
+        for block in data.decode().split(f"--{boundary}")[1:-1]:
+            content_id = block.split("Content-ID: <")[1].split(">")[0]
+            message_id = block.split("GET ")[1].split()[0].rsplit("/", 1)[1]
+            if message_id not in self.throttled:
+                self.throttled.add(message_id)
+                status, body = "429 Too Many Requests", "{}"
+            else:
+                status, body = "200 OK", json.dumps({"id": message_id})
+            parts.append(
+                f"--resp\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status}\r\n\r\n{body}\r\n"
+            )
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "multipart/mixed; boundary=resp"
+        response._content = ("".join(parts) + "--resp--\r\n").encode()
+        return response
+
+
+def test_batch_client_retries_only_failed_sub_requests(monkeypatch):
+    monkeypatch.setattr(GmailBatchClient, "_sleep", lambda self, attempt: None)
+    session = FakeBatchSession()
+    client = GmailBatchClient(
+        session=session,
+        url_base="https://gmail.googleapis.com",
+        batch_size=10,
+        rate_limiter=QuotaRateLimiter(1_000_000),
+        concurrency=AdaptiveConcurrency(3),
+    )
+    ids = [f"m{i}" for i in range(25)]
+
+    messages = list(client.get_messages("me", ids))
+
+    assert [message["id"] for message in messages] == ids
+    assert session.calls == 6  # three batches, each retried once
+    assert client.concurrency.limit < 3
+
+
+def test_batch_client_bounds_messages_in_flight(monkeypatch):
+    monkeypatch.setattr(GmailBatchClient, "_sleep", lambda self, attempt: None)
+    session = FakeBatchSession()
+    client = GmailBatchClient(
+        session=session,
+        url_base="https://gmail.googleapis.com",
+        batch_size=10,
+        rate_limiter=QuotaRateLimiter(1_000_000),
+        concurrency=AdaptiveConcurrency(4),
+        max_in_flight_messages=20,
+    )
+    messages = client.get_messages("me", [f"m{i}" for i in range(100)])
+
+    next(messages)
+
+    assert len(session.throttled) == 20
+
+
+def test_page_size_adapts_to_page_latency_and_size():
+    page_size = AdaptivePageSize(initial=100, maximum=500, target_seconds=1)
+
+    page_size.observe(100, 100, 0.1, 10_000)
+    page_size.observe(200, 150, 0.1, 10_000)  # A partial page says nothing
+    assert page_size.value == 200
+    page_size.observe(200, 200, 0.1, 10_000)
+    page_size.observe(400, 400, 0.1, 10_000)
+    assert page_size.value == 500
+    page_size.observe(500, 500, 3, 10_000)
+    assert page_size.value == 250
+    page_size.observe(250, 250, 0.1, 100 * 1024 * 1024)
+    assert page_size.value == 125
+
+
+def test_page_size_never_exceeds_gmails_limit():
+    page_size = AdaptivePageSize(initial=1000, maximum=2000)
+
+    assert page_size.value == page_size.maximum == 500
+    page_size.observe(500, 500, 0.1, 10_000)
+    assert page_size.value == 500
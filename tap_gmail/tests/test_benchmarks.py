@@ -0,0 +1,105 @@
+"""Throughput benchmarks against the local Gmail stand-in.
+
+Run with `pytest tap_gmail/tests/test_benchmarks.py` (pytest-benchmark is a dev
+dependency); `--benchmark-json` keeps the results for comparing runs.
+"""
+
+import tracemalloc
+from typing import Callable
+
+import pytest
+
+from tap_gmail.tap import TapGmail
+from tap_gmail.tests.fake_gmail import FakeMailbox, import_tap, run_sync
+
+pytest.importorskip("pytest_benchmark")
+
+MAILBOX_SIZE = 2000
+INCREMENTAL_SIZE = 200
+LATENCY = 0.005  # Seconds added to every request, roughly a nearby network
+
+
+def peak_traced_bytes(sync: Callable[[], object]) -> int:
+    """Return the peak memory Python allocates during `sync()`.
+
+    Measured in an extra, untimed run, as tracing slows allocations down. The
+    allocations of the in-process fake server are included.
+    """
+    tracemalloc.start()
+    try:
+        sync()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def record_metrics(benchmark, server, result, messages: int, sync: Callable[[], object]) -> None:
+    """Attach per-message costs, and the peak memory of `sync`, to the benchmark report."""
+    api_calls = sum(server.stats.values()) - server.stats["batch"] - server.stats["throttled"]
+    # messages.get calls all travel inside batch requests
+    http_requests = api_calls - server.stats["messages.get"] + server.stats["batch"]
+    benchmark.extra_info.update(
+        messages_per_second=messages / result.seconds,
+        requests_per_message=http_requests / messages,
+        api_calls_per_message=api_calls / messages,
+        time_to_first_record=result.first_record_seconds,
+    )
+    benchmark.extra_info["peak_traced_bytes"] = peak_traced_bytes(sync)
+
+
+@pytest.mark.parametrize("message_format", ["metadata", "full"])
+def test_full_sync(benchmark, make_gmail, message_format):
+    server, config = make_gmail(FakeMailbox(size=MAILBOX_SIZE), latency=LATENCY)
+    config = {**config, "use_incremental": False, "messages.format": message_format}
+
+    def sync():
+        server.stats.clear()
+        return run_sync(TapGmail, config)
+
+    result = benchmark.pedantic(sync, rounds=3, iterations=1)
+
+    assert len(result.records("messages")) == MAILBOX_SIZE
+    record_metrics(benchmark, server, result, MAILBOX_SIZE, sync)
+
+
+def test_incremental_sync(benchmark, make_gmail):
+    mailbox = FakeMailbox(size=MAILBOX_SIZE)
+    server, config = make_gmail(mailbox, latency=LATENCY)
+    state = run_sync(TapGmail, {**config, "use_incremental": False}).state
+    mailbox.add_messages(INCREMENTAL_SIZE)
+    config = {**config, "use_incremental": True}
+
+    def sync():
+        server.stats.clear()
+        return run_sync(TapGmail, config, state=state)
+
+    result = benchmark.pedantic(sync, rounds=3, iterations=1)
+
+    assert len(result.records("messages")) == INCREMENTAL_SIZE
+    record_metrics(benchmark, server, result, INCREMENTAL_SIZE, sync)
+
+
+def test_import_time(benchmark):
+    times = benchmark.pedantic(import_tap, rounds=3, iterations=1)
+
+    benchmark.extra_info.update(
+        import_seconds=times["tap_gmail.tap"],
+        sdk_import_seconds=times.get("singer_sdk", 0.0),
+    )
+
+
+def test_empty_incremental_sync(benchmark, make_gmail):
+    server, config = make_gmail(FakeMailbox(size=50), latency=LATENCY)
+    state = run_sync(TapGmail, {**config, "use_incremental": False}).state
+    config = {**config, "use_incremental": True, "decode.enabled": True}
+
+    def sync():
+        server.stats.clear()
+        return run_sync(TapGmail, config, state=state)
+
+    result = benchmark.pedantic(sync, rounds=5, iterations=1)
+
+    assert result.records("messages") == []
+    assert dict(server.stats) == {"history.list": 1}
+    bookmark = result.state["bookmarks"]["message_list"]["replication_key_value"]
+    assert bookmark == state["bookmarks"]["message_list"]["replication_key_value"]
@@ -0,0 +1,52 @@
+"""Tests for the persistent message cache."""
+
+import os
+
+from tap_gmail.cache import MessageCache
+from tap_gmail.tap import TapGmail
+from tap_gmail.tests.fake_gmail import FakeMailbox, run_sync
+
+VARIANT = MessageCache.variant({"format": "full"})
+
+
+def message(message_id, history_id, body=""):
+    return {"id": message_id, "historyId": history_id, "snippet": body}
+
+
+def test_cache_round_trip(tmp_path):
+    cache = MessageCache(str(tmp_path / "cache.db"), max_bytes=10**6, max_age_seconds=3600)
+    cache.put("me", message("a", "10"), VARIANT)
+    cache.put("me", message("a", "12"), VARIANT)
+    assert cache.history_ids("me", ["a", "b"], VARIANT) == {"a": 12}
+    assert cache.history_ids("other", ["a"], VARIANT) == {}
+    assert cache.history_ids("me", ["a"], MessageCache.variant({"format": "raw"})) == {}
+    assert cache.get("me", "a", VARIANT) == message("a", "12")
+    cache.close()
+
+    reopened = MessageCache(str(tmp_path / "cache.db"), max_bytes=10**6, max_age_seconds=3600)
+    assert reopened.get("me", "a", VARIANT) == message("a", "12")
+
+
+def test_cache_evicts_oldest_beyond_max_bytes(tmp_path):
+    cache = MessageCache(str(tmp_path / "cache.db"), max_bytes=3000, max_age_seconds=0)
+    for index in range(10):
+        # Incompressible bodies of about 1KB
+        cache.put("me", message(str(index), "1", os.urandom(500).hex()), VARIANT)
+    kept = cache.history_ids("me", [str(index) for index in range(10)], VARIANT)
+    assert 0 < len(kept) < 10
+    assert "9" in kept and "0" not in kept
+
+
+def test_second_sync_only_probes_cached_messages(make_gmail, tmp_path):
+    server, config = make_gmail(FakeMailbox(size=20))
+    config = {**config, "use_incremental": False, "cache.path": str(tmp_path / "cache.db")}
+    first = run_sync(TapGmail, config)
+    # Closing the last connection checkpoints and removes the write-ahead log
+    assert not os.path.exists(tmp_path / "cache.db-wal")
+    server.stats.clear()
+
+    second = run_sync(TapGmail, config)
+
+    assert second.records("messages") == first.records("messages")
+    # One format=minimal probe per message and no full re-fetch
+    assert server.stats["messages.get"] == 20
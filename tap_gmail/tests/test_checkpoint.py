@@ -0,0 +1,38 @@
+"""Tests for resumable history bookmarks."""
+
+from tap_gmail.checkpoint import (
+    HistoryCheckpoint,
+    StateUpdate,
+    apply_state_update,
+    max_history_id,
+)
+
+
+def test_max_history_id_compares_numerically():
+    assert max_history_id("999", None, "1000") == "1000"
+    assert max_history_id(None) is None
+
+
+def test_checkpoint_waits_for_every_message_of_a_record():
+    checkpoint = HistoryCheckpoint(
+        [("10", ["a", "b"]), ("11", []), ("12", ["c"]), ("13", ["a"])]
+    )
+    assert checkpoint.safe_history_id is None
+    assert checkpoint.emitted("a") is None
+    assert checkpoint.emitted("b") == "11"
+    assert checkpoint.emitted("c") == "13"
+    assert checkpoint.latest_history_id == "13"
+
+
+def test_state_update_never_moves_bookmarks_backwards():
+    state = {"replication_key_value": "20", "last_internal_date": 5, "next_page_token": "x"}
+    apply_state_update(
+        state,
+        StateUpdate(None, {"next_page_token": None}, history_id="9", last_internal_date=3),
+        "historyId",
+    )
+    assert state == {
+        "replication_key": "historyId",
+        "replication_key_value": "20",
+        "last_internal_date": 5,
+    }
@@ -0,0 +1,42 @@
+"""Tests for syncing partitions ahead of the SDK."""
+
+import threading
+
+import pytest
+
+from tap_gmail.fanout import PartitionPrefetcher
+
+PARTITIONS = [{"user_id": user_id} for user_id in ("a", "b", "c")]
+
+
+def test_prefetcher_runs_partitions_ahead_in_order():
+    started = []
+    all_started = threading.Event()
+
+    def produce(context):
+        started.append(context["user_id"])
+        if len(started) == len(PARTITIONS):
+            all_started.set()
+        # Every partition is in flight before the first one finishes
+        all_started.wait(timeout=5)
+        for index in range(5):
+            yield f"{context['user_id']}{index}"
+
+    prefetcher = PartitionPrefetcher(produce, PARTITIONS, max_workers=3, queue_size=2)
+    items = [list(prefetcher.items(context)) for context in PARTITIONS]
+    assert all_started.is_set()
+    assert items == [[f"{user_id}{index}" for index in range(5)] for user_id in "abc"]
+
+
+def test_prefetcher_raises_producer_errors_in_order():
+    def produce(context):
+        yield context["user_id"]
+        if context["user_id"] == "b":
+            raise ValueError("boom")
+
+    prefetcher = PartitionPrefetcher(produce, PARTITIONS, max_workers=2)
+    assert list(prefetcher.items(PARTITIONS[0])) == ["a"]
+    items = prefetcher.items(PARTITIONS[1])
+    assert next(items) == "b"
+    with pytest.raises(ValueError):
+        next(items)
@@ -0,0 +1,19 @@
+"""Tests for the JSON fast path."""
+
+from singer_sdk.helpers.jsonpath import extract_jsonpath
+
+from tap_gmail.fastjson import compile_jsonpath, dumps, loads
+
+DOCUMENT = {"messages": [{"id": "a"}, {"id": "b"}], "nextPageToken": "t", "nested": {"value": None}}
+
+
+def test_compiled_jsonpath_matches_the_sdk():
+    for expression in ("$.messages[*]", "$.nextPageToken", "$.nested.value", "$.missing", "$.missing[*]", "$.messages[0].id"):
+        assert list(compile_jsonpath(expression)(DOCUMENT)) == list(
+            extract_jsonpath(expression, DOCUMENT)
+        ), expression
+
+
+def test_round_trip():
+    assert loads(dumps(DOCUMENT)) == DOCUMENT
+    assert loads(dumps({"text": "é"}).decode()) == {"text": "é"}
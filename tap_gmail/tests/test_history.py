@@ -0,0 +1,40 @@
+"""Tests for collapsing history records into per-message changes."""
+
+from tap_gmail.history import summarize_history
+
+HISTORY = [
+    {"id": "10", "messagesAdded": [{"message": {"id": "a", "threadId": "t"}}]},
+    {
+        "id": "11",
+        "labelsAdded": [
+            {"message": {"id": "a", "labelIds": ["X"]}, "labelIds": ["X"]},
+            {"message": {"id": "b", "labelIds": ["X", "Y"]}, "labelIds": ["X", "Y"]},
+        ],
+    },
+    {
+        "id": "12",
+        "labelsRemoved": [{"message": {"id": "b", "labelIds": ["X"]}, "labelIds": ["Y"]}],
+        "messagesAdded": [{"message": {"id": "c", "threadId": "t"}}],
+    },
+    {"id": "13", "messagesDeleted": [{"message": {"id": "c", "threadId": "t"}}]},
+]
+
+
+def test_summarize_history_collapses_changes_per_message():
+    changes, page_records = summarize_history(HISTORY)
+
+    assert list(changes) == ["a", "b", "c"]  # "c" was added, then deleted
+    assert changes["a"]["changeType"] == "messageAdded"
+    assert changes["a"]["historyId"] == "11"
+    assert changes["b"]["changeType"] == "labelsChanged"
+    assert changes["b"]["addedLabelIds"] == ["X"]
+    assert changes["b"]["removedLabelIds"] == ["Y"]
+    assert changes["b"]["labelIds"] == ["X"]
+    assert changes["c"]["changeType"] == "messageDeleted"
+    assert changes["c"]["deleted"] is True
+    assert page_records == [
+        ("10", ["a"]),
+        ("11", ["a", "b"]),
+        ("12", ["c", "b"]),
+        ("13", ["c"]),
+    ]
@@ -0,0 +1,52 @@
+"""Tests for sync metrics."""
+
+import sys
+
+import pytest
+from singer_sdk.exceptions import ConfigValidationError
+
+from tap_gmail.instrumentation import SyncMetrics, endpoint_of
+from tap_gmail.tap import TapGmail
+
+
+def test_endpoint_of():
+    base = "https://gmail.googleapis.com/gmail/v1/users/me"
+    assert endpoint_of(base + "/messages?q=x") == "messages.list"
+    assert endpoint_of(base + "/messages/abc?format=full") == "messages.get"
+    assert endpoint_of(base + "/messages/abc/attachments/def") == "messages.attachments.get"
+    assert endpoint_of(base + "/history?startHistoryId=1") == "history.list"
+    assert endpoint_of("https://gmail.googleapis.com/batch/gmail/v1") == "batch"
+
+
+def test_metrics_export():
+    metrics = SyncMetrics()
+    metrics.increment("quota_units_total", 5, endpoint="messages.list")
+    metrics.increment("quota_units_total", 5, endpoint="messages.list")
+    for seconds in (0.001, 0.02, 0.02, 3):
+        metrics.observe("http_request_duration_seconds", seconds, endpoint="batch")
+
+    points = {
+        (point["metric"], point["tags"].get("quantile")): point for point in metrics.points()
+    }
+    assert all(isinstance(point["value"], (int, float)) for point in points.values())
+    assert points[("quota_units_total", None)]["value"] == 10
+    assert points[("http_request_duration_seconds_count", None)]["value"] == 4
+    assert points[("http_request_duration_seconds_count", None)]["type"] == "counter"
+    assert points[("http_request_duration_seconds", "0.5")]["value"] == 0.025
+    assert points[("http_request_duration_seconds", "0.5")]["type"] == "timer"
+    assert points[("http_request_duration_seconds", "1")]["value"] == 3
+
+    text = metrics.prometheus_text()
+    assert 'tap_gmail_quota_units_total{endpoint="messages.list"} 10' in text
+    assert 'tap_gmail_http_request_duration_seconds_bucket{endpoint="batch",le="0.025"} 3' in text
+    assert 'tap_gmail_http_request_duration_seconds_bucket{endpoint="batch",le="+Inf"} 4' in text
+
+
+def test_opentelemetry_without_its_extra_is_a_config_error(monkeypatch):
+    monkeypatch.setitem(sys.modules, "opentelemetry", None)
+    tap = TapGmail(
+        config={"user_id": "me", "metrics.opentelemetry": True}, parse_env_config=False
+    )
+
+    with pytest.raises(ConfigValidationError, match="opentelemetry extra"):
+        tap.instrumentation
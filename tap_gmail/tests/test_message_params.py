@@ -0,0 +1,87 @@
+"""The messages.get format and fields mask picked for the catalog."""
+
+from typing import Dict, Tuple
+
+from tap_gmail.tap import TapGmail
+
+CONFIG = {"user_id": "me", "api_url": "http://localhost"}
+
+
+def messages_stream(selected: Dict[Tuple[str, ...], bool], config: dict = CONFIG):
+    """Return the messages stream of a catalog selecting only the `selected` breadcrumbs.
+
+    Like a catalog listing every property, the payload's own properties are
+    deselected unless in `selected`.
+    """
+    tap = TapGmail(config=config, parse_env_config=False)
+    part_properties = tap.streams["messages"].schema["definitions"]["message_part"]["properties"]
+    selected = {
+        **{("properties", "payload", "properties", name): False for name in part_properties},
+        **selected,
+    }
+    catalog = tap.catalog_dict
+    for entry in catalog["streams"]:
+        is_messages = entry["tap_stream_id"] == "messages"
+        breadcrumbs = set()
+        for item in entry["metadata"]:
+            breadcrumb = tuple(item["breadcrumb"])
+            breadcrumbs.add(breadcrumb)
+            item["metadata"]["selected"] = is_messages and (
+                breadcrumb == () or selected.get(breadcrumb, False)
+            )
+        if is_messages:
+            entry["metadata"].extend(
+                {"breadcrumb": list(breadcrumb), "metadata": {"selected": value}}
+                for breadcrumb, value in selected.items()
+                if breadcrumb not in breadcrumbs
+            )
+    tap = TapGmail(config=config, catalog=catalog, parse_env_config=False)
+    return tap.streams["messages"]
+
+
+def test_ids_and_labels_only_need_the_minimal_format():
+    stream = messages_stream({("properties", "id"): True, ("properties", "labelIds"): True})
+
+    assert stream.message_params == {
+        "format": "minimal",
+        "fields": "id,threadId,historyId,internalDate,labelIds",
+    }
+
+
+def test_selected_headers_need_the_metadata_format():
+    stream = messages_stream(
+        {
+            ("properties", "id"): True,
+            ("properties", "payload"): True,
+            ("properties", "payload", "properties", "headers"): True,
+            ("properties", "payload", "properties", "headers", "items", "properties", "name"): True,
+        }
+    )
+
+    assert stream.message_params == {
+        "format": "metadata",
+        "fields": "id,threadId,historyId,internalDate,payload(headers)",
+    }
+
+
+def test_raw_needs_the_raw_format():
+    stream = messages_stream({("properties", "id"): True, ("properties", "raw"): True})
+
+    assert stream.message_params == {
+        "format": "raw",
+        "fields": "id,threadId,historyId,internalDate,raw",
+    }
+
+
+def test_selected_bodies_need_the_full_format():
+    stream = messages_stream(
+        {
+            ("properties", "payload"): True,
+            ("properties", "payload", "properties", "body"): True,
+        }
+    )
+
+    assert stream.message_params == {
+        "format": "full",
+        "fields": "id,threadId,historyId,internalDate,payload(body)",
+    }
@@ -0,0 +1,75 @@
+"""Tests for message decoding."""
+
+import base64
+
+from tap_gmail.mime import decode_message
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+MESSAGE = {
+    "id": "m1",
+    "payload": {
+        "mimeType": "multipart/mixed",
+        "headers": [
+            {"name": "Subject", "value": "Hi"},
+            {"name": "Received", "value": "a"},
+            {"name": "Received", "value": "b"},
+        ],
+        "body": {"size": 0},
+        "parts": [
+            {
+                "mimeType": "multipart/alternative",
+                "body": {"size": 0},
+                "parts": [
+                    {
+                        "mimeType": "text/plain",
+                        "headers": [{"name": "Content-Type", "value": 'text/plain; charset="iso-8859-1"'}],
+                        "body": {"size": 6, "data": b64url("café".encode("iso-8859-1"))},
+                    },
+                    {
+                        "mimeType": "text/html",
+                        "body": {"size": 11, "data": b64url(b"<p>caf\xc3\xa9</p>")},
+                    },
+                ],
+            },
+            {
+                "mimeType": "text/plain",
+                "filename": "notes.txt",
+                "body": {"size": 100, "attachmentId": "att"},
+            },
+        ],
+    },
+}
+
+
+def test_decode_payload():
+    decoded = decode_message(MESSAGE, max_body_bytes=1000)
+
+    assert decoded["headers"] == {"Subject": "Hi", "Received": "a\nb"}
+    assert decoded["text_body"] == "café"
+    assert decoded["html_body"] == "<p>café</p>"
+    assert decoded["body_truncated"] is False
+    alternative, attachment = decoded["payload"]["parts"]
+    assert all("data" not in part["body"] for part in alternative["parts"])
+    assert attachment["body"] == {"size": 100, "attachmentId": "att"}
+    # The input is left alone
+    assert "data" in MESSAGE["payload"]["parts"][0]["parts"][0]["body"]
+
+
+def test_decode_raw_and_truncate():
+    raw = (
+        "Subject: Hello\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "\r\n"
+        "déjà vu\r\n"
+    ).encode()
+
+    decoded = decode_message({"id": "m2", "raw": b64url(raw)}, max_body_bytes=3)
+
+    assert "raw" not in decoded
+    assert decoded["headers"]["Subject"] == "Hello"
+    assert decoded["text_body"] == "dé"
+    assert decoded["body_truncated"] is True
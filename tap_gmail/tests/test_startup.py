@@ -0,0 +1,14 @@
+"""Tests that starting the tap stays cheap."""
+
+from tap_gmail.tests.fake_gmail import import_tap
+
+# What the tap's own modules may add to importing the SDK, far above the usual 0.1s
+MAX_OWN_IMPORT_SECONDS = 0.5
+
+
+def test_import_defers_optional_modules():
+    times = import_tap()
+
+    assert times["loaded_lazy_modules"] == ""
+    own_seconds = times["tap_gmail.tap"] - times.get("singer_sdk", 0.0)
+    assert own_seconds < MAX_OWN_IMPORT_SECONDS
@@ -0,0 +1,212 @@
+"""End-to-end syncs against the local Gmail stand-in."""
+
+import pytest
+from singer_sdk.exceptions import ConfigValidationError
+
+from tap_gmail.batch import GmailBatchClient
+from tap_gmail.streams import DECODE_AHEAD, MessagesStream
+from tap_gmail.tap import TapGmail
+from tap_gmail.tests.fake_gmail import FakeMailbox, SyncFailed, run_sync
+
+
+def test_full_then_incremental_sync(make_gmail):
+    mailbox = FakeMailbox(size=250)
+    server, config = make_gmail(mailbox)
+
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+
+    assert len(full.records("messages")) == 250
+    assert full.state["bookmarks"]["message_list"]["replication_key_value"] == "1250"
+    assert server.stats["batch"] == 3
+
+    added = mailbox.add_messages(5)
+    incremental = run_sync(TapGmail, {**config, "use_incremental": True}, state=full.state)
+
+    assert [record["id"] for record in incremental.records("messages")] == added
+    assert server.stats["history.list"] == 1
+
+
+def test_sync_recovers_from_throttling(make_gmail):
+    server, config = make_gmail(FakeMailbox(size=120), throttle_every=25)
+
+    result = run_sync(TapGmail, {**config, "use_incremental": False})
+
+    assert server.stats["throttled"] > 0
+    assert len({record["id"] for record in result.records("messages")}) == 120
+
+
+def test_incremental_sync_emits_label_changes_and_deletions(make_gmail):
+    mailbox = FakeMailbox(size=20)
+    server, config = make_gmail(mailbox)
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+    ids = list(mailbox.messages)
+    mailbox.add_label(ids[:2], "STARRED")
+    mailbox.remove_label(ids[1:3], "UNREAD")
+    mailbox.delete([ids[3]])
+    added = mailbox.add_messages(2)
+    server.stats.clear()
+
+    result = run_sync(TapGmail, {**config, "use_incremental": True}, state=full.state)
+
+    changes = {record["id"]: record for record in result.records("message_list")}
+    assert changes[ids[0]]["addedLabelIds"] == ["STARRED"]
+    assert changes[ids[0]]["removedLabelIds"] == []
+    assert changes[ids[1]]["addedLabelIds"] == ["STARRED"]
+    assert changes[ids[1]]["removedLabelIds"] == ["UNREAD"]
+    assert changes[ids[2]]["removedLabelIds"] == ["UNREAD"]
+    assert changes[ids[3]]["changeType"] == "messageDeleted"
+    assert changes[ids[3]]["deleted"] is True
+    assert [record["id"] for record in result.records("messages")] == added
+    assert server.stats["messages.get"] == 2
+
+
+def test_sync_fails_rather_than_skip_a_message_it_cannot_fetch(make_gmail, monkeypatch):
+    monkeypatch.setattr(GmailBatchClient, "_sleep", lambda self, attempt: None)
+    mailbox = FakeMailbox(size=20)
+    server, config = make_gmail(mailbox)
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+    added = mailbox.add_messages(5)
+    server.throttle_ids.add(added[2])
+
+    with pytest.raises(SyncFailed) as failed:
+        run_sync(TapGmail, {**config, "use_incremental": True}, state=full.state)
+
+    states = [
+        message["value"]["bookmarks"]["message_list"].get("replication_key_value")
+        for message in failed.value.result.messages
+        if message["type"] == "STATE"
+    ]
+    # Message n was added at history id 1001 + n; the bookmark must stay short of it
+    assert all(int(state) < 1023 for state in states if state)
+    assert added[2] not in {record["id"] for record in failed.value.result.records("messages")}
+
+
+def test_message_gone_before_it_is_fetched_is_emitted_as_deleted(make_gmail):
+    mailbox = FakeMailbox(size=20)
+    server, config = make_gmail(mailbox)
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+    added = mailbox.add_messages(3)
+    # Gone from messages.get while history still only shows it being added
+    del mailbox.messages[added[1]]
+
+    result = run_sync(TapGmail, {**config, "use_incremental": True}, state=full.state)
+
+    assert [record["id"] for record in result.records("messages")] == [added[0], added[2]]
+    tombstones = [record for record in result.records("message_list") if record.get("deleted")]
+    assert [record["id"] for record in tombstones] == [added[1]]
+    assert result.state["bookmarks"]["message_list"]["replication_key_value"] == "1023"
+
+
+def test_sync_recovers_from_expired_history(make_gmail):
+    mailbox = FakeMailbox(size=0)
+    mailbox.add_messages(300)  # All within the fallback scan's margin
+    server, config = make_gmail(mailbox)
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+    mailbox.expire_history()
+    added = mailbox.add_messages(3)
+    server.stats.clear()
+
+    result = run_sync(TapGmail, {**config, "use_incremental": True}, state=full.state)
+
+    # Messages of the full sync are known from its state and not fetched again
+    assert sorted(record["id"] for record in result.records("messages")) == sorted(added)
+    assert server.stats["messages.get"] == 3
+    assert int(result.state["bookmarks"]["message_list"]["replication_key_value"]) >= mailbox.min_history_id
+
+
+def test_each_mailbox_keeps_its_own_bookmark(make_gmail):
+    mailboxes = {"a@example.com": FakeMailbox(size=30), "b@example.com": FakeMailbox(size=10, seed=1)}
+    server, config = make_gmail(mailboxes)
+
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+
+    for stream in ("message_list", "messages"):
+        records = full.records(stream)
+        assert sorted((record["user_id"], record["id"]) for record in records) == sorted(
+            (user_id, message_id)
+            for user_id, mailbox in mailboxes.items()
+            for message_id in mailbox.messages
+        )
+
+    def bookmarks(result):
+        return {
+            partition["context"]["user_id"]: partition["replication_key_value"]
+            for partition in result.state["bookmarks"]["message_list"]["partitions"]
+        }
+
+    assert bookmarks(full) == {"a@example.com": "1030", "b@example.com": "1010"}
+
+    added = mailboxes["b@example.com"].add_messages(2)
+    incremental = run_sync(TapGmail, {**config, "use_incremental": True}, state=full.state)
+
+    assert [(record["user_id"], record["id"]) for record in incremental.records("messages")] == [
+        ("b@example.com", message_id) for message_id in added
+    ]
+    assert bookmarks(incremental) == {"a@example.com": "1030", "b@example.com": "1012"}
+
+
+def test_threads_sync_refetches_only_changed_threads(make_gmail):
+    mailbox = FakeMailbox(size=30)
+    server, config = make_gmail(mailbox)
+    full = run_sync(TapGmail, {**config, "use_incremental": False}, selected=("threads",))
+
+    threads = full.records("threads")
+    assert len(threads) == 10
+    assert all(len(thread["messages"]) == 3 for thread in threads)
+
+    mailbox.add_messages(4)
+    server.stats.clear()
+    incremental = run_sync(
+        TapGmail, {**config, "use_incremental": True}, selected=("threads",), state=full.state
+    )
+
+    assert [len(thread["messages"]) for thread in incremental.records("threads")] == [3, 1]
+    assert server.stats["threads.get"] == 2
+    assert incremental.state["bookmarks"]["threads"]["replication_key_value"] == "1034"
+
+
+def test_pages_grow_while_they_come_back_quickly(make_gmail):
+    mailbox = FakeMailbox(size=1200)
+    server, config = make_gmail(mailbox)
+
+    full = run_sync(TapGmail, {**config, "use_incremental": False})
+
+    assert len({record["id"] for record in full.records("messages")}) == 1200
+    # 100, 200, 400 then 500 messages per page
+    assert server.stats["messages.list"] == 4
+
+
+def test_page_sizes_above_gmails_limit_are_rejected(make_gmail):
+    server, config = make_gmail(FakeMailbox(size=1))
+
+    with pytest.raises(ConfigValidationError):
+        TapGmail(config={**config, "fetch.max_page_size": 1000}, parse_env_config=False)
+
+
+def test_messages_are_decoded_ahead_of_their_hand_off(make_gmail, monkeypatch):
+    server, config = make_gmail(FakeMailbox(size=150))
+    events = []
+    prepare = MessagesStream.prepare
+    tag_mailbox = MessagesStream._tag_mailbox
+
+    def logged_prepare(self, message):
+        events.append("submitted")
+        return prepare(self, message)
+
+    def logged_tag_mailbox(row, context):
+        events.append("emitted")
+        return tag_mailbox(row, context)
+
+    monkeypatch.setattr(MessagesStream, "prepare", logged_prepare)
+    monkeypatch.setattr(MessagesStream, "_tag_mailbox", staticmethod(logged_tag_mailbox))
+
+    result = run_sync(
+        TapGmail,
+        {**config, "use_incremental": False, "decode.enabled": True, "decode.processes": 2},
+    )
+
+    records = result.records("messages")
+    assert len(records) == 150
+    assert all("text_body" in record for record in records)
+    assert events[:DECODE_AHEAD] == ["submitted"] * DECODE_AHEAD
+    assert events.count("submitted") == events.count("emitted") == 150
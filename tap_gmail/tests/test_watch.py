@@ -0,0 +1,63 @@
+"""Tests for following mailbox changes from users.watch notifications."""
+
+import threading
+import time
+
+from tap_gmail.tap import TapGmail
+from tap_gmail.tests.fake_gmail import FakeMailbox, run_sync
+from tap_gmail.watch import NotificationFile, collect_changes
+
+
+def test_notification_bursts_are_coalesced(tmp_path):
+    path = tmp_path / "notifications.jsonl"
+    path.write_text('{"emailAddress": "old@example.com", "historyId": "1"}\n')
+    source = NotificationFile(str(path))
+    with path.open("a") as file:
+        file.write(
+            '{"emailAddress": "a@example.com", "historyId": "5"}\n'
+            '{"emailAddress": "a@example.com", "historyId": "7"}\n'
+            "not json\n"
+            '{"emailAddress": "b@example.com", "historyId": 3}\n'
+            '{"emailAddress": "c@exa'
+        )
+
+    changes = collect_changes(source, 0.1, 1, until=time.monotonic() + 1)
+
+    assert changes == {"a@example.com": "7", "b@example.com": "3"}
+    assert collect_changes(source, 0.1, 1, until=time.monotonic() + 0.2) == {}
+
+
+def test_watch_pulls_history_once_per_burst(make_gmail):
+    mailbox = FakeMailbox(size=20)
+    server, config = make_gmail(mailbox)
+    state = run_sync(TapGmail, {**config, "use_incremental": False}).state
+    config = {
+        **config,
+        "use_incremental": True,
+        "watch.enabled": True,
+        "watch.topic": "projects/p/topics/gmail",
+        "watch.subscription": "projects/p/subscriptions/tap-gmail",
+        "watch.pubsub_url": server.url,
+        "watch.debounce_seconds": 0.3,
+        "watch.max_runtime_seconds": 3,
+    }
+    added = []
+
+    def deliver():
+        time.sleep(1)
+        for _ in range(3):
+            added.extend(mailbox.add_messages(1))
+            server.publish("me")
+
+    delivery = threading.Thread(target=deliver)
+    delivery.start()
+    server.stats.clear()
+    result = run_sync(TapGmail, config, state=state)
+    delivery.join()
+
+    assert [record["id"] for record in result.records("messages")] == added
+    # The catch-up sync, then one pull for the whole burst
+    assert server.stats["history.list"] == 2
+    assert server.watches == {"me": "projects/p/topics/gmail"}
+    bookmark = result.state["bookmarks"]["message_list"]["replication_key_value"]
+    assert bookmark == str(mailbox.history_id)
@@ -0,0 +1,151 @@
+"""Mailbox change notifications from users.watch, for pulling history as mail arrives."""
+
+import base64
+import json
+import logging
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import requests
+from requests.auth import AuthBase
+
+from tap_gmail.checkpoint import max_history_id
+
+PUBSUB_URL = "https://pubsub.googleapis.com"
+IDLE_SECONDS = 0.5  # Pause after a pull that found nothing
+RENEW_MARGIN_SECONDS = 3600  # Renew a watch this long before it expires
+
+logger = logging.getLogger(__name__)
+
+
+class Notification(NamedTuple):
+    """A mailbox changed; its history is complete up to `history_id`."""
+
+    email_address: str
+    history_id: str
+
+
+def parse_notification(data: bytes) -> Optional[Notification]:
+    """Decode the JSON body Gmail publishes, ignoring anything else."""
+    try:
+        body = json.loads(data)
+        return Notification(body["emailAddress"], str(body["historyId"]))
+    except (ValueError, TypeError, KeyError):
+        logger.warning(f"Ignoring malformed notification: {data[:200]!r}")
+        return None
+
+
+class PubSubSubscription:
+    """Pull notifications from a Pub/Sub subscription over its REST API.
+
+    Messages are acknowledged as soon as they are pulled: a notification only
+    says that history moved, and the next pull from the bookmark catches up on
+    anything a lost notification announced.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        subscription: str,
+        auth: AuthBase,
+        url_base: str = PUBSUB_URL,
+        max_messages: int = 1000,
+    ) -> None:
+        """Initialize for a subscription such as "projects/p/subscriptions/s"."""
+        self.session = session
+        self.url = f"{url_base}/v1/{subscription}"
+        self.auth = auth
+        self.max_messages = max_messages
+
+    def pull(self, timeout: float) -> List[Notification]:
+        """Return the notifications waiting, after up to about `timeout` seconds."""
+        try:
+            response = self.session.post(
+                f"{self.url}:pull",
+                json={"maxMessages": self.max_messages},
+                auth=self.auth,
+                timeout=max(timeout, 1),
+            )
+        except requests.exceptions.Timeout:
+            return []
+        response.raise_for_status()
+        received = response.json().get("receivedMessages", [])
+        if not received:
+            time.sleep(min(timeout, IDLE_SECONDS))
+            return []
+        self.session.post(
+            f"{self.url}:acknowledge",
+            json={"ackIds": [message["ackId"] for message in received]},
+            auth=self.auth,
+            timeout=60,
+        ).raise_for_status()
+        notifications = [
+            parse_notification(base64.b64decode(message["message"].get("data", "")))
+            for message in received
+        ]
+        return [notification for notification in notifications if notification]
+
+
+class NotificationFile:
+    """Read notifications appended to a JSON-lines file, e.g. by a push endpoint.
+
+    Each line holds the body Gmail publishes: {"emailAddress": ..., "historyId": ...}.
+    Only lines written after the tap started are read.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize at the current end of `path`."""
+        self.path = path
+        self._offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def pull(self, timeout: float) -> List[Notification]:
+        """Return the complete lines appended since the last pull."""
+        lines: List[bytes] = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as file:
+                file.seek(self._offset)
+                data = file.read()
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            lines = [line for line in data[:end].splitlines() if line.strip()]
+        if not lines:
+            time.sleep(min(timeout, IDLE_SECONDS))
+            return []
+        notifications = [parse_notification(line) for line in lines]
+        return [notification for notification in notifications if notification]
+
+
+def collect_changes(
+    source,
+    debounce_seconds: float,
+    max_delay_seconds: float,
+    until: Optional[float] = None,
+) -> Dict[str, str]:
+    """Wait for notifications and return the latest historyId of each mailbox.
+
+    Once a notification arrives, more are gathered until `debounce_seconds` pass
+    without any, or `max_delay_seconds` after the first, so a burst of new mail
+    turns into one history pull. Returns empty if `until` (a `time.monotonic()`
+    deadline) passes first.
+    """
+    changes: Dict[str, str] = {}
+    first = last = 0.0
+    while True:
+        now = time.monotonic()
+        if changes:
+            quiet_at = min(last + debounce_seconds, first + max_delay_seconds)
+            if now >= quiet_at:
+                return changes
+            wait = quiet_at - now
+        elif until is not None and now >= until:
+            return changes
+        else:
+            wait = until - now if until is not None else debounce_seconds + IDLE_SECONDS
+        for notification in source.pull(wait):
+            if not changes:
+                first = time.monotonic()
+            last = time.monotonic()
+            changes[notification.email_address] = max_history_id(
+                changes.get(notification.email_address), notification.history_id
+            )